@@ -0,0 +1,140 @@
+import os
+import sys
+import json
+import queue
+import select
+import asyncio
+import itertools
+import threading
+import subprocess
+from concurrent.futures import Future
+
+
+class ASRPool:
+    """
+    Pool of Whisper worker processes (see asr_worker.py) fed by a shared job queue.
+
+    Each worker process loads the model once. Jobs are dispatched by one thread per worker, and
+    a job that runs longer than `timeout` seconds fails with TimeoutError and its worker process
+    is restarted, so one stuck recording cannot block the others. The web process only waits
+    on futures and never loads the model itself.
+    """
+
+    def __init__(self, model_size, model_download_root, workers=1, timeout=300, load_timeout=1800, vad=False):
+        self.model_size = model_size
+        self.model_download_root = model_download_root
+        self.vad = vad
+        self.workers = workers
+        self.timeout = timeout
+        self.load_timeout = load_timeout
+
+        self._jobs = queue.Queue()
+        self._ids = itertools.count()
+        self._ready = 0
+        self._ready_lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        """Start the worker processes in the background, the models load while the server is already running."""
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run_worker, name=f"asr-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    @property
+    def ready_workers(self):
+        with self._ready_lock:
+            return self._ready
+
+    def _start_process(self):
+        command = [sys.executable, "-m", "asr_worker",
+                   "--model_size", self.model_size,
+                   "--model_download_root", self.model_download_root]
+        if self.vad:
+            command.append("--vad")
+        process = subprocess.Popen(
+            command,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            encoding='utf-8',
+            bufsize=1,
+        )
+        try:
+            reply = self._read_reply(process, self.load_timeout)
+            if not reply.get("ready"):
+                raise RuntimeError(f"ASR worker failed to start: {reply}")
+        except Exception:
+            process.kill()
+            process.wait()
+            raise
+        with self._ready_lock:
+            self._ready += 1
+        return process
+
+    def _stop_process(self, process):
+        with self._ready_lock:
+            self._ready -= 1
+        process.kill()
+        process.wait()
+
+    @staticmethod
+    def _read_reply(process, timeout):
+        readable, _, _ = select.select([process.stdout], [], [], timeout)
+        if not readable:
+            raise TimeoutError(f"ASR worker did not answer within {timeout} seconds")
+        line = process.stdout.readline()
+        if not line:
+            raise RuntimeError(f"ASR worker exited with code {process.wait()}")
+        return json.loads(line)
+
+    def _run_worker(self):
+        # load the model right away instead of on the first job
+        try:
+            process = self._start_process()
+        except Exception as e:
+            print(f"Failed to start ASR worker: {e}")
+            process = None
+
+        while True:
+            future, job = self._jobs.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                if process is None:
+                    process = self._start_process()
+                process.stdin.write(json.dumps(job, ensure_ascii=False) + "\n")
+                process.stdin.flush()
+                reply = self._read_reply(process, self.timeout)
+            except Exception as e:
+                # the worker is stuck or dead, replace it for the next job
+                if process is not None:
+                    self._stop_process(process)
+                    process = None
+                future.set_exception(e)
+                continue
+
+            if "error" in reply:
+                future.set_exception(RuntimeError(reply["error"]))
+            else:
+                future.set_result(reply["text"])
+
+    def submit(self, audio_path):
+        """
+        Queue a transcription job.
+
+        Parameters:
+            audio_path (str): Path to the audio file
+
+        Returns:
+            concurrent.futures.Future: Resolves to the transcribed text
+        """
+        future = Future()
+        self._jobs.put((future, {"id": next(self._ids), "audio_path": os.path.abspath(audio_path)}))
+        return future
+
+    async def transcribe(self, audio_path):
+        """Transcribe an audio file without blocking the event loop."""
+        return await asyncio.wrap_future(self.submit(audio_path))
@@ -0,0 +1,48 @@
+import os
+import sys
+import json
+import argparse
+import traceback
+
+import whisper
+
+from vad import transcribe_with_vad
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Whisper ASR worker process, reads jobs from stdin and writes results to stdout (one JSON object per line).")
+    parser.add_argument("--model_size", type=str, default="large", help="Whisper model size (tiny, base, small, medium, large)")
+    parser.add_argument("--model_download_root", type=str, default="envs/whisper", help="Whisper model download path")
+    parser.add_argument("--vad", action="store_true", help="Cut silences with voice activity detection before decoding")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    # Results go to the original stdout, anything printed by libraries goes to stderr
+    results = os.fdopen(os.dup(sys.stdout.fileno()), 'w', encoding='utf-8', buffering=1)
+    sys.stdout = sys.stderr
+
+    # Load the model once for the lifetime of the worker
+    model = whisper.load_model(args.model_size, download_root=args.model_download_root)
+    results.write(json.dumps({"ready": True}) + "\n")
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        job = json.loads(line)
+        try:
+            if args.vad:
+                text = transcribe_with_vad(model, job["audio_path"])
+            else:
+                text = model.transcribe(job["audio_path"])["text"]
+            reply = {"id": job["id"], "text": text}
+        except Exception as e:
+            traceback.print_exc()
+            reply = {"id": job["id"], "error": f"{type(e).__name__}: {e}"}
+        results.write(json.dumps(reply, ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    main()
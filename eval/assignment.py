@@ -0,0 +1,145 @@
+import random
+import threading
+from collections import defaultdict
+from datetime import datetime
+
+from completion_rules import text_length
+
+
+def chain_position(data):
+    """Position in the annotation chain of the next annotation of an image (0 = first description)."""
+    if 'annotation_history' not in data and 'history_summary' in data:
+        return data['history_summary']['annotation_count']
+    return len(data.get('annotation_history', []))
+
+
+def annotation_seconds(info):
+    """Time spent on one annotation, or None if the timestamps are missing or invalid."""
+    try:
+        start = datetime.strptime(info.get('start_time', ''), '%Y-%m-%d %H:%M:%S')
+        end = datetime.strptime(info.get('end_time', ''), '%Y-%m-%d %H:%M:%S')
+    except (TypeError, ValueError):
+        return None
+    seconds = (end - start).total_seconds()
+    return seconds if seconds > 0 else None
+
+
+class AnnotatorStats:
+    """
+    Measured annotation throughput per annotator and chain position.
+
+    Semantic units are only extracted offline from the final captions, so the size of a
+    supplement (in words, CJK characters counting as words) stands in for the semantic units it
+    adds. Annotations that took longer than `max_seconds` (abandoned sessions) are ignored.
+    """
+
+    def __init__(self, max_seconds=3600):
+        self.max_seconds = max_seconds
+        self._units = defaultdict(float)     # (annotator id, position) -> units
+        self._seconds = defaultdict(float)   # (annotator id, position) -> seconds
+        self._lock = threading.Lock()
+
+    def add(self, annotator_id, position, units, seconds):
+        if seconds is None or seconds > self.max_seconds:
+            return
+        with self._lock:
+            self._units[(str(annotator_id), position)] += units
+            self._seconds[(str(annotator_id), position)] += seconds
+
+    def learn(self, data, latest_only=False):
+        """
+        Add the annotations of a record.
+
+        Parameters:
+            data (dict): Annotation record
+            latest_only (bool): Only add the last annotation, e.g. right after a submission
+        """
+        history = data.get('annotation_history', [])
+        start = len(history) - 1 if latest_only else 0
+        for position in range(max(start, 0), len(history)):
+            info = history[position].get('annotation_info', {})
+            if 'annotator_id' not in info:
+                continue
+            self.add(info['annotator_id'], position, text_length(info.get('annotation') or ""), annotation_seconds(info))
+
+    def rate(self, annotator_id, position):
+        """Units per second of an annotator at a chain position, or None if not measured."""
+        with self._lock:
+            seconds = self._seconds.get((str(annotator_id), position))
+            return self._units[(str(annotator_id), position)] / seconds if seconds else None
+
+    def position_rate(self, position):
+        """Units per second of all annotators at a chain position, or None if not measured."""
+        with self._lock:
+            units = sum(v for (_, p), v in self._units.items() if p == position)
+            seconds = sum(v for (_, p), v in self._seconds.items() if p == position)
+        return units / seconds if seconds else None
+
+
+# -----------------------------
+# Assignment policies
+# -----------------------------
+# A policy orders the chain positions that have available images, the index then picks an
+# eligible image at the first position that has one.
+
+class RandomPolicy:
+    """Any available image with the same probability (the original behaviour)."""
+    name = "random"
+
+    def order(self, annotator_id, sizes):
+        # weighted shuffle of the positions by their number of images
+        return sorted(sizes, key=lambda position: random.random() ** (1.0 / sizes[position]), reverse=True)
+
+    def learn(self, data, latest_only=False):
+        pass
+
+
+class MostAdvancedPolicy(RandomPolicy):
+    """Finish the longest chains first, so fewer images are left half-annotated."""
+    name = "most_advanced"
+
+    def order(self, annotator_id, sizes):
+        return sorted(sizes, reverse=True)
+
+
+class BreadthFirstPolicy(RandomPolicy):
+    """Give every image its first description before any image gets a supplement."""
+    name = "breadth_first"
+
+    def order(self, annotator_id, sizes):
+        return sorted(sizes)
+
+
+class ThroughputPolicy(RandomPolicy):
+    """
+    Send annotators to the chain position where they are fastest compared with everyone else
+    (measured units per second divided by the average at that position). Positions without
+    measurements score 1, ties go to the most advanced chain.
+    """
+    name = "throughput"
+
+    def __init__(self, stats=None):
+        self.stats = stats or AnnotatorStats()
+
+    def score(self, annotator_id, position):
+        rate = self.stats.rate(annotator_id, position)
+        average = self.stats.position_rate(position)
+        if rate is None or not average:
+            return 1.0
+        return rate / average
+
+    def order(self, annotator_id, sizes):
+        return sorted(sizes, key=lambda position: (self.score(annotator_id, position), position), reverse=True)
+
+    def learn(self, data, latest_only=False):
+        self.stats.learn(data, latest_only)
+
+
+POLICIES = {policy.name: policy for policy in (RandomPolicy, MostAdvancedPolicy, BreadthFirstPolicy, ThroughputPolicy)}
+
+
+def make_policy(name):
+    """Create an assignment policy by name (see POLICIES)."""
+    if name not in POLICIES:
+        raise ValueError(f"Unknown assignment policy: {name}")
+    return POLICIES[name]()
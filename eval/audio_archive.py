@@ -0,0 +1,180 @@
+import os
+import json
+import queue
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+
+
+COMPRESSED_FORMATS = {
+    "flac": ["-c:a", "flac"],
+    "opus": ["-c:a", "libopus", "-b:a", "32k"],
+}
+
+
+def file_hash(path, block_size=1 << 20):
+    """SHA-256 of a file's content."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class AudioArchive:
+    """
+    Content-addressed archive of the annotators' recordings, with a transcript cache.
+
+    Layout under `root`:
+        objects/<ab>/<sha256>.<wav|flac|opus>   one copy of each distinct recording
+        transcripts/<ab>/<sha256>.json           cached transcripts of that recording, per ASR setting
+        <record_key>/recordings.jsonl            which recordings were made for an image, and when
+
+    New recordings are stored as WAV and compressed to `audio_format` by a background thread
+    (ffmpeg), 'wav' keeps them uncompressed.
+    """
+
+    def __init__(self, root, audio_format="flac"):
+        if audio_format != "wav" and audio_format not in COMPRESSED_FORMATS:
+            raise ValueError(f"Unknown audio format: {audio_format}")
+        self.root = root
+        self.audio_format = audio_format
+        self._compress_queue = queue.Queue()
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(root, "transcripts"), exist_ok=True)
+
+    def start(self):
+        """Start the background compression thread and queue the recordings left uncompressed by a previous run."""
+        if self.audio_format == "wav":
+            return self
+        threading.Thread(target=self._compress_worker, name="audio-compression", daemon=True).start()
+        threading.Thread(target=self._queue_leftovers, name="audio-compression-scan", daemon=True).start()
+        return self
+
+    def _object_base(self, digest):
+        return os.path.join(self.root, "objects", digest[:2], digest)
+
+    def object_path(self, digest):
+        """Path of the archived recording, compressed or not, or None if it is not archived."""
+        base = self._object_base(digest)
+        for ext in (self.audio_format, "wav", *COMPRESSED_FORMATS):
+            if os.path.exists(f"{base}.{ext}"):
+                return f"{base}.{ext}"
+        return None
+
+    def store(self, audio_path, record_key):
+        """
+        Archive a recording made for an image. Identical recordings are stored once.
+
+        Parameters:
+            audio_path (str): Path to the WAV recording
+            record_key (str): Key of the annotated image
+
+        Returns:
+            str: Content hash of the recording
+        """
+        digest = file_hash(audio_path)
+        with self._lock:
+            if self.object_path(digest) is None:
+                base = self._object_base(digest)
+                os.makedirs(os.path.dirname(base), exist_ok=True)
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(base), prefix=".", suffix=".tmp")
+                os.close(fd)
+                shutil.copyfile(audio_path, tmp_path)
+                os.replace(tmp_path, f"{base}.wav")
+                if self.audio_format != "wav":
+                    self._compress_queue.put(digest)
+            self._add_reference(digest, record_key)
+        return digest
+
+    def _add_reference(self, digest, record_key):
+        folder = os.path.join(self.root, record_key)
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, "recordings.jsonl")
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                if any(json.loads(line).get("hash") == digest for line in f if line.strip()):
+                    return
+        with open(path, 'a', encoding='utf-8') as f:
+            entry = {"hash": digest, "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+            f.write(json.dumps(entry) + "\n")
+
+    # -----------------------------
+    # Transcript cache
+    # -----------------------------
+
+    def _transcript_path(self, digest):
+        return os.path.join(self.root, "transcripts", digest[:2], digest + ".json")
+
+    def get_transcript(self, digest, tag):
+        """
+        Return the cached transcript of a recording for an ASR setting, or None.
+
+        Parameters:
+            digest (str): Content hash of the recording
+            tag (str): ASR setting the transcript was made with (e.g. model size and VAD)
+        """
+        path = self._transcript_path(digest)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f).get(tag)
+        except (OSError, json.JSONDecodeError):
+            return None
+
+    def put_transcript(self, digest, tag, text):
+        """Cache the transcript of a recording for an ASR setting."""
+        path = self._transcript_path(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self._lock:
+            transcripts = {}
+            if os.path.exists(path):
+                try:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        transcripts = json.load(f)
+                except (OSError, json.JSONDecodeError):
+                    transcripts = {}
+            transcripts[tag] = text
+            tmp_path = path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(transcripts, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+
+    # -----------------------------
+    # Background compression
+    # -----------------------------
+
+    def _queue_leftovers(self):
+        for folder, _, files in os.walk(os.path.join(self.root, "objects")):
+            for name in files:
+                if name.endswith(".wav"):
+                    self._compress_queue.put(name[:-len(".wav")])
+
+    def _compress_worker(self):
+        while True:
+            digest = self._compress_queue.get()
+            try:
+                self.compress(digest)
+            except Exception as e:
+                print(f"Failed to compress recording {digest}: {e}")
+
+    def compress(self, digest):
+        """Compress an archived WAV recording with ffmpeg and remove the WAV copy."""
+        base = self._object_base(digest)
+        source = f"{base}.wav"
+        target = f"{base}.{self.audio_format}"
+        if not os.path.exists(source):
+            return
+        tmp_target = f"{base}.tmp.{self.audio_format}"
+        subprocess.run(
+            ["ffmpeg", "-nostdin", "-loglevel", "error", "-y", "-i", source,
+             *COMPRESSED_FORMATS[self.audio_format], tmp_target],
+            check=True,
+        )
+        os.replace(tmp_target, target)
+        os.remove(source)
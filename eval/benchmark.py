@@ -0,0 +1,315 @@
+import os
+import sys
+import json
+import time
+import wave
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+
+
+# What the simulated annotators say, the fake Whisper model returns it for their recordings
+DESCRIPTIONS = [
+    "This aerial image shows a parking lot with {n} cars parked in rows next to a grey building.",
+    "A harbor with {n} boats moored along a concrete pier, the water is dark blue.",
+    "An airport apron with {n} small airplanes parked beside a long runway.",
+    "A residential area with {n} houses with red roofs along a curved road.",
+]
+SUPPLEMENTS = [
+    "There are also {n} trees along the road on the left side.",
+    "Two of the vehicles are white trucks near the entrance.",
+    "The building has a flat roof with {n} ventilation units.",
+    "A footpath crosses the grass area in the upper right corner.",
+]
+COMPLETE_REPLY = "Nothing to add, the annotation is complete."
+
+
+def parse_args():
+    """
+    Parse the benchmark arguments. Unknown arguments are passed on to cotalk, e.g. --async_submit.
+    """
+    parser = argparse.ArgumentParser(description="Load test of the CoTalk handlers with simulated annotators, a fake LLM and a fake Whisper model.")
+    parser.add_argument("--annotators", type=int, default=8, help="Number of simulated annotators working at the same time")
+    parser.add_argument("--images", type=int, default=200, help="Size of the synthetic image corpus")
+    parser.add_argument("--image_size", type=int, default=1024, help="Side in pixels of the synthetic images")
+    parser.add_argument("--duration_seconds", type=float, default=60, help="Stop handing out images after this many seconds")
+    parser.add_argument("--llm_latency", type=float, default=0.5, help="Latency in seconds of each fake LLM call")
+    parser.add_argument("--asr_latency", type=float, default=1.0, help="Latency in seconds of each fake Whisper transcription")
+    parser.add_argument("--think_seconds", type=float, default=0.0, help="Mean time an annotator spends on an image before recording")
+    parser.add_argument("--complete_ratio", type=float, default=0.2, help="Share of supplements saying the caption is complete")
+    parser.add_argument("--storage", type=str, default="json", choices=["json", "split", "sqlite"], help="Storage backend of the synthetic corpus")
+    parser.add_argument("--layout", type=str, default="flat", choices=["flat", "sharded"], help="Folder layout of the json and split backends")
+    parser.add_argument("--person_num", type=int, default=2, help="Annotations per image, as in cotalk")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the corpus and the annotators")
+    parser.add_argument("--workdir", type=str, default=None, help="Folder of the synthetic corpus and outputs (default: a temporary folder, removed afterwards)")
+    parser.add_argument("--report_json", type=str, default=None, help="Also write the results to this JSON file")
+    return parser.parse_known_args()
+
+
+# -----------------------------
+# Fakes and synthetic data
+# -----------------------------
+
+class FakeWhisper:
+    """
+    Stand-in for a Whisper model: returns the text scripted for a recording after `latency` seconds.
+
+    Like Whisper, it takes a file path or the decoded samples, which --vad passes after cutting the
+    silences. Samples are matched to the recording whose PCM data contains their first 10ms.
+    """
+
+    def __init__(self, latency, scripts):
+        self.latency = latency
+        self.scripts = scripts
+
+    def transcribe(self, audio, **kwargs):
+        time.sleep(self.latency)
+        if isinstance(audio, str):
+            return {"text": self.scripts.get(audio, "")}
+        return {"text": self.script_of_samples(audio)}
+
+    def script_of_samples(self, samples):
+        # whisper.load_audio decodes 16-bit PCM as pcm / 32768
+        head = np.round(np.asarray(samples[:160], dtype=np.float64) * 32768).astype(np.int16).tobytes()
+        for path, text in list(self.scripts.items()):
+            try:
+                with wave.open(path, 'rb') as wav_file:
+                    pcm = wav_file.readframes(wav_file.getnframes())
+            except (OSError, EOFError, wave.Error):
+                continue
+            position = pcm.find(head)
+            while position >= 0 and position % 2:
+                position = pcm.find(head, position + 1)
+            if position >= 0:
+                return text
+        raise ValueError(f"No scripted recording matches the {len(samples)} samples")
+
+
+def make_corpus(image_folder, count, size, seed):
+    """Write `count` synthetic PNG images with random rectangles."""
+    from PIL import Image, ImageDraw
+
+    os.makedirs(image_folder, exist_ok=True)
+    rng = random.Random(seed)
+    for i in range(count):
+        image = Image.new("RGB", (size, size), tuple(rng.randrange(256) for _ in range(3)))
+        draw = ImageDraw.Draw(image)
+        for _ in range(20):
+            x, y = rng.randrange(size), rng.randrange(size)
+            draw.rectangle([x, y, x + rng.randrange(8, 64), y + rng.randrange(8, 64)], fill=tuple(rng.randrange(256) for _ in range(3)))
+        image.save(os.path.join(image_folder, f"B{i:06d}.png"))
+
+
+def write_recording(folder, rng, seconds=1.0):
+    """Write a unique noise recording, so the transcript cache never answers for Whisper."""
+    from streaming_asr import write_wav
+
+    fd, path = tempfile.mkstemp(dir=folder, prefix="recording_", suffix=".wav")
+    os.close(fd)
+    samples = np.random.default_rng(rng.randrange(2 ** 32)).uniform(-0.1, 0.1, int(16000 * seconds)).astype(np.float32)
+    write_wav(path, samples, 16000)
+    return path
+
+
+# -----------------------------
+# Measurements
+# -----------------------------
+
+class LatencyRecorder:
+    def __init__(self):
+        self.samples = defaultdict(list)
+        self.errors = defaultdict(int)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def time(self, operation):
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            with self._lock:
+                self.errors[operation] += 1
+            raise
+        with self._lock:
+            self.samples[operation].append(time.perf_counter() - start)
+
+    def wrap(self, operation, fn):
+        def wrapper(*args, **kwargs):
+            with self.time(operation):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    def summary(self):
+        with self._lock:
+            samples = {operation: list(values) for operation, values in self.samples.items()}
+            errors = dict(self.errors)
+        result = {}
+        for operation in sorted(set(samples) | set(errors)):
+            values = np.array(samples.get(operation, [])) * 1000
+            result[operation] = {
+                "count": int(len(values)),
+                "errors": errors.get(operation, 0),
+                "p50_ms": float(np.percentile(values, 50)) if len(values) else None,
+                "p95_ms": float(np.percentile(values, 95)) if len(values) else None,
+                "p99_ms": float(np.percentile(values, 99)) if len(values) else None,
+            }
+        return result
+
+
+def update_value(output):
+    """Value of a handler output, which is either a plain value or a gr.update(...) dict."""
+    return output.get("value") if isinstance(output, dict) else output
+
+
+# -----------------------------
+# Simulated annotators
+# -----------------------------
+
+def run_annotator(cotalk, recorder, annotator_id, deadline, settings, scripts, recordings_folder):
+    rng = random.Random(f"{settings.seed}-{annotator_id}")
+    view = cotalk.update_view("", annotator_id)
+    while time.monotonic() < deadline:
+        record_key, history = update_value(view[1]), update_value(view[2])
+        if not record_key:
+            break
+        first = not history or history == "Please describe the image as thoroughly as possible"
+        if settings.think_seconds:
+            time.sleep(rng.expovariate(1.0 / settings.think_seconds))
+
+        if first:
+            text = rng.choice(DESCRIPTIONS).format(n=rng.randint(2, 40))
+        elif rng.random() < settings.complete_ratio:
+            text = COMPLETE_REPLY
+        else:
+            text = rng.choice(SUPPLEMENTS).format(n=rng.randint(2, 40))
+
+        audio_path = write_recording(recordings_folder, rng)
+        scripts[audio_path] = text
+        try:
+            with recorder.time("transcribe_audio"):
+                transcript = asyncio.run(cotalk.transcribe_audio(audio_path, record_key))
+            with recorder.time("submit_annotation"):
+                outputs = list(cotalk.submit_annotation(transcript, None, record_key, history, "", annotator_id))
+            view = outputs[-1]
+        except Exception as e:
+            print(f"Annotator {annotator_id} failed on {record_key}: {e}")
+            view = cotalk.update_view(record_key, annotator_id)
+        finally:
+            scripts.pop(audio_path, None)
+            os.remove(audio_path)
+
+    # hand back the image the annotator was working on
+    record_key = update_value(view[1])
+    if record_key:
+        cotalk.store.release(record_key, annotator_id)
+
+
+# cotalk options whose code path the fakes cannot serve: Whisper worker processes load the real
+# model, and the microphone stream is not simulated (annotators upload whole recordings)
+UNSUPPORTED_COTALK_ARGS = ("--asr_workers", "--stream_asr")
+
+
+def main():
+    settings, cotalk_args = parse_args()
+    for arg in cotalk_args:
+        if arg.split("=")[0] in UNSUPPORTED_COTALK_ARGS:
+            sys.exit(f"{arg.split('=')[0]} is not supported by the benchmark: the fake Whisper model runs in-process and recordings are uploaded whole")
+    workdir = settings.workdir or tempfile.mkdtemp(prefix="cotalk_bench_")
+    image_folder = os.path.join(workdir, "images")
+    json_folder = os.path.join(workdir, "annotation_json")
+    sqlite_path = os.path.join(workdir, "annotation.db")
+    recordings_folder = os.path.join(workdir, "recordings")
+    os.makedirs(recordings_folder, exist_ok=True)
+
+    try:
+        print(f"Creating {settings.images} synthetic images in {workdir}")
+        make_corpus(image_folder, settings.images, settings.image_size, settings.seed)
+
+        from storage import open_store
+        store = open_store(settings.storage, json_folder_path=json_folder, sqlite_path=sqlite_path, layout=settings.layout)
+        for name in sorted(os.listdir(image_folder)):
+            store.create(name)
+
+        # cotalk reads its settings from the command line when it is imported
+        os.environ["COTALK_LLM_BACKEND"] = "fake"
+        os.environ["COTALK_FAKE_LLM_LATENCY"] = str(settings.llm_latency)
+        sys.argv = [
+            "cotalk",
+            "--original_image_folder", image_folder,
+            "--json_folder_path", json_folder,
+            "--storage", settings.storage,
+            "--sqlite_path", sqlite_path,
+            "--audio_save_dir", os.path.join(workdir, "audio"),
+            "--audio_format", "wav",
+            "--display_cache_folder", os.path.join(workdir, "display_images"),
+            "--tile_cache_folder", os.path.join(workdir, "tiles"),
+            "--person_num", str(settings.person_num),
+            "--asr_workers", "0",
+            *cotalk_args,
+        ]
+        import cotalk
+        from metrics import EVENTS
+
+        scripts = {}
+        cotalk.model = FakeWhisper(settings.asr_latency, scripts)
+        cotalk.model_ready.set()
+        cotalk.build_index()
+
+        recorder = LatencyRecorder()
+        # handlers look these up as module globals, so the nested calls are measured too
+        cotalk.find_unlocked_image = recorder.wrap("find_unlocked_image", cotalk.find_unlocked_image)
+        cotalk.update_view = recorder.wrap("update_view", cotalk.update_view)
+
+        print(f"Running {settings.annotators} annotators for {settings.duration_seconds:g}s "
+              f"(LLM {settings.llm_latency:g}s, ASR {settings.asr_latency:g}s, extra cotalk arguments: {' '.join(cotalk_args) or 'none'})")
+        start = time.monotonic()
+        deadline = start + settings.duration_seconds
+        threads = [
+            threading.Thread(target=run_annotator, args=(cotalk, recorder, f"bench-{i}", deadline, settings, scripts, recordings_folder), daemon=True)
+            for i in range(settings.annotators)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # background merges (--async_submit) belong to the run
+        while len(cotalk.merge_queue) and time.monotonic() < deadline + 120:
+            time.sleep(0.1)
+        elapsed = time.monotonic() - start
+
+        completed = sum(1 for _, data in cotalk.store.iter_records() if data.get("annotation_completed") == "Yes")
+        results = {
+            "settings": vars(settings),
+            "cotalk_args": cotalk_args,
+            "elapsed_seconds": elapsed,
+            "images_completed": completed,
+            "images_per_minute": completed / (elapsed / 60),
+            "submissions": int(EVENTS.value(event="submission")),
+            "lock_conflicts": int(EVENTS.value(event="lock_conflict")),
+            "operations": recorder.summary(),
+        }
+    finally:
+        if settings.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"\n{'operation':<22}{'count':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for operation, stats in results["operations"].items():
+        latencies = "".join(f"{stats[key]:>10.1f}" if stats[key] is not None else f"{'-':>10}" for key in ("p50_ms", "p95_ms", "p99_ms"))
+        print(f"{operation:<22}{stats['count']:>7}{stats['errors']:>8}{latencies}")
+    print(f"\nImages completed: {results['images_completed']} in {elapsed:.1f}s ({results['images_per_minute']:.1f} per minute)")
+    print(f"Submissions: {results['submissions']}, lock conflicts: {results['lock_conflicts']}")
+
+    if settings.report_json:
+        with open(settings.report_json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
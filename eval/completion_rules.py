@@ -0,0 +1,87 @@
+import re
+import threading
+
+
+# Replies meaning "nothing to add", after normalization (lowercase, no punctuation)
+COMPLETE_PHRASES = {
+    "none", "no", "nope", "nothing", "n a", "na", "nil", "null", "0",
+    "done", "complete", "completed", "finished", "all good", "looks good", "ok", "okay",
+    "thats all", "that is all", "thats it", "that is it",
+    "nothing to add", "nothing more", "nothing else", "nothing more to add", "nothing else to add",
+    "no more", "no addition", "no additions", "no supplement", "no more additions",
+    "its complete", "it is complete", "its already complete", "it is already complete",
+    "the annotation is complete", "annotation is complete", "the description is complete",
+    "i think thats all", "i think that is all", "i think its complete", "i think it is complete",
+    "无", "没有", "没有了", "无补充", "没有补充", "没有要补充的", "没什么要补充的", "完整", "已完整", "已经完整了", "就这些",
+}
+
+# Words that make a longer reply worth asking the LLM about
+COMPLETE_KEYWORDS = re.compile(
+    r"\b(none|nothing|complete|completed|finished|that'?s all|that is all|no more|no addition)\b|无|没有|完整|就这些"
+)
+
+_PUNCTUATION = re.compile(r"[^\w\s]|_")
+_CJK = re.compile(r"[一-鿿]")
+
+
+def normalize(text):
+    text = text.lower().replace("'", "").replace("’", "")
+    text = _PUNCTUATION.sub(" ", text)
+    return " ".join(text.split())
+
+
+def text_length(text):
+    """Length in words, counting each CJK character as a word."""
+    cjk = len(_CJK.findall(text))
+    return len(_CJK.sub(" ", text).split()) + cjk
+
+
+class CompletionJudge:
+    """
+    Local decision stage in front of the LLM completion judge.
+
+    Short replies that are a known "nothing to add" phrase are complete, long descriptive replies
+    without any completion wording are not. Everything else is left to the LLM. Counters report
+    how many LLM round trips the fast path saved.
+    """
+
+    def __init__(self, min_descriptive_words=8):
+        self.min_descriptive_words = min_descriptive_words
+        self.fast_complete = 0
+        self.fast_incomplete = 0
+        self.llm_calls = 0
+        self._lock = threading.Lock()
+
+    def decide(self, caption):
+        """
+        Returns:
+            bool or None: True if the caption says the annotation is complete, False if it is a
+            real supplement, None if the LLM should decide
+        """
+        normalized = normalize(caption)
+        if normalized in COMPLETE_PHRASES:
+            decision = True
+        elif text_length(normalized) >= self.min_descriptive_words and not COMPLETE_KEYWORDS.search(caption.lower()):
+            decision = False
+        else:
+            decision = None
+
+        with self._lock:
+            if decision is True:
+                self.fast_complete += 1
+            elif decision is False:
+                self.fast_incomplete += 1
+            else:
+                self.llm_calls += 1
+        return decision
+
+    def stats(self):
+        with self._lock:
+            fast = self.fast_complete + self.fast_incomplete
+            total = fast + self.llm_calls
+            return {
+                "fast_complete": self.fast_complete,
+                "fast_incomplete": self.fast_incomplete,
+                "llm_calls": self.llm_calls,
+                "fast_path_hit_rate": fast / total if total else 0.0,
+            }
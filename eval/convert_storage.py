@@ -0,0 +1,58 @@
+import argparse
+from tqdm import tqdm
+
+from storage import JsonStore, SplitStore, SqliteStore, add_layout_args
+
+
+def copy_records(source, target):
+    """
+    Copy every annotation record from one storage backend to another.
+
+    Parameters:
+        source: Store to read from
+        target: Store to write to, existing records with the same key are replaced
+
+    Returns:
+        int: Number of copied records
+    """
+    keys = sorted(source.keys())
+    copied = 0
+    for key in tqdm(keys, desc=f"{source.kind} -> {target.kind}"):
+        try:
+            target.save(key, source.load(key))
+            copied += 1
+        except Exception as e:
+            print(f"Failed to copy {key}: {e}")
+    print(f"Copied {copied}/{len(keys)} records.")
+    return copied
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import the JSON annotation layout into SQLite or the split layout, export them back to JSON files, or copy a JSON or split folder into another folder layout.")
+    parser.add_argument("direction", choices=["import", "export", "relayout"], help="'import': JSON folder -> backend, 'export': backend -> JSON folder, 'relayout': JSON folder -> --target_json_folder_path in --layout (with --backend split: split folder -> --target_split_folder_path)")
+    parser.add_argument("--backend", type=str, default="sqlite", choices=["sqlite", "split"], help="Storage backend on the other side of the conversion")
+    parser.add_argument("--json_folder_path", type=str, default="output/annotation_json", help="Folder with one JSON file per image")
+    parser.add_argument("--sqlite_path", type=str, default="output/annotation.db", help="SQLite database path")
+    parser.add_argument("--split_folder_path", type=str, default="output/annotation_split", help="Folder of the split layout (state file + history log per image)")
+    parser.add_argument("--target_json_folder_path", type=str, default="output/annotation_json_sharded", help="New JSON folder of 'relayout'")
+    parser.add_argument("--target_split_folder_path", type=str, default="output/annotation_split_sharded", help="New split folder of 'relayout' with --backend split")
+    add_layout_args(parser)
+    args = parser.parse_args()
+
+    if args.direction == "relayout":
+        if args.backend == "split":
+            copy_records(SplitStore(args.split_folder_path), SplitStore(args.target_split_folder_path, args.layout or "sharded", args.shard_chars))
+        else:
+            copy_records(JsonStore(args.json_folder_path), JsonStore(args.target_json_folder_path, args.layout or "sharded", args.shard_chars))
+    else:
+        # --layout applies to the folder being written
+        json_store = JsonStore(args.json_folder_path, args.layout if args.direction == "export" else None, args.shard_chars)
+        if args.backend == "sqlite":
+            other_store = SqliteStore(args.sqlite_path)
+        else:
+            other_store = SplitStore(args.split_folder_path, args.layout if args.direction == "import" else None, args.shard_chars)
+        # exporting the split layout compacts each history log back into its canonical JSON record
+        if args.direction == "import":
+            copy_records(json_store, other_store)
+        else:
+            copy_records(other_store, json_store)
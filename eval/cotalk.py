@@ -1,18 +1,31 @@
 import gradio as gr
-import whisper
 import os
+import asyncio
 import argparse
-from datetime import datetime
-import shutil
+from datetime import datetime, timedelta
 import json
 import re
+import time
 from pathlib import Path
-import random
-from llm.llm import llm
-from prompt.PROMPT_TEMPLATE import Prompt_Speech_Normalization, Prompt_Text_Integration, Prompt_Is_Complete
+from llm.llm import llm, llm_stream, warm_up as llm_warm_up
+from prompt.PROMPT_TEMPLATE import Prompt_Speech_Normalization, Prompt_Text_Integration, Prompt_Is_Complete, Prompt_Judge_And_Integrate
 
 import threading
-from schedule_unlock import start_unlocker_job
+from schedule_unlock import start_unlocker_job, LockDeadlines
+from image_index import ImageIndex
+from assignment import POLICIES, make_policy, annotation_seconds
+from metrics import STAGE_SECONDS, EVENTS, ANNOTATOR_SUBMISSIONS, ANNOTATOR_UNITS, ANNOTATOR_SECONDS, TimedStore, time_stage, timed, start_metrics_server
+from storage import open_store, add_storage_args
+from asr_pool import ASRPool
+from streaming_asr import StreamingTranscript
+from vad import transcribe_with_vad
+from audio_archive import AudioArchive
+from completion_rules import CompletionJudge, text_length
+from merge_queue import MergeQueue
+from display_cache import DisplayCache
+from tile_pyramid import TilePyramid, viewer_html, OPENSEADRAGON_URL
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Chain-of-Talkers (CoTalk): Fast Human Annotation of Dense Image Captions")
@@ -20,11 +33,23 @@ def parse_args():
     # Model settings
     parser.add_argument("--model_size", type=str, default="large", help="Whisper model size (tiny, base, small, medium, large)")
     parser.add_argument("--model_download_root", type=str, default="envs/whisper", help="Whisper model download path")
+    parser.add_argument("--asr_workers", type=int, default=0, help="Number of Whisper worker processes. 0 loads the model in the web process")
+    parser.add_argument("--asr_timeout", type=int, default=300, help="Timeout in seconds of one transcription job in the worker pool")
+    parser.add_argument("--vad", action="store_true", help="Cut silences with voice activity detection before Whisper decoding (the archived audio is unchanged)")
+    parser.add_argument("--stream_asr", action="store_true", help="Transcribe the microphone stream in chunks while the annotator is speaking")
+    parser.add_argument("--stream_chunk_seconds", type=float, default=5.0, help="Length in seconds of the audio chunks transcribed in streaming mode")
 
     # Data paths
     parser.add_argument("--json_folder_path", type=str, default="output/annotation_json", help="save JSON folder path")
     parser.add_argument("--original_image_folder", type=str, default="data/image", help="Original image folder path")
+    parser.add_argument("--display_cache_folder", type=str, default="output/display_images", help="Folder of the display-sized copies of the images, built on demand")
+    parser.add_argument("--display_size", type=int, default=800, help="Longest side in pixels of the displayed images. 0 serves the original files")
+    parser.add_argument("--zoom_viewer", action="store_true", help="Show the image in a deep-zoom viewer fed by a cached tile pyramid instead of a downscaled picture")
+    parser.add_argument("--tile_cache_folder", type=str, default="output/tiles", help="Folder of the tile pyramids of the zoom viewer")
+    parser.add_argument("--openseadragon_url", type=str, default=OPENSEADRAGON_URL, help="Base URL of the OpenSeadragon build used by the zoom viewer")
     parser.add_argument("--audio_save_dir", type=str, default="output/audio", help="Audio save directory")
+    parser.add_argument("--audio_format", type=str, default="flac", choices=["flac", "opus", "wav"], help="Format the archived recordings are compressed to in the background")
+    add_storage_args(parser)
 
     # Server settings
     parser.add_argument("--server_name", type=str, default="", help="Server IP or domain name")
@@ -33,14 +58,26 @@ def parse_args():
     parser.add_argument("--ssl_certfile", type=str, default="cert.pem", help="SSL certificate file path")
     parser.add_argument("--ssl_keyfile", type=str, default="key.pem", help="SSL private key file path")
     parser.add_argument("--ssl_verify", action="store_true", help="Verify SSL (default False)")
+    parser.add_argument("--metrics_port", type=int, default=0, help="Serve Prometheus metrics on this port (/metrics), 0 disables them")
 
     # annotation num
     parser.add_argument("--person_num", type=int, default=2, help="If > 0, specifies the exact number of annotations required for completion. "
              "If <= 0, indicates that annotation can only be completed when someone explicitly states there are no further additions needed.")
+    parser.add_argument("--assignment_policy", type=str, default="random", choices=sorted(POLICIES),
+                        help="Which image an annotator gets next: random, the most advanced chains first, breadth first, "
+                             "or the chain position where the annotator is fastest (throughput)")
 
     # schedule settings
     parser.add_argument("--interval_seconds", type=int, default=10, help="Interval in seconds between checks (default: 10)")
     parser.add_argument("--timeout_minutes", type=int, default=15, help="Lock timeout duration in minutes. Files locked longer than this will be unlocked (default: 15)")
+
+    # LLM settings
+    parser.add_argument("--no_judge_fast_path", action="store_true", help="Always ask the LLM whether an annotation says the caption is complete, without the local rules")
+    parser.add_argument("--judge_mode", type=str, default="sequential", choices=["sequential", "combined", "speculative"],
+                        help="How a supplement is judged and merged: one LLM call after the other, one structured call answering both, or both calls in parallel")
+    parser.add_argument("--async_submit", action="store_true", help="Save a supplement and serve the next image right away, judging and merging it in the background")
+    parser.add_argument("--merge_workers", type=int, default=2, help="Number of background threads merging asynchronous submissions")
+    parser.add_argument("--stream_merge", action="store_true", help="Stream the merged caption to the annotator while the LLM is generating it")
     
     return parser.parse_args()
 
@@ -48,11 +85,106 @@ def parse_args():
 # Global variables (initialized by args)
 args = parse_args()
 
-# Load Whisper model
-model = whisper.load_model(args.model_size, download_root=args.model_download_root)
+# Whisper runs either in separate worker processes or in the web process, loaded in the background by start_warm_up()
+model = None
+model_ready = threading.Event()
+# Jobs of the in-process model run one at a time
+speech_executor = ThreadPoolExecutor(max_workers=1)
+# Completion judgements running next to the merge in speculative judge mode
+speculative_executor = ThreadPoolExecutor(max_workers=8)
+asr_pool = ASRPool(args.model_size, args.model_download_root, workers=args.asr_workers, timeout=args.asr_timeout, vad=args.vad) if args.asr_workers > 0 else None
+
+# Content-addressed audio archive, also caching the transcript of each distinct recording
+audio_archive = AudioArchive(args.audio_save_dir, audio_format=args.audio_format).start()
+# Transcripts depend on the ASR settings
+transcript_tag = f"whisper-{args.model_size}" + ("-vad" if args.vad else "")
+
+# Open the annotation storage, the image state index is built once at startup by start_warm_up()
+store = TimedStore(open_store(args.storage, json_folder_path=args.json_folder_path, sqlite_path=args.sqlite_path))
+assignment_policy = make_policy(args.assignment_policy)
+image_index = ImageIndex(policy=assignment_policy)
+lock_deadlines = LockDeadlines(timedelta(minutes=args.timeout_minutes))
+index_ready = threading.Event()
+# Longest time an annotator waits for the image index before being asked to try again
+INDEX_WAIT_SECONDS = 60
+
+# Display-sized copies of the images, the likely next image of each annotator is prepared while they work
+display_cache = DisplayCache(args.original_image_folder, args.display_cache_folder, max_size=args.display_size) if args.display_size > 0 else None
+prefetch_executor = ThreadPoolExecutor(max_workers=2)
+next_images = {}
+# Deep-zoom tile pyramids, built on first view and prefetched like the display images
+tile_pyramid = TilePyramid(args.original_image_folder, args.tile_cache_folder) if args.zoom_viewer else None
+
+# Readiness of the background warm-up tasks, shown in the UI
+startup_status = {
+    "Image index": "loading",
+    "Speech recognition": "loading",
+    "LLM connection": "connecting",
+}
+
+
+def build_index():
+    # submissions whose background merge was interrupted by a restart are merged again
+    merging = []
+
+    def records():
+        for key, data in lock_deadlines.track(store.iter_records()):
+            if data.get("image_status") == "merging":
+                merging.append(key)
+            # throughput measurements of the existing annotations
+            assignment_policy.learn(data)
+            yield key, data
+
+    try:
+        image_index.build(records())
+        startup_status["Image index"] = f"ready ({len(image_index)} images)"
+    except Exception as e:
+        startup_status["Image index"] = f"failed: {e}"
+        raise
+    finally:
+        # handlers waiting for the index must not block forever if it could not be built
+        index_ready.set()
+        merge_queue.start()
+    for key in merging:
+        merge_queue.put(key)
+
+
+def load_speech_model():
+    global model
+    if asr_pool is not None:
+        asr_pool.start()
+        startup_status["Speech recognition"] = "loading in worker processes"
+        return
+    import whisper
+    model = whisper.load_model(args.model_size, download_root=args.model_download_root)
+    model_ready.set()
+    startup_status["Speech recognition"] = "ready"
+
+
+def connect_llm():
+    startup_status["LLM connection"] = "ready" if llm_warm_up() else "unreachable, requests will be retried"
+
+
+def start_warm_up():
+    """Build the image index, load Whisper and open the LLM connection in background threads, so the server binds its port right away."""
+    def run(name, task):
+        try:
+            task()
+        except Exception as e:
+            startup_status[name] = f"failed: {e}"
+            print(f"Warm-up of {name} failed: {e}")
+
+    for name, task in [("Image index", build_index), ("Speech recognition", load_speech_model), ("LLM connection", connect_llm)]:
+        threading.Thread(target=run, args=(name, task), name=f"warm-up {name}", daemon=True).start()
+
 
-# Create audio save directory
-os.makedirs(args.audio_save_dir, exist_ok=True)
+def readiness_markdown():
+    status = dict(startup_status)
+    if asr_pool is not None and status["Speech recognition"].startswith("loading"):
+        status["Speech recognition"] = f"{asr_pool.ready_workers}/{asr_pool.workers} workers ready"
+    if len(merge_queue):
+        status["Background merges"] = f"{len(merge_queue)} pending"
+    return "\n".join(f"- **{name}**: {value}" for name, value in status.items())
 
 
 # Extract JSON content
@@ -69,12 +201,24 @@ def process_json(json_str):
     else:
         return json_data
 
+
+# Extract the (possibly unfinished) caption from a partial LLM output
+def partial_caption(text):
+    match = re.search(r'"caption"\s*:\s*"((?:[^"\\]|\\.)*)', text, re.DOTALL)
+    if not match:
+        return ""
+    try:
+        return json.loads(f'"{match.group(1)}"')
+    except json.JSONDecodeError:
+        # cut inside an escape sequence, show the raw text until the next token arrives
+        return match.group(1)
+
 # Speech-to-text normalization
 def process(pre_text):
     prompt_normalization = Prompt_Speech_Normalization.format(
         pre_text=pre_text,
     )
-    llm_result = llm(prompt_normalization)
+    llm_result = llm(prompt_normalization, tag="normalization")
     # print("LLM normalization output:", llm_result)
     return process_json(llm_result)
 
@@ -85,17 +229,43 @@ def process_history_annotation(caption1, caption2):
         caption1= caption1,
         caption2 = caption2
     )
-    llm_result = llm(prompt)
+    llm_result = llm(prompt, tag="merge")
     print("Merged historical annotation:", llm_result)
     return process_json(llm_result)
 
 
-# Judge if annotation is complete
-def judged_all_annotations(caption):
+# Merge historical annotations, yielding the partial merged caption while it is generated
+def process_history_annotation_stream(caption1, caption2):
+    prompt = Prompt_Text_Integration.format( 
+        caption1= caption1,
+        caption2 = caption2
+    )
+    llm_result = ""
+    for delta in llm_stream(prompt, tag="merge"):
+        llm_result += delta
+        partial = partial_caption(llm_result)
+        if partial:
+            yield partial
+    print("Merged historical annotation:", llm_result)
+    yield process_json(llm_result)
+
+
+# Judge if annotation is complete, obvious cases are settled locally without an LLM call
+completion_judge = CompletionJudge()
+
+def fast_judge(caption):
+    if args.no_judge_fast_path:
+        return None
+    decision = completion_judge.decide(caption)
+    print(f"Completion judge: {completion_judge.stats()}")
+    return decision
+
+
+def llm_judge(caption):
     prompt = Prompt_Is_Complete.format(
         caption= caption,
     )
-    llm_result = llm(prompt)
+    llm_result = llm(prompt, tag="judge")
     is_complete = process_json(llm_result)
     if is_complete == '0':
         return True
@@ -103,144 +273,497 @@ def judged_all_annotations(caption):
         return False
 
 
+# Merge historical annotations, yielding ("partial", caption) steps when streaming and a final ("merged", caption)
+# `show_partial` holds the partial captions back until it returns True
+def merge_steps(caption1, caption2, show_partial=lambda: True):
+    if not args.stream_merge:
+        yield "merged", process_history_annotation(caption1, caption2)
+        return
+    processed_label = None
+    for processed_label in process_history_annotation_stream(caption1, caption2):
+        if show_partial():
+            yield "partial", processed_label
+    yield "merged", processed_label
+
+
+# Judge and merge in one LLM call, the output starts with the completion flag so the caption can still be streamed
+def judge_and_merge_combined(caption1, caption2):
+    prompt = Prompt_Judge_And_Integrate.format(
+        caption1= caption1,
+        caption2 = caption2
+    )
+    llm_result = ""
+    if args.stream_merge:
+        for delta in llm_stream(prompt, tag="judge_merge"):
+            llm_result += delta
+            if re.search(r'"complete"\s*:\s*"?0', llm_result):
+                partial = partial_caption(llm_result)
+                if partial:
+                    yield "partial", partial
+    else:
+        llm_result = llm(prompt, tag="judge_merge")
+    print("Judged and merged historical annotation:", llm_result)
+
+    match = re.search(r'```json(.*?)```', llm_result, re.DOTALL)
+    json_data = json.loads(match.group(1).strip() if match else llm_result.strip())
+    if str(json_data.get("complete", "0")).strip() == "1":
+        yield "complete", None
+    else:
+        yield "merged", json_data["caption"]
+
+
+# Decide whether a supplement completes the caption and otherwise merge it into the caption.
+# Yields ("partial", caption) while a streamed merge is generated, then ("complete", None) or ("merged", caption).
+def judge_and_merge(caption1, caption2):
+    decision = fast_judge(caption2)
+    if decision is True:
+        yield "complete", None
+        return
+    if decision is False:
+        yield from merge_steps(caption1, caption2)
+        return
+
+    if args.judge_mode == "combined":
+        yield from judge_and_merge_combined(caption1, caption2)
+    elif args.judge_mode == "speculative":
+        # ask both questions at once, the merge is thrown away if the caption turns out to be complete
+        judge_future = speculative_executor.submit(llm_judge, caption2)
+        if not args.stream_merge:
+            merge_future = speculative_executor.submit(process_history_annotation, caption1, caption2)
+            # the merge is not waited for when the judge says the caption is complete
+            if judge_future.result():
+                merge_future.cancel()
+                yield "complete", None
+            else:
+                yield "merged", merge_future.result()
+            return
+
+        merged = None
+        # partial captions are held back until the judge has answered, then each step checks its answer
+        steps = merge_steps(caption1, caption2, show_partial=judge_future.done)
+        try:
+            for kind, value in steps:
+                # stop generating the merge as soon as the judge says the caption is complete
+                if judge_future.done() and judge_future.result():
+                    break
+                if kind == "partial":
+                    yield kind, value
+                else:
+                    merged = value
+        except Exception:
+            # a failed merge does not matter if the caption is complete
+            if not judge_future.result():
+                raise
+        finally:
+            steps.close()
+        if judge_future.result():
+            yield "complete", None
+        else:
+            yield "merged", merged
+    else:
+        if llm_judge(caption2):
+            yield "complete", None
+        else:
+            yield from merge_steps(caption1, caption2)
+
+
 # Find an unlocked image
+@timed("find_image")
 def find_unlocked_image(checksum):
-    json_files = [f for f in os.listdir(args.json_folder_path) if f.endswith('.json')]
-    random.shuffle(json_files)
+    if not index_ready.wait(timeout=INDEX_WAIT_SECONDS) or not startup_status["Image index"].startswith("ready"):
+        raise gr.Error(f"The image index is not available ({startup_status['Image index']}), please try again later.")
+    # images whose lock failed stay reserved until we return, so the loop does not pick them again
+    failed_keys = []
+    try:
+        return reserve_image(checksum, failed_keys)
+    finally:
+        for record_key in failed_keys:
+            image_index.mark_unlocked(record_key)
+
+
+# Reserve the next eligible image in the index and lock it in the storage
+def reserve_image(checksum, failed_keys):
+    while True:
+        record_key = image_index.reserve_next(checksum, prefer=next_images.pop(checksum, None))
+        if record_key is None:
+            return {"image": None}
 
-    for json_filename in json_files:
-        json_filepath = os.path.join(args.json_folder_path, json_filename)
         try:
-            with open(json_filepath, 'r', encoding='utf-8') as file:
-                data = json.load(file)
-
-            if data.get("image_status") == "unlocked" and data.get("annotation_completed") == 'No':
-                history = data.get('annotation_history', [])
-                # check whether the image is completed or whether the same person has annotated
-                ids = [item['id'] for item in history if 'id' in item]
-                if checksum not in ids:
-                    print(f"Selected image: {json_filename}")
-
-                    # Lock the image
-                    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    data['lock_time'] = current_time
-                    data['image_status'] = 'locked'
-
-                    with open(json_filepath, 'w', encoding='utf-8') as file:
-                        json.dump(data, file, ensure_ascii=False, indent=4)
-
-                    image_name = data["image_name"]
-                    image_path = os.path.join(args.original_image_folder, image_name)
-                    all_label = data.get("overall_annotation", "")
-
-                    return {
-                        "image": image_path,
-                        "json_path": json_filepath,
-                        "overall_annotation": all_label
-                    }
+            # Lock the image, this fails if another session took it first
+            data, locked = store.try_lock(record_key, checksum)
         except Exception as e:
-            print(f"Failed to read {json_filename}: {e}")
+            print(f"Failed to lock {record_key}: {e}")
+            failed_keys.append(record_key)
             continue
 
-    return {"image": None}
+        # the index may be stale, the storage is the source of truth
+        if not locked:
+            EVENTS.inc(event="lock_conflict")
+            image_index.update(record_key, data)
+            continue
+
+        print(f"Selected image: {record_key}")
+        EVENTS.inc(event="image_assigned")
+        lock_deadlines.push(record_key, data['lock_time'])
+
+        image_name = data["image_name"]
+        if display_cache is not None:
+            image_path = display_cache.get(image_name)
+        else:
+            image_path = os.path.join(args.original_image_folder, image_name)
+        if display_cache is not None or tile_pyramid is not None:
+            prefetch_executor.submit(prefetch_next_image, checksum, record_key)
+        all_label = data.get("overall_annotation", "")
+
+        return {
+            "image": image_path,
+            "record_key": record_key,
+            "overall_annotation": all_label
+        }
+
+# Prepare the display image the annotator will most likely get next, reserve_next prefers it
+def prefetch_next_image(checksum, current_key):
+    candidate = image_index.peek_next(checksum, exclude=current_key)
+    if candidate is None:
+        return
+    next_images[checksum] = candidate
+    try:
+        image_name = store.image_name(candidate)
+        if display_cache is not None:
+            display_cache.get(image_name)
+        if tile_pyramid is not None:
+            tile_pyramid.get(image_name)
+    except Exception as e:
+        print(f"Failed to prefetch {candidate}: {e}")
+
+
+# Deep-zoom viewer of the assigned image
+def zoom_view(record_key):
+    if not record_key or not store.exists(record_key):
+        return ""
+    dzi_path = tile_pyramid.get(store.image_name(record_key))
+    if dzi_path is None:
+        return "### The zoom view of this image is not available."
+    return viewer_html(dzi_path, height=800, openseadragon_url=args.openseadragon_url)
+
+
+# Queue a Whisper job on the worker pool or the in-process model
+def submit_transcription(audio_path):
+    if asr_pool is not None:
+        return asr_pool.submit(audio_path)
+    if not model_ready.is_set():
+        raise gr.Error("Speech recognition is still loading, please try again in a moment.")
+    if args.vad:
+        return speech_executor.submit(transcribe_with_vad, model, audio_path)
+    return speech_executor.submit(lambda: model.transcribe(audio_path)["text"])
+
 
 # Speech recognition
-def transcribe_audio(audio_path, json_path_textbox):
+async def transcribe_audio(audio_path, record_key):
     if not audio_path:
         return ""
     
-    # Save audio file
-    filename_without_ext = os.path.splitext(os.path.basename(json_path_textbox))[0]
-    current_audio_save = os.path.join(args.audio_save_dir, filename_without_ext)
-    os.makedirs(current_audio_save, exist_ok=True)
+    # Save audio file, a recording that was already transcribed is not sent to Whisper again.
+    # Hashing and copying the file runs off the event loop like the other blocking steps
+    with time_stage("audio_archive"):
+        digest = await asyncio.to_thread(audio_archive.store, audio_path, record_key)
+        text = await asyncio.to_thread(audio_archive.get_transcript, digest, transcript_tag)
+
+    if text is None:
+        # Run Whisper off the event loop, so one long recording does not block other users
+        try:
+            with time_stage("asr"):
+                text = await asyncio.wrap_future(submit_transcription(audio_path))
+        except TimeoutError:
+            raise gr.Error("Speech recognition timed out, please try again.")
+        await asyncio.to_thread(audio_archive.put_transcript, digest, transcript_tag, text)
+    else:
+        EVENTS.inc(event="transcript_cache_hit")
+
+    # Normalize text
+    with time_stage("normalize"):
+        processed_text = await asyncio.to_thread(process, text)
+    print("Speech recognition result:", processed_text)
+    return processed_text
+
+
+# Streaming speech recognition: transcribe chunks while the annotator is speaking
+def stream_audio_chunk(chunk, transcript):
+    if chunk is None:
+        return transcript, gr.update()
+    if transcript is None:
+        transcript = StreamingTranscript(submit_transcription, chunk_seconds=args.stream_chunk_seconds)
+    sample_rate, samples = chunk
+    transcript.add_chunk(sample_rate, samples)
+    return transcript, transcript.partial_text()
+
+
+# Write a streamed recording to a WAV file and archive it, blocking, run it with asyncio.to_thread
+def archive_recording(transcript, record_key):
+    fd, recording_path = tempfile.mkstemp(prefix="cotalk_recording_", suffix=".wav")
+    os.close(fd)
+    try:
+        if transcript.save(recording_path):
+            audio_archive.store(recording_path, record_key)
+    finally:
+        os.remove(recording_path)
 
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    save_path = os.path.join(current_audio_save, f"audio_{timestamp}.wav")
-    shutil.copy2(audio_path, save_path)
 
-    result = model.transcribe(save_path)
-    text = result["text"]
+# Streaming speech recognition: transcribe the remaining audio and normalize the whole text
+async def finish_audio_stream(transcript, record_key):
+    if transcript is None:
+        return None, gr.update()
+
+    try:
+        # only the tail of the recording is left, this is the wait the annotator sees
+        with time_stage("asr_stream_tail"):
+            texts = [await asyncio.wrap_future(future) for future in transcript.finish()]
+    except TimeoutError:
+        raise gr.Error("Speech recognition timed out, please try again.")
+
+    # Save audio file
+    if record_key:
+        await asyncio.to_thread(archive_recording, transcript, record_key)
+
+    text = " ".join(t.strip() for t in texts if t.strip())
+    if not text:
+        return None, ""
 
     # Normalize text
-    processed_text = process(text)
+    with time_stage("normalize"):
+        processed_text = await asyncio.to_thread(process, text)
     print("Speech recognition result:", processed_text)
-    return processed_text
+    return None, processed_text
 
 
-# Submit annotation
-def submit_annotation(new_annotation_input, original_image, json_path_textbox, history_label, input_help, checksum):
-    if not new_annotation_input or not json_path_textbox:
-        return [original_image, json_path_textbox, history_label, input_help, checksum, None, ""]
+# Only the annotator holding the lock may write to a record: a session whose lock expired must not
+# add its supplement to an image that has been locked by someone else in the meantime
+def holds_lock(data, checksum):
+    return (data.get("image_status") == "locked"
+            and data.get("annotation_completed") != 'Yes'
+            and data.get("lock_owner") == str(checksum))
 
-    with open(json_path_textbox, 'r', encoding='utf-8') as file:
-        data = json.load(file)
 
-    # Add historical annotation
-    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+# Serve a new image after a submission was rejected because the annotator no longer held the lock
+def rejected_view(record_key, checksum):
+    print(f"Rejected submission of {checksum} for {record_key}, the lock is no longer held")
+    EVENTS.inc(event="submission_rejected")
+    view = update_view(None, checksum)
+    view[3] = gr.update(value="### Your lock on the previous image expired and the image was given to another annotator, so your annotation was not saved. Please annotate this image instead.")
+    return view
+
+
+# Add a supplement to the annotation history
+def add_annotation(data, annotation, checksum, current_time):
     original_label = {
         "id": len(data['annotation_history']) + 1,
         "annotation_info": {
             "annotator_id": checksum,
-            "annotation": new_annotation_input,
+            "annotation": annotation,
             "start_time": data['lock_time'],
             "end_time": current_time
         }
     }
     data['annotation_history'].append(original_label)
 
-    # Update overall annotation
+
+# Apply the judged/merged supplement to the overall annotation
+def apply_merge(data, annotation, completed_by_judge, processed_label, current_time):
     if not data.get("overall_annotation_history"):
-        data['overall_annotation'] = new_annotation_input
+        data['overall_annotation'] = annotation
         history_all_label = {
             "id": 1,
-            "description": new_annotation_input,
+            "description": annotation,
             "start_time": data['lock_time'],
             "end_time": current_time
         }
         data['overall_annotation_history'] = [history_all_label]
-    else:
-        # first check whether the annoation is over
-        if judged_all_annotations(new_annotation_input):
-            data['annotation_completed'] = 'Yes'
-        else:
-            processed_label = process_history_annotation(data['overall_annotation'], new_annotation_input)
-            data['overall_annotation'] = processed_label
-            history_all_label = {
-                "id": len(data['overall_annotation_history']) + 1,
-                "description": processed_label,
-                "start_time": data['lock_time'],
-                "end_time": current_time
-            }
-            data['overall_annotation_history'].append(history_all_label)
+    elif completed_by_judge:
+        data['annotation_completed'] = 'Yes'
+    elif processed_label is not None:
+        data['overall_annotation'] = processed_label
+        history_all_label = {
+            "id": len(data['overall_annotation_history']) + 1,
+            "description": processed_label,
+            "start_time": data['lock_time'],
+            "end_time": current_time
+        }
+        data['overall_annotation_history'].append(history_all_label)
 
     # Mark annotation as completed
     if args.person_num > 0 and len(data['annotation_history']) >= args.person_num:
         data['annotation_completed'] = 'Yes'
 
-    # Write back to file
-    with open(json_path_textbox, 'w', encoding='utf-8') as file:
-        json.dump(data, file, ensure_ascii=False, indent=4)
 
-    return update_view(json_path_textbox, checksum)
+# Judge and merge a supplement saved by an asynchronous submission, then make the image available again
+def merge_submission(record_key):
+    data = store.load(record_key)
+    if data.get("image_status") != "merging":
+        return
+    supplement = data['annotation_history'][-1]['annotation_info']
+    completed_by_judge = False
+    processed_label = None
+    with time_stage("background_merge"):
+        for kind, value in judge_and_merge(data['overall_annotation'], supplement['annotation']):
+            if kind == "complete":
+                completed_by_judge = True
+            elif kind == "merged":
+                processed_label = value
+
+    finish_background_merge(record_key, supplement, completed_by_judge, processed_label)
+
+
+# Apply the outcome of a background merge and make the image available again
+def finish_background_merge(record_key, supplement, completed_by_judge, processed_label, merge_failed=False):
+    def apply_background_merge(data):
+        if data.get("image_status") != "merging":
+            return False
+        if merge_failed:
+            # the supplement stays in the history, flagged so it can be merged by hand
+            data['annotation_history'][-1]['annotation_info']['merge_failed'] = True
+        apply_merge(data, supplement['annotation'], completed_by_judge, processed_label, supplement['end_time'])
+        if data['annotation_completed'] == 'Yes':
+            # completed images stay locked by their last annotator
+            data['image_status'] = 'locked'
+        else:
+            data['image_status'] = 'unlocked'
+            data['lock_time'] = ""
+            data['lock_owner'] = ""
+        return True
+
+    data, merged = store.update(record_key, apply_background_merge)
+    if merged:
+        image_index.update(record_key, data)
+        if data['annotation_completed'] == 'Yes':
+            EVENTS.inc(event="image_completed")
+        print(f"Background merge {'abandoned' if merge_failed else 'done'}: {record_key}")
+
+
+# Called by merge_queue when a merge keeps failing: the caption is left unchanged and the image
+# returns to the pool instead of staying 'merging', where it is never expired or assigned
+def abandon_merge(record_key, error):
+    EVENTS.inc(event="merge_abandoned")
+    data = store.load(record_key)
+    if data.get("image_status") == "merging":
+        finish_background_merge(record_key, data['annotation_history'][-1]['annotation_info'], False, None, merge_failed=True)
+
+
+merge_queue = MergeQueue(merge_submission, workers=args.merge_workers, on_give_up=abandon_merge)
+
+
+# Per-annotator throughput of a submitted annotation
+def observe_submission(data):
+    info = data['annotation_history'][-1]['annotation_info']
+    annotator = str(info['annotator_id'])
+    position = len(data['annotation_history']) - 1
+    EVENTS.inc(event="submission")
+    ANNOTATOR_SUBMISSIONS.inc(annotator=annotator)
+    ANNOTATOR_UNITS.inc(text_length(info['annotation']), annotator=annotator, position=position)
+    seconds = annotation_seconds(info)
+    if seconds is not None:
+        ANNOTATOR_SECONDS.inc(seconds, annotator=annotator, position=position)
+    if data.get('annotation_completed') == 'Yes':
+        EVENTS.inc(event="image_completed")
+
+
+# Submit annotation
+def submit_annotation(new_annotation_input, original_image, record_key, history_label, input_help, checksum):
+    if not new_annotation_input or not record_key:
+        yield [original_image, record_key, history_label, input_help, checksum, None, ""]
+        return
+
+    start = time.perf_counter()
+
+    data = store.load(record_key)
+    if not holds_lock(data, checksum):
+        yield rejected_view(record_key, checksum)
+        return
+
+    if args.async_submit and data.get("overall_annotation_history"):
+        # Save the supplement right away and serve the next image, the image stays unavailable until merge_queue has merged it
+        def save_supplement(data):
+            # a stale session must not turn another annotator's locked image into 'merging'
+            if not holds_lock(data, checksum):
+                return False
+            add_annotation(data, new_annotation_input, checksum, datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+            data['image_status'] = 'merging'
+            return True
+
+        data, saved = store.update(record_key, save_supplement)
+        if not saved:
+            yield rejected_view(record_key, checksum)
+            return
+        image_index.update(record_key, data)
+        assignment_policy.learn(data, latest_only=True)
+        observe_submission(data)
+        merge_queue.put(record_key)
+        view = update_view(record_key, checksum)
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage="submit")
+        yield view
+        return
+
+    # Ask the LLM before locking the record, the result is applied to the latest record content below
+    completed_by_judge = False
+    processed_label = None
+    if data.get("overall_annotation_history"):
+        # first check whether the annoation is over, otherwise merge the supplement
+        judge_start = time.perf_counter()
+        for kind, value in judge_and_merge(data['overall_annotation'], new_annotation_input):
+            if kind == "complete":
+                completed_by_judge = True
+            elif kind == "merged":
+                processed_label = value
+            else:
+                # show the merged caption in the history box while it is being generated
+                yield [
+                    gr.update(),
+                    gr.update(),
+                    value,
+                    gr.update(value="### Merging your annotation into the caption..."),
+                    gr.update(),
+                    gr.update(),
+                    gr.update()
+                ]
+        STAGE_SECONDS.observe(time.perf_counter() - judge_start, stage="judge_merge")
+
+    def apply_submission(data):
+        # the lock may have expired while the LLM was working
+        if not holds_lock(data, checksum):
+            return False
+        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        # Add historical annotation
+        add_annotation(data, new_annotation_input, checksum, current_time)
+        # Update overall annotation
+        apply_merge(data, new_annotation_input, completed_by_judge, processed_label, current_time)
+        return True
+
+    # Write back to storage
+    data, saved = store.update(record_key, apply_submission)
+    if not saved:
+        yield rejected_view(record_key, checksum)
+        return
+    image_index.update(record_key, data, lock_owner=checksum)
+    assignment_policy.learn(data, latest_only=True)
+    observe_submission(data)
+
+    view = update_view(record_key, checksum)
+    STAGE_SECONDS.observe(time.perf_counter() - start, stage="submit")
+    yield view
 
 
 # Update view
-def update_view(json_path_textbox, checksum):
+def update_view(record_key, checksum):
 
-    if json_path_textbox and os.path.exists(json_path_textbox):
-        with open(json_path_textbox, 'r', encoding='utf-8') as file:
-            data = json.load(file)
-        if data.get('annotation_completed') == 'No':
-            data['image_status'] = 'unlocked'
-            data['lock_time'] = ""
-            with open(json_path_textbox, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=4)
+    if record_key and store.exists(record_key):
+        data, released = store.release(record_key, checksum)
+        if released:
+            image_index.update(record_key, data)
 
     result = find_unlocked_image(checksum)
     if not result.get("overall_annotation"):
         return [
             result['image'],
-            gr.update(value=result.get('json_path', ''), visible=False),
+            gr.update(value=result.get('record_key', ''), visible=False),
             "Please describe the image as thoroughly as possible",
             gr.update(value="### Please follow the sample format and describe the image in detail."),
             gr.update(value=checksum),
@@ -250,7 +773,7 @@ def update_view(json_path_textbox, checksum):
     else:
         return [
             result['image'],
-            gr.update(value=result.get('json_path', ''), visible=False),
+            gr.update(value=result.get('record_key', ''), visible=False),
             result["overall_annotation"],
             gr.update(value="### Please refer to the sample and point out what is missing or incorrect in the previous annotations. If you believe the annotation is already complete, simply enter 'none'."),
             gr.update(value=checksum),
@@ -272,21 +795,16 @@ def first_interface():
                 gr.Markdown("### Help image")
                 help_image = gr.Image(value="gradio_image//begin.jpg", label="Help image")
                 start_button = gr.Button("Start Annotation", variant="primary")
-    return first_ui, start_button
+                status_md = gr.Markdown(readiness_markdown())
+    return first_ui, start_button, status_md
 
 
-# Second interface
-def second_interface():
-    result = find_unlocked_image("10086")
-    img_path = result['image'] if result['image'] else "gradio_image//begin.jpg"
-    json_path = result.get('json_path', '')
-
-    initial_text = result.get("overall_annotation", "")
-    if not initial_text:
-        initial_text = "Please describe the image as thoroughly as possible"
-        help_md = "### Please follow the sample format and describe the image in detail."
-    else:
-        help_md = "### Please refer to the sample and point out what is missing or incorrect in the previous annotations. If you believe the annotation is already complete, simply enter 'none'."
+# Second interface, the image is assigned when the session clicks start_button
+def second_interface(start_button):
+    img_path = "gradio_image//begin.jpg"
+    record_key_value = ""
+    initial_text = "Please describe the image as thoroughly as possible"
+    help_md = "### Please follow the sample format and describe the image in detail."
 
     with gr.Blocks(css=".large-font-textbox textarea { font-size: 20px !important; }") as second_ui:
         gr.Markdown("## Image Annotation Platform")
@@ -294,15 +812,20 @@ def second_interface():
         with gr.Row():
             with gr.Column():
                 gr.Markdown("### Image to be annotated")
-                original_image = gr.Image(value=img_path, label="Image", height=800, width=800)
-                json_path_textbox = gr.Textbox(value=json_path, label="JSON path", visible=False)
+                original_image = gr.Image(value=img_path, label="Image", height=800, width=800, visible=not args.zoom_viewer)
+                zoom_html = gr.HTML(visible=args.zoom_viewer)
+                record_key = gr.Textbox(value=record_key_value, label="Record key", visible=False)
 
             with gr.Column():
                 input_help = gr.Markdown(help_md)
                 gr.Markdown("### Historical annotation")
                 history_label = gr.Textbox(value=initial_text, label="Latest annotation", lines=8, interactive=False)
-                audio_input = gr.Microphone(type='filepath', label="Record voice")
-                transcribe_btn = gr.Button("Transcribe Speech")
+                if args.stream_asr:
+                    audio_input = gr.Audio(sources=["microphone"], type="numpy", streaming=True, label="Record voice")
+                else:
+                    audio_input = gr.Microphone(type='filepath', label="Record voice")
+                transcribe_btn = gr.Button("Transcribe Speech", visible=not args.stream_asr)
+                speech_state = gr.State(None)
                 new_annotation_input = gr.Textbox(label="New annotation text", lines=6)
                 audio_save_path = gr.Textbox(label="Audio save path", visible=False)
                 checksum = gr.Textbox(label="Verification code", value="1", visible=True)
@@ -311,24 +834,63 @@ def second_interface():
                     submit_btn = gr.Button("Submit Annotation", variant="primary")
                     refresh_btn = gr.Button("Refresh Image")
 
+        # The worker pool queues jobs itself, an in-process model handles one recording at a time
         transcribe_btn.click(
             fn=transcribe_audio,
-            inputs=[audio_input, json_path_textbox],
-            outputs=new_annotation_input
+            inputs=[audio_input, record_key],
+            outputs=new_annotation_input,
+            concurrency_limit=None if asr_pool is not None else 1
         )
 
+        if args.stream_asr:
+            # every chunk must be processed, in order and before the recording is finished: the
+            # recording events share one queue slot, the chunk handler only buffers audio and queues Whisper jobs
+            audio_input.start_recording(
+                fn=lambda: None,
+                outputs=speech_state,
+                concurrency_limit=1,
+                concurrency_id="speech_stream",
+                show_progress="hidden"
+            )
+            audio_input.stream(
+                fn=stream_audio_chunk,
+                inputs=[audio_input, speech_state],
+                outputs=[speech_state, new_annotation_input],
+                trigger_mode="multiple",
+                concurrency_limit=1,
+                concurrency_id="speech_stream",
+                show_progress="hidden"
+            )
+            audio_input.stop_recording(
+                fn=finish_audio_stream,
+                inputs=[speech_state, record_key],
+                outputs=[speech_state, new_annotation_input],
+                concurrency_limit=1,
+                concurrency_id="speech_stream"
+            )
+
         submit_btn.click(
             fn=submit_annotation,
-            inputs=[new_annotation_input, original_image, json_path_textbox, history_label, input_help, checksum],
-            outputs=[original_image, json_path_textbox, history_label, input_help, checksum, audio_input, new_annotation_input]
+            inputs=[new_annotation_input, original_image, record_key, history_label, input_help, checksum],
+            outputs=[original_image, record_key, history_label, input_help, checksum, audio_input, new_annotation_input]
         )
 
         refresh_btn.click(
             fn=update_view,
-            inputs=[json_path_textbox, checksum],
-            outputs=[original_image, json_path_textbox, history_label, input_help, checksum]
+            inputs=[record_key, checksum],
+            outputs=[original_image, record_key, history_label, input_help, checksum]
         )
 
+        start_button.click(
+            fn=update_view,
+            inputs=[record_key, checksum],
+            outputs=[original_image, record_key, history_label, input_help, checksum, audio_input, new_annotation_input]
+        )
+
+        if args.zoom_viewer:
+            # every way of assigning an image ends in a new record key
+            record_key.change(fn=zoom_view, inputs=record_key, outputs=zoom_html)
+
     return second_ui
 
 
@@ -355,9 +917,9 @@ with gr.Blocks() as demo:
 
     with gr.Tab("Annotation Platform"):
         with gr.Column(visible=True) as col1:
-            first_ui, start_button = first_interface()
+            first_ui, start_button, status_md = first_interface()
         with gr.Column(visible=False) as col2:
-            second_ui = second_interface()
+            second_ui = second_interface(start_button)
 
         start_button.click(
             fn=lambda: [gr.update(visible=False), gr.update(visible=True)],
@@ -365,15 +927,25 @@ with gr.Blocks() as demo:
             outputs=[col1, col2]
         )
 
+    # Report background warm-up progress
+    demo.load(fn=readiness_markdown, inputs=None, outputs=status_md, every=2)
+
 
 # Launch application
 if __name__ == "__main__":
+    start_warm_up()
+
+    if args.metrics_port:
+        start_metrics_server(args.metrics_port, host=args.server_name)
+
     unlocker_thread = threading.Thread(
         target=start_unlocker_job,
         kwargs={
             'interval_seconds': args.interval_seconds,
             'timeout_minutes': args.timeout_minutes,
-            'folder_path': args.json_folder_path
+            'store': store,
+            'on_unlock': image_index.update,
+            'deadlines': lock_deadlines
         },
         daemon=True 
     )
@@ -383,4 +955,5 @@ if __name__ == "__main__":
         share=args.share,
         server_name=args.server_name,
         server_port=args.server_port,
+        allowed_paths=[args.tile_cache_folder] if args.zoom_viewer else None,
     )
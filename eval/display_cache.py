@@ -0,0 +1,91 @@
+import os
+import tempfile
+import threading
+
+from PIL import Image
+
+
+# Largest source image Pillow decodes without a DecompressionBombWarning (it refuses twice this size).
+# Aerial scenes exceed Pillow's default of about 89 MP, so the limit is raised here, for the whole
+# process and for every module using the source images (tile_pyramid imports it from here); it stays
+# bounded because the same Pillow also decodes the images uploaded through the Gradio UI.
+MAX_SOURCE_PIXELS = 30000 * 30000
+Image.MAX_IMAGE_PIXELS = MAX_SOURCE_PIXELS
+
+
+class DisplayCache:
+    """
+    Display-sized JPEG derivatives of the source images.
+
+    The annotation view shows images at `max_size` pixels, so serving the full-resolution source
+    makes the browser download (and Gradio copy) far more than is displayed. Derivatives are
+    written to `cache_folder/<max_size>/<image stem>.jpg` and rebuilt when the source is newer.
+    """
+
+    def __init__(self, source_folder, cache_folder, max_size=800, quality=85):
+        self.source_folder = source_folder
+        self.folder = os.path.join(cache_folder, str(max_size))
+        self.max_size = max_size
+        self.quality = quality
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        os.makedirs(self.folder, exist_ok=True)
+
+    def source_path(self, image_name):
+        return os.path.join(self.source_folder, image_name)
+
+    def derivative_path(self, image_name):
+        return os.path.join(self.folder, os.path.splitext(image_name)[0] + ".jpg")
+
+    def is_current(self, image_name):
+        path = self.derivative_path(image_name)
+        try:
+            return os.path.getmtime(path) >= os.path.getmtime(self.source_path(image_name))
+        except OSError:
+            return False
+
+    def _lock_for(self, image_name):
+        with self._locks_lock:
+            return self._locks.setdefault(image_name, threading.Lock())
+
+    def get(self, image_name):
+        """
+        Return the path of the display-sized image, building it if needed.
+
+        Parameters:
+            image_name (str): File name of the image in the source folder
+
+        Returns:
+            str: Path of the derivative, or of the source image if it could not be built
+        """
+        if self.is_current(image_name):
+            return self.derivative_path(image_name)
+        # one build per image, concurrent requests (e.g. a prefetch and the annotator) wait for it
+        with self._lock_for(image_name):
+            if self.is_current(image_name):
+                return self.derivative_path(image_name)
+            try:
+                self.build(image_name)
+            except Exception as e:
+                print(f"Failed to build the display image of {image_name}: {e}")
+                return self.source_path(image_name)
+        return self.derivative_path(image_name)
+
+    def build(self, image_name):
+        """Downscale an image to fit in max_size x max_size and save it as a progressive JPEG."""
+        target = self.derivative_path(image_name)
+        with Image.open(self.source_path(image_name)) as image:
+            # JPEG sources are decoded at a reduced scale directly
+            image.draft("RGB", (self.max_size, self.max_size))
+            image = image.convert("RGB")
+            image.thumbnail((self.max_size, self.max_size), Image.LANCZOS)
+            fd, tmp_path = tempfile.mkstemp(dir=self.folder, prefix=".", suffix=".tmp")
+            os.close(fd)
+            try:
+                image.save(tmp_path, "JPEG", quality=self.quality, optimize=True, progressive=True)
+                os.chmod(tmp_path, 0o644)
+                os.replace(tmp_path, target)
+            except BaseException:
+                os.remove(tmp_path)
+                raise
+        return target
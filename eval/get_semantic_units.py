@@ -1,12 +1,23 @@
 import re
 import json
 import os
+import hashlib
 import pandas as pd
 from tqdm import tqdm
 import argparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
+import llm.llm as llm_client
 from llm.llm import llm
+from llm.batch import BatchRunner
 from prompt.PROMPT_TEMPLATE import Prompt_Caption_Refinement, Prompt_Semantic_Unit_Parsing
+from storage import open_store, add_storage_args, output_layout, record_folder
+from json_lock import atomic_write_json
+
+# Changing either prompt invalidates every entry of the checkpoint manifest
+PROMPT_VERSION = hashlib.sha256(
+    (Prompt_Caption_Refinement + Prompt_Semantic_Unit_Parsing).encode('utf-8')
+).hexdigest()[:12]
 
 
 def parse_args():
@@ -17,6 +28,16 @@ def parse_args():
         argparse.Namespace: Parsed arguments with attributes:
             - annotation_json_folder (str): Input folder path containing JSON files.
             - save_folder (str): Output folder path to save results.
+            - storage (str): Annotation storage backend ('json' or 'sqlite').
+            - sqlite_path (str): SQLite database path for the 'sqlite' backend.
+            - workers (int): Number of files processed concurrently.
+            - max_inflight (int): Maximum number of submitted but unfinished files.
+            - force (bool): Reprocess every file, ignoring the checkpoint manifest.
+            - llm_cache (bool): Enable the on-disk LLM completion cache for this run.
+            - backend (str): 'interactive' chat requests or 'batch' jobs.
+            - batch_base_url (str): API base URL for the batch jobs (default: the configured api_base).
+            - batch_poll_seconds (float): Seconds between status checks of a batch job.
+            - batch_folder (str): Folder of the batch input files and job ids.
     """
 
     parser = argparse.ArgumentParser(
@@ -24,6 +45,15 @@ def parse_args():
     )
     parser.add_argument("--annotation_json_folder", type=str, default="output/annotation_json", help="Path to input folder containing JSON annotation files.")
     parser.add_argument("--save_folder", type=str, default="output/semantic_units_json", help="Path to save processed JSON files.")
+    add_storage_args(parser)
+    parser.add_argument("--workers", type=int, default=1, help="Number of files processed concurrently (LLM calls are network bound).")
+    parser.add_argument("--max_inflight", type=int, default=0, help="Maximum number of files queued or running at once (default: 2 x workers).")
+    parser.add_argument("--force", action="store_true", help="Reprocess every file, even if its output is already up to date.")
+    parser.add_argument("--llm_cache", action="store_true", help="Cache LLM completions on disk (see the 'cache' section of config/llm/openai.json).")
+    parser.add_argument("--backend", type=str, default="interactive", choices=["interactive", "batch"], help="Send interactive chat requests, or submit all prompts as batch jobs (cheaper, results within the completion window).")
+    parser.add_argument("--batch_base_url", type=str, default=None, help="API base URL for the batch jobs, e.g. http://127.0.0.1:8765/v1 for llm.fake_batch_server (default: api_base of the config).")
+    parser.add_argument("--batch_poll_seconds", type=float, default=30, help="Seconds between status checks of a batch job.")
+    parser.add_argument("--batch_folder", type=str, default=None, help="Folder of the batch input files and job ids (default: <save_folder>.batch).")
     return parser.parse_args()
 
 def load_json(file_path):
@@ -39,11 +69,59 @@ def save_json(data, file_path):
     """Safely save dictionary to JSON file."""
     try:
         os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        atomic_write_json(file_path, data, indent=2)
     except Exception as e:
         raise RuntimeError(f"Failed to save JSON: {file_path}, error: {e}")
 
+
+# -----------------------------
+# Checkpoint manifest
+# -----------------------------
+
+def manifest_path(save_folder):
+    """The manifest lives next to the output folder, e.g. output/semantic_units_json.manifest.jsonl"""
+    return os.path.normpath(save_folder) + ".manifest.jsonl"
+
+
+def caption_hash(caption):
+    """Content hash of a caption together with the prompt version used to process it."""
+    return hashlib.sha256(f"{PROMPT_VERSION}\n{caption}".encode('utf-8')).hexdigest()
+
+
+def load_manifest(path):
+    """
+    Load the checkpoint manifest, an append-only JSONL file of {"file", "hash"} entries.
+    Later entries win, and a line left incomplete by a crash is ignored.
+    """
+    entries = {}
+    if not os.path.exists(path):
+        return entries
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            try:
+                item = json.loads(line)
+                entries[item["file"]] = item["hash"]
+            except (json.JSONDecodeError, KeyError, TypeError):
+                continue
+    return entries
+
+
+def append_manifest(path, filename, digest):
+    """Record that the output of `filename` is up to date for the caption hash `digest`."""
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(json.dumps({"file": filename, "hash": digest}, ensure_ascii=False) + "\n")
+        f.flush()
+
+
+def compact_manifest(path, entries):
+    """Rewrite the manifest with one line per file."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for filename in sorted(entries):
+            f.write(json.dumps({"file": filename, "hash": entries[filename]}, ensure_ascii=False) + "\n")
+    os.replace(tmp_path, path)
+
+
 def extract_json_content(llm_output) :
     """
     Extract JSON content from LLM output that may contain markdown-style code blocks.
@@ -63,7 +141,7 @@ def refine_caption(caption):
     Use LLM to refine caption: fix typos, remove redundancy, ensure clarity.
     """
     prompt = Prompt_Caption_Refinement.format(caption=caption)
-    response = llm(prompt)
+    response = llm(prompt, tag="refinement")
     parsed = extract_json_content(response)
     return parsed.get("caption", caption)  # fallback to original if missing
 
@@ -72,13 +150,16 @@ def parse_semantic_units(refined_caption):
     Parse refined caption into structured semantic units.
     """
     prompt = Prompt_Semantic_Unit_Parsing.format(caption=refined_caption)
-    response = llm(prompt)
+    response = llm(prompt, tag="semantic_units")
     return extract_json_content(response)
 
 
 def process_caption(caption):
     """
     Full pipeline: refine + parse.
+
+    Returns None if an LLM call or the parsing of its output failed, so that a caption without
+    semantic units ([]) can be told apart from a failure.
     """
     if not caption or not caption.strip():
         return []
@@ -88,65 +169,271 @@ def process_caption(caption):
         return units
     except Exception as e:
         print(f"[Error] Caption processing failed: {e}")
-        return []
+        return None
         
+def process_record(store, key, save_path, done_hash=None):
+    """
+    Extract semantic units for one annotation record and save the result.
+
+    Args:
+        store: Annotation storage backend.
+        key (str): Record key.
+        save_path (str): Output JSON file path.
+        done_hash (str): Caption hash recorded in the manifest for this file, if any.
+
+    Returns:
+        tuple: (status, caption hash), status is 'done', 'current' (output already up to date),
+            'skipped' (empty caption) or 'failed' (the LLM calls failed, the file stays pending).
+    """
+    data = store.load(key)
+    caption = data.get("overall_annotation", "").strip()
+
+    if not caption:
+        print(f"Skipped: {os.path.basename(save_path)} - missing or empty 'overall_annotation'")
+        return "skipped", None
+
+    digest = caption_hash(caption)
+    if digest == done_hash and os.path.exists(save_path):
+        return "current", digest
+
+    semantic_units = process_caption(caption)
+    if semantic_units is None:
+        # keep the file pending for the next run, an empty result is checkpointed like any other
+        return "failed", digest
+    data["semantic_units"] = semantic_units
+    save_json(data, save_path)
+    return "done", digest
+
+
 def batch_process_annotations(
     annotation_json_folder,
-    save_folder
+    save_folder,
+    storage="json",
+    sqlite_path="output/annotation.db",
+    workers=1,
+    max_inflight=0,
+    force=False
 ):
     """
-    Process all JSON files in the input folder, extract semantic units, and save results.
+    Process all annotation records, extract semantic units, and save results as one JSON file per record.
 
     Args:
-        annotation_json_folder (str): Path to folder containing input JSON files.
+        annotation_json_folder (str): Path to folder containing input JSON files (JSON storage).
         save_folder (str): Path to folder for saving output JSON files.
+        storage (str): Annotation storage backend ('json' or 'sqlite').
+        sqlite_path (str): SQLite database path for the 'sqlite' backend.
+        workers (int): Number of files processed concurrently.
+        max_inflight (int): Maximum number of files queued or running at once (default: 2 x workers).
+        force (bool): Reprocess every file, ignoring the checkpoint manifest.
+
+    Files whose caption and prompts have not changed since they were last processed are skipped,
+    using the manifest written next to save_folder. An interrupted run resumes from there.
     """
-    if not os.path.exists(annotation_json_folder):
+    if storage == "json" and not os.path.exists(annotation_json_folder):
         raise FileNotFoundError(f"Input folder not found: {annotation_json_folder}")
 
-    os.makedirs(save_folder, exist_ok=True)
+    store = open_store(storage, json_folder_path=annotation_json_folder, sqlite_path=sqlite_path)
+    # outputs of a sharded annotation folder are sharded the same way
+    layout = output_layout(save_folder, like=getattr(store, "layout", None))
 
-    json_files = [f for f in os.listdir(annotation_json_folder) if f.endswith("json")]
+    keys = sorted(store.keys())
+    json_files = [key + ".json" for key in keys]
     
     if not json_files:
-        print(f"No (json) files found in {annotation_json_folder}")
+        print(f"No annotation records found in {storage} storage")
         return
 
+    workers = max(1, workers)
+    max_inflight = max_inflight if max_inflight > 0 else 2 * workers
     failed_files = []
+    manifest_file = manifest_path(save_folder)
+    manifest = {} if force else load_manifest(manifest_file)
+    up_to_date = 0
 
-    for filename in tqdm(json_files, desc="Processing files"):
-        file_path = os.path.join(annotation_json_folder, filename)
-        save_path = os.path.join(save_folder, filename)
+    # Every file is written to its own output path, so the results do not depend on completion order
+    with ThreadPoolExecutor(max_workers=workers) as executor, \
+            tqdm(total=len(json_files), desc="Processing files") as progress:
+        pending = {}
+        tasks = iter(zip(keys, json_files))
 
-        try:
-            data = load_json(file_path)
-            caption = data.get("overall_annotation", "").strip()
+        while True:
+            # keep at most max_inflight files submitted at once
+            for key, filename in tasks:
+                save_path = os.path.join(record_folder(save_folder, key, layout), filename)
+                pending[executor.submit(process_record, store, key, save_path, manifest.get(filename))] = filename
+                if len(pending) >= max_inflight:
+                    break
+            if not pending:
+                break
 
-            if not caption:
-                print(f"Skipped: {filename} - missing or empty 'overall_annotation'")
-            else:
-                semantic_units = process_caption(caption)
-                data["semantic_units"] = semantic_units
-                save_json(data, save_path)
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                filename = pending.pop(future)
+                try:
+                    status, digest = future.result()
+                    if status == "done":
+                        manifest[filename] = digest
+                        append_manifest(manifest_file, filename, digest)
+                    elif status == "current":
+                        up_to_date += 1
+                    elif status == "failed":
+                        failed_files.append(filename)
+                except Exception as e:
+                    print(f"Failed to process {filename}: {e}")
+                    failed_files.append(filename)
+                progress.update(1)
 
-        except Exception as e:
-            print(f"Failed to process {filename}: {e}")
-            failed_files.append(filename)
+    failed_files.sort()
+    compact_manifest(manifest_file, manifest)
 
     # Final report
     print(f"\n✅ Processing complete.")
     print(f"Total files: {len(json_files)}")
     print(f"Success: {len(json_files) - len(failed_files)}")
+    print(f"Already up to date: {up_to_date}")
     if failed_files:
         print(f"Failed: {len(failed_files)} → {failed_files}")
-            
+    if llm_client.cache is not None:
+        print(f"LLM cache: {llm_client.cache.stats()}")
+
+
+def batch_job_process_annotations(
+    annotation_json_folder,
+    save_folder,
+    storage="json",
+    sqlite_path="output/annotation.db",
+    force=False,
+    batch_base_url=None,
+    poll_seconds=30,
+    batch_folder=None
+):
+    """
+    Extract semantic units with batch jobs instead of interactive requests.
+
+    All refinement prompts are submitted as one round of batch jobs, and the parsing prompts of
+    the refined captions as a second round. Arguments are as in batch_process_annotations, plus:
+
+    Args:
+        batch_base_url (str): API base URL for the batch jobs (default: the configured api_base).
+        poll_seconds (float): Seconds between status checks of a batch job.
+        batch_folder (str): Folder of the batch input files and job ids (default: <save_folder>.batch).
+
+    Submitted jobs are remembered in batch_folder, so an interrupted run waits for the same jobs
+    instead of submitting them again. The checkpoint manifest is shared with the interactive backend.
+    """
+    if storage == "json" and not os.path.exists(annotation_json_folder):
+        raise FileNotFoundError(f"Input folder not found: {annotation_json_folder}")
+
+    store = open_store(storage, json_folder_path=annotation_json_folder, sqlite_path=sqlite_path)
+    layout = output_layout(save_folder, like=getattr(store, "layout", None))
+
+    keys = sorted(store.keys())
+    if not keys:
+        print(f"No annotation records found in {storage} storage")
+        return
+
+    client = llm_client.client
+    if batch_base_url:
+        client = llm_client.OpenAI(base_url=batch_base_url, api_key=llm_client.config['api_key'], http_client=llm_client.http_client)
+    runner = BatchRunner(
+        client,
+        llm_client.config['model_name'],
+        temperature=llm_client.config.get('temperature', 0.6),
+        work_folder=batch_folder or os.path.normpath(save_folder) + ".batch",
+        poll_seconds=poll_seconds,
+    )
+
+    manifest_file = manifest_path(save_folder)
+    manifest = {} if force else load_manifest(manifest_file)
+    failed_files = []
+    skipped = 0
+    up_to_date = 0
+
+    # record key -> (record, caption, caption hash) of the records that need processing
+    pending = {}
+    for key in tqdm(keys, desc="Collecting captions"):
+        filename = key + ".json"
+        data = store.load(key)
+        caption = data.get("overall_annotation", "").strip()
+        if not caption:
+            print(f"Skipped: {filename} - missing or empty 'overall_annotation'")
+            skipped += 1
+            continue
+        digest = caption_hash(caption)
+        if digest == manifest.get(filename) and os.path.exists(os.path.join(record_folder(save_folder, key, layout), filename)):
+            up_to_date += 1
+            continue
+        pending[key] = (data, caption, digest)
+
+    # Round 1: refinement
+    refined = {}
+    if pending:
+        responses = runner.run({key: Prompt_Caption_Refinement.format(caption=caption) for key, (_, caption, _) in pending.items()}, name="refine")
+        for key, response in responses.items():
+            try:
+                if response is None:
+                    raise RuntimeError("batch request failed")
+                refined[key] = extract_json_content(response).get("caption", pending[key][1])
+            except Exception as e:
+                print(f"Failed to refine {key}.json: {e}")
+                failed_files.append(key + ".json")
+
+    # Round 2: semantic unit parsing of the refined captions
+    if refined:
+        responses = runner.run({key: Prompt_Semantic_Unit_Parsing.format(caption=caption) for key, caption in refined.items()}, name="parse")
+        for key, response in responses.items():
+            filename = key + ".json"
+            data, _, digest = pending[key]
+            try:
+                if response is None:
+                    raise RuntimeError("batch request failed")
+                data["semantic_units"] = extract_json_content(response)
+                save_json(data, os.path.join(record_folder(save_folder, key, layout), filename))
+                manifest[filename] = digest
+                append_manifest(manifest_file, filename, digest)
+            except Exception as e:
+                print(f"Failed to process {filename}: {e}")
+                failed_files.append(filename)
+
+    failed_files.sort()
+    compact_manifest(manifest_file, manifest)
+
+    # Final report
+    print("\n✅ Processing complete.")
+    print(f"Total files: {len(keys)}")
+    print(f"Success: {len(keys) - len(failed_files) - skipped}")
+    print(f"Already up to date: {up_to_date}")
+    if skipped:
+        print(f"Skipped (empty caption): {skipped}")
+    if failed_files:
+        print(f"Failed: {len(failed_files)} → {failed_files}")
+
 
 if __name__ == "__main__":
     args = parse_args()
-    batch_process_annotations(
-        annotation_json_folder=args.annotation_json_folder,
-        save_folder=args.save_folder,
-    )
+    if args.llm_cache:
+        llm_client.configure_cache()
+    if args.backend == "batch":
+        batch_job_process_annotations(
+            annotation_json_folder=args.annotation_json_folder,
+            save_folder=args.save_folder,
+            storage=args.storage,
+            sqlite_path=args.sqlite_path,
+            force=args.force,
+            batch_base_url=args.batch_base_url,
+            poll_seconds=args.batch_poll_seconds,
+            batch_folder=args.batch_folder,
+        )
+    else:
+        batch_process_annotations(
+            annotation_json_folder=args.annotation_json_folder,
+            save_folder=args.save_folder,
+            storage=args.storage,
+            sqlite_path=args.sqlite_path,
+            workers=args.workers,
+            max_inflight=args.max_inflight,
+            force=args.force,
+        )
     
 
     
@@ -0,0 +1,189 @@
+import random
+import threading
+
+from assignment import RandomPolicy, chain_position
+
+
+def annotator_ids(data):
+    """
+    Collect the ids of everyone who has already annotated an image.
+
+    Parameters:
+        data (dict): Annotation record
+
+    Returns:
+        set: Annotator ids (as strings) found in 'annotation_history'
+    """
+    # records returned by the lock operations of the split storage carry a summary instead of the history
+    if 'annotation_history' not in data and 'history_summary' in data:
+        return set(data['history_summary']['annotator_ids'])
+    ids = set()
+    for item in data.get('annotation_history', []):
+        info = item.get('annotation_info', {})
+        if 'annotator_id' in info:
+            ids.add(str(info['annotator_id']))
+    return ids
+
+
+class ImageIndex:
+    """
+    In-memory index of the annotation state of every image.
+
+    The index is built once from the storage backend at startup and then kept in sync by the
+    handlers that write the records, so picking the next image for an annotator no longer
+    needs to list and parse every record. The storage stays the source of truth: callers
+    re-check the chosen record and call `update` if it disagrees with the index.
+
+    Available images are bucketed by chain position (number of annotations so far), and the
+    assignment `policy` (see assignment.py) decides which position an annotator gets next.
+    """
+
+    def __init__(self, policy=None):
+        self.policy = policy or RandomPolicy()
+        self._lock = threading.RLock()
+        self._entries = {}      # record key -> {"status", "completed", "lock_owner", "annotators", "position"}
+        self._available = {}    # chain position -> record keys that are unlocked and not completed
+        self._slots = {}        # record key -> (chain position, index in self._available[chain position])
+
+    def build(self, records):
+        """
+        Rebuild the index from all annotation records.
+
+        Parameters:
+            records (iterable): (key, data) pairs, e.g. from store.iter_records()
+        """
+        with self._lock:
+            self._entries.clear()
+            self._available.clear()
+            self._slots.clear()
+
+            for key, data in records:
+                self.update(key, data)
+
+            print(f"Indexed {len(self._entries)} images, {len(self._slots)} available")
+
+    def update(self, key, data, lock_owner=None):
+        """
+        Refresh the entry of one image from its record data.
+
+        Parameters:
+            key (str): Record key
+            data (dict): Current record data
+            lock_owner (str): Annotator holding the lock, if known
+        """
+        with self._lock:
+            entry = {
+                "status": data.get("image_status"),
+                "completed": data.get("annotation_completed") == 'Yes',
+                "lock_owner": (lock_owner or data.get("lock_owner") or None) if data.get("image_status") == "locked" else None,
+                "annotators": annotator_ids(data),
+                "position": chain_position(data),
+            }
+            # the chain position may have changed, re-add the image to the right bucket
+            self._remove_available(key)
+            self._entries[key] = entry
+            if entry["status"] == "unlocked" and not entry["completed"]:
+                self._add_available(key)
+
+    def mark_locked(self, key, lock_owner):
+        """Record that an image has been locked by an annotator."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry["status"] = "locked"
+            entry["lock_owner"] = lock_owner
+            self._remove_available(key)
+
+    def mark_unlocked(self, key):
+        """Record that an image has been unlocked."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry["status"] = "unlocked"
+            entry["lock_owner"] = None
+            if not entry["completed"]:
+                self._add_available(key)
+
+    def reserve_next(self, annotator_id, prefer=None):
+        """
+        Pick an available image the annotator has not annotated yet and mark it as locked.
+
+        Chain positions are tried in the order given by the policy. Within a position the scan
+        starts at a random image, so the cost is bounded by the number of available images this
+        annotator has already worked on.
+
+        Parameters:
+            annotator_id (str): Id of the annotator asking for work
+            prefer (str): Optional key to take if it is still eligible, e.g. a prefetched image
+
+        Returns:
+            str: Key of the reserved record, or None if nothing is eligible
+        """
+        annotator_id = str(annotator_id)
+        with self._lock:
+            if prefer is not None and prefer in self._slots and annotator_id not in self._entries[prefer]["annotators"]:
+                self.mark_locked(prefer, annotator_id)
+                return prefer
+            key = self._pick(annotator_id)
+            if key is not None:
+                self.mark_locked(key, annotator_id)
+            return key
+
+    def peek_next(self, annotator_id, exclude=None):
+        """
+        Pick the image `reserve_next` could give the annotator next, without locking it.
+
+        Returns:
+            str: Key of an eligible record, or None
+        """
+        with self._lock:
+            return self._pick(str(annotator_id), exclude)
+
+    def available_by_position(self):
+        """Number of available images at each chain position."""
+        with self._lock:
+            return {position: len(keys) for position, keys in self._available.items() if keys}
+
+    def _pick(self, annotator_id, exclude=None):
+        sizes = {position: len(keys) for position, keys in self._available.items() if keys}
+        for position in self.policy.order(annotator_id, sizes):
+            keys = self._available[position]
+            total = len(keys)
+            start = random.randrange(total)
+            for offset in range(total):
+                key = keys[(start + offset) % total]
+                if key != exclude and annotator_id not in self._entries[key]["annotators"]:
+                    return key
+        return None
+
+    def get(self, key):
+        """Return a copy of the indexed state of an image, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            return dict(entry, annotators=set(entry["annotators"]))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _add_available(self, key):
+        if key in self._slots:
+            return
+        keys = self._available.setdefault(self._entries[key]["position"], [])
+        self._slots[key] = (self._entries[key]["position"], len(keys))
+        keys.append(key)
+
+    def _remove_available(self, key):
+        slot = self._slots.pop(key, None)
+        if slot is None:
+            return
+        position, index = slot
+        keys = self._available[position]
+        last = keys.pop()
+        if index < len(keys):
+            keys[index] = last
+            self._slots[last] = (position, index)
@@ -1,55 +1,82 @@
 import os
-import json
 import argparse
+from itertools import islice
+from concurrent.futures import ThreadPoolExecutor
 
-def main(image_folder, json_folder):
-    if not os.path.exists(json_folder):
-        os.makedirs(json_folder)
-
-    # Load the image names from the directory specified in arguments
-    image_names = os.listdir(image_folder)
-
-    # Define JSON template for image annotation metadata
-    json_template = {
-        "image_name": "",  # Placeholder for the name of the image file.
-        "image_status": "unlocked",  # Status indicating if the image is locked for annotation.
-        "annotation_completed": "No",  # Indicates if annotation for this image is completed.
-        "lock_time": "",  # Time when the image was locked for annotation.
-        "overall_annotation": "",  # Overall annotation for the image.
-        "overall_annotation_history": [],  # History of overall annotations.
-        "annotation_history": []  # Annotation history for the image.
-    }
-
-    # Iterate over each image name and create corresponding JSON file
-    for image_name in image_names:
-        # Skip files that are not images (if necessary)
-        if not image_name.lower().endswith(('.png', '.jpg', '.jpeg', '.tiff', '.bmp', '.gif')):
-            continue
-
-        # Create JSON file name based on image file name
-        json_file_name = os.path.splitext(image_name)[0] + ".json"
-        json_file_path = os.path.join(json_folder, json_file_name)
-
-        # Update the "image_name" field in the JSON template
-        json_template["image_name"] = image_name
-
-        # Skip creation of JSON file if it already exists
-        if os.path.exists(json_file_path):
-            continue
-
-        # Write the template to a JSON file
-        with open(json_file_path, 'w', encoding='utf-8') as json_file:
-            json.dump(json_template, json_file, ensure_ascii=False, indent=4)
-        
-        print(f"Created: {json_file_name}")
-
-    print("All JSON files have been initialized.")
+from tqdm import tqdm
+
+from storage import IMAGE_EXTENSIONS, open_store, add_storage_args, add_layout_args, record_key
+
+
+def iter_image_names(image_folder):
+    """Stream the image file names of a folder with os.scandir, without listing it at once."""
+    with os.scandir(image_folder) as entries:
+        for entry in entries:
+            if entry.name.lower().endswith(IMAGE_EXTENSIONS) and entry.is_file():
+                yield entry.name
+
+
+def create_records(store, image_names, workers=4, chunk_size=10000):
+    """
+    Create the records of the images that do not have one yet, `workers` at a time.
+
+    The keys already in the store are read once up front, so a rerun only writes the new images.
+
+    Returns:
+        tuple: (number of created records, number of records that already existed)
+    """
+    existing = set(store.iter_keys())
+    created = skipped = 0
+    names = iter(image_names)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor, tqdm(desc="Annotation records", unit=" images") as progress:
+        while True:
+            chunk = list(islice(names, chunk_size))
+            if not chunk:
+                break
+            new = [name for name in chunk if record_key(name) not in existing]
+            skipped += len(chunk) - len(new)
+            progress.update(len(chunk) - len(new))
+            for was_created in executor.map(store.create, new):
+                created += was_created
+                skipped += not was_created
+                progress.update(1)
+    return created, skipped
+
+
+def build_display_images(image_folder, image_names, display_cache_folder, display_size=800, workers=4):
+    """Pre-render the display-sized copies of the images used by the annotation view."""
+    from display_cache import DisplayCache
+
+    cache = DisplayCache(image_folder, display_cache_folder, max_size=display_size)
+    missing = [name for name in image_names if not cache.is_current(name)]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(tqdm(executor.map(cache.get, missing), total=len(missing), desc="Display images"))
+    print(f"Display images ready in {cache.folder} ({len(image_names) - len(missing)} already up to date).")
+
+
+def main(image_folder, json_folder, storage="json", sqlite_path="output/annotation.db",
+         display_cache_folder=None, display_size=800, workers=4, layout=None, shard_chars=2):
+    # Open the storage backend, the JSON backend creates one file per image in json_folder (or its shard folders)
+    store = open_store(storage, json_folder_path=json_folder, sqlite_path=sqlite_path, layout=layout, shard_chars=shard_chars)
+
+    # Create the records of the images found in the image folder, existing records are kept
+    created, skipped = create_records(store, iter_image_names(image_folder), workers)
+    print(f"All annotation records have been initialized: {created} created, {skipped} already existed.")
+
+    if display_cache_folder:
+        build_display_images(image_folder, list(iter_image_names(image_folder)), display_cache_folder, display_size, workers)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Generate JSON files for images in a specified folder.")
     parser.add_argument('--image_folder', type=str, default= "data/image", help='The folder containing images.')
     parser.add_argument('--save_json_folder', type=str, default= "output/annotation_json", help='The folder to save JSON files.')
+    parser.add_argument('--display_cache_folder', type=str, default=None, help='If set, also pre-render the display-sized images used by cotalk into this folder.')
+    parser.add_argument('--display_size', type=int, default=800, help='Longest side in pixels of the display-sized images.')
+    parser.add_argument('--workers', type=int, default=4, help='Number of records created and images resized at once.')
+    add_storage_args(parser)
+    add_layout_args(parser)
 
     args = parser.parse_args()
     
-    main(args.image_folder, args.save_json_folder)
\ No newline at end of file
+    main(args.image_folder, args.save_json_folder, args.storage, args.sqlite_path,
+         args.display_cache_folder, args.display_size, args.workers, args.layout, args.shard_chars)
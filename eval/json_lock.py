@@ -0,0 +1,179 @@
+import os
+import json
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows, fall back to in-process locking only
+    fcntl = None
+
+from image_index import annotator_ids
+
+
+LOCK_DIR_NAME = ".locks"
+
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+
+
+def _thread_lock(path):
+    with _thread_locks_guard:
+        lock = _thread_locks.get(path)
+        if lock is None:
+            lock = _thread_locks[path] = threading.Lock()
+        return lock
+
+
+@contextmanager
+def file_lock(file_path):
+    """
+    Hold an exclusive lock on a JSON file across threads and processes.
+
+    The lock is taken on a sidecar file in a hidden '.locks' folder next to the JSON file,
+    because the JSON file itself is replaced on every write.
+
+    Parameters:
+        file_path (str): Path to the JSON file to lock
+    """
+    file_path = os.path.abspath(file_path)
+    folder, name = os.path.split(file_path)
+    lock_folder = os.path.join(folder, LOCK_DIR_NAME)
+    os.makedirs(lock_folder, exist_ok=True)
+
+    with _thread_lock(file_path):
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(lock_folder, name + ".lock"), 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+def read_json(file_path):
+    """Read a JSON file. Writers replace files atomically, so a reader never sees a partial file."""
+    with open(file_path, 'r', encoding='utf-8') as file:
+        return json.load(file)
+
+
+def atomic_write_json(file_path, data, indent=4):
+    """
+    Write data to a temporary file in the same folder and rename it over the target.
+
+    Parameters:
+        file_path (str): Path of the JSON file to write
+        data (dict): Data to be saved
+        indent (int): JSON indentation
+    """
+    folder = os.path.dirname(os.path.abspath(file_path))
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix=".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as file:
+            json.dump(data, file, ensure_ascii=False, indent=indent)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def update_json(file_path, update_fn):
+    """
+    Atomically read, modify and write back a JSON file.
+
+    Parameters:
+        file_path (str): Path to the JSON file
+        update_fn (callable): Called with the loaded data, modifies it in place and returns
+            True if the file should be written back
+
+    Returns:
+        tuple: The (possibly updated) data and a boolean indicating whether it was written
+    """
+    with file_lock(file_path):
+        data = read_json(file_path)
+        changed = bool(update_fn(data))
+        if changed:
+            atomic_write_json(file_path, data)
+        return data, changed
+
+
+def acquire_lock(data, owner):
+    """
+    Lock a record in place if it is unlocked, not completed and not yet annotated by `owner`.
+
+    Parameters:
+        data (dict): Annotation record (or the state part of a split record)
+        owner (str): Id of the annotator taking the lock
+
+    Returns:
+        bool: True if the lock was taken
+    """
+    owner = str(owner)
+    if data.get("image_status") != "unlocked" or data.get("annotation_completed") != 'No':
+        return False
+    if owner in annotator_ids(data):
+        return False
+    data['lock_time'] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    data['lock_owner'] = owner
+    data['image_status'] = 'locked'
+    return True
+
+
+def release_owned_lock(data, owner=None):
+    """
+    Unlock a record in place if it is locked and not completed, and held by `owner` if given.
+
+    Parameters:
+        data (dict): Annotation record (or the state part of a split record)
+        owner (str): Id of the annotator releasing the lock
+
+    Returns:
+        bool: True if the lock was released
+    """
+    if data.get("annotation_completed") != 'No' or data.get("image_status") != 'locked':
+        return False
+    lock_owner = data.get('lock_owner')
+    if owner is not None and lock_owner and lock_owner != str(owner):
+        return False
+    data['image_status'] = 'unlocked'
+    data['lock_time'] = ""
+    data['lock_owner'] = ""
+    return True
+
+
+def try_lock(file_path, owner):
+    """
+    Compare-and-swap lock acquisition: lock the image only if it is unlocked, not completed
+    and not yet annotated by `owner`.
+
+    Parameters:
+        file_path (str): Path to the JSON file
+        owner (str): Id of the annotator taking the lock
+
+    Returns:
+        tuple: The current data and a boolean indicating whether the lock was acquired
+    """
+    return update_json(file_path, lambda data: acquire_lock(data, owner))
+
+
+def release_lock(file_path, owner=None):
+    """
+    Unlock an image that is not completed. If `owner` is given, the lock is only released when
+    it is still held by that annotator, so a session never frees a lock that expired and was
+    taken by someone else in the meantime.
+
+    Parameters:
+        file_path (str): Path to the JSON file
+        owner (str): Id of the annotator releasing the lock
+
+    Returns:
+        tuple: The current data and a boolean indicating whether the lock was released
+    """
+    return update_json(file_path, lambda data: release_owned_lock(data, owner))
@@ -0,0 +1,152 @@
+import os
+import json
+import time
+import hashlib
+
+
+TERMINAL_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+def request_line(custom_id, prompt, model_name, temperature):
+    """One request of a batch input file, in the OpenAI batch JSONL format."""
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": "/v1/chat/completions",
+        "body": {
+            "model": model_name,
+            "messages": [{"role": "user", "content": prompt}],
+            "temperature": temperature,
+        },
+    }
+
+
+def parse_output_line(line):
+    """
+    Parse one line of a batch output or error file.
+
+    Returns:
+        tuple: (custom_id, completion text or None, error message or None)
+    """
+    item = json.loads(line)
+    response = item.get("response") or {}
+    if item.get("error") or response.get("status_code", 200) != 200:
+        return item.get("custom_id"), None, json.dumps(item.get("error") or response.get("body"), ensure_ascii=False)
+    try:
+        return item.get("custom_id"), response["body"]["choices"][0]["message"]["content"], None
+    except (KeyError, IndexError, TypeError):
+        return item.get("custom_id"), None, f"Unexpected response: {line.strip()[:200]}"
+
+
+class BatchRunner:
+    """
+    Run many prompts through the OpenAI Batch API instead of interactive requests.
+
+    The prompts are written to JSONL input files (at most `max_requests` lines each), uploaded and
+    submitted as batch jobs, which are polled until they finish. The id of every submitted job is
+    kept in `work_folder`, keyed by the content of its input file, so an interrupted run picks the
+    same jobs up again instead of paying for them twice.
+    """
+
+    def __init__(self, client, model_name, temperature=0.6, work_folder="output/llm_batches",
+                 poll_seconds=30, completion_window="24h", max_requests=50000):
+        self.client = client
+        self.model_name = model_name
+        self.temperature = temperature
+        self.work_folder = work_folder
+        self.poll_seconds = poll_seconds
+        self.completion_window = completion_window
+        self.max_requests = max_requests
+        os.makedirs(work_folder, exist_ok=True)
+
+    def run(self, prompts, name="batch"):
+        """
+        Complete a set of prompts with batch jobs.
+
+        Parameters:
+            prompts (dict): custom id -> prompt text, the ids must be unique
+            name (str): Name of the round, used for the files in work_folder
+
+        Returns:
+            dict: custom id -> completion text, or None for the requests that failed
+        """
+        ids = sorted(prompts)
+        results = {custom_id: None for custom_id in ids}
+        for part, start in enumerate(range(0, len(ids), self.max_requests)):
+            chunk = {custom_id: prompts[custom_id] for custom_id in ids[start:start + self.max_requests]}
+            results.update(self._run_chunk(chunk, f"{name}-{part:03d}"))
+        return results
+
+    def _run_chunk(self, prompts, name):
+        lines = [
+            json.dumps(request_line(custom_id, prompt, self.model_name, self.temperature), ensure_ascii=False)
+            for custom_id, prompt in prompts.items()
+        ]
+        content = ("\n".join(lines) + "\n").encode("utf-8")
+        digest = hashlib.sha256(content).hexdigest()[:16]
+        input_path = os.path.join(self.work_folder, f"{name}.input.jsonl")
+        state_path = os.path.join(self.work_folder, f"{name}.batch.json")
+
+        state = {}
+        if os.path.exists(state_path):
+            with open(state_path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        if state.get("input_hash") != digest or state.get("status") in {"failed", "expired", "cancelled"}:
+            with open(input_path, 'wb') as f:
+                f.write(content)
+            with open(input_path, 'rb') as f:
+                input_file = self.client.files.create(file=f, purpose="batch")
+            batch = self.client.batches.create(
+                input_file_id=input_file.id,
+                endpoint="/v1/chat/completions",
+                completion_window=self.completion_window,
+            )
+            state = {"input_hash": digest, "batch_id": batch.id, "status": batch.status}
+            self._save_state(state_path, state)
+            print(f"Submitted batch {batch.id} with {len(prompts)} requests ({name})")
+        else:
+            print(f"Resuming batch {state['batch_id']} ({name})")
+
+        batch = self._wait(state["batch_id"], name)
+        state["status"] = batch.status
+        self._save_state(state_path, state)
+
+        results = {}
+        errors = []
+        for file_id in (getattr(batch, "output_file_id", None), getattr(batch, "error_file_id", None)):
+            if not file_id:
+                continue
+            for line in self.client.files.content(file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                custom_id, text, error = parse_output_line(line)
+                if custom_id in prompts:
+                    results[custom_id] = text
+                    if error:
+                        errors.append(f"{custom_id}: {error}")
+        if errors:
+            print(f"{len(errors)} requests of batch {batch.id} failed, e.g. {errors[0]}")
+        if batch.status != "completed":
+            print(f"Batch {batch.id} ended with status '{batch.status}', {len(results) - len(errors)} of {len(prompts)} requests answered")
+        return results
+
+    def _wait(self, batch_id, name):
+        last_report = None
+        while True:
+            batch = self.client.batches.retrieve(batch_id)
+            counts = getattr(batch, "request_counts", None)
+            report = (batch.status, getattr(counts, "completed", None), getattr(counts, "failed", None))
+            if report != last_report:
+                done = f", {counts.completed}/{counts.total} done, {counts.failed} failed" if counts is not None else ""
+                print(f"Batch {batch_id} ({name}): {batch.status}{done}")
+                last_report = report
+            if batch.status in TERMINAL_STATUSES:
+                return batch
+            time.sleep(self.poll_seconds)
+
+    @staticmethod
+    def _save_state(path, state):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_path, path)
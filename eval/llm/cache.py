@@ -0,0 +1,116 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+
+
+class LLMCache:
+    """
+    Persistent content-addressed cache of LLM completions, stored in a SQLite file.
+
+    Entries are keyed on the model name, temperature and prompt text. Entries older than
+    `max_age_days` are ignored and removed, and the least recently used entries are evicted
+    once the cache holds more than `max_entries` entries or `max_size_mb` of completions.
+    """
+
+    def __init__(self, path="output/llm_cache.sqlite", max_entries=200000, max_size_mb=512, max_age_days=30,
+                 evict_every=100):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = int(max_size_mb * 1024 * 1024)
+        self.max_age_seconds = max_age_days * 24 * 3600 if max_age_days else None
+        self.evict_every = evict_every
+
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self._counter_lock = threading.Lock()
+        self._local = threading.local()
+
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._connection().execute(
+            "CREATE TABLE IF NOT EXISTS completions ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+            "created REAL NOT NULL, accessed REAL NOT NULL)"
+        )
+        self._connection().execute("CREATE INDEX IF NOT EXISTS idx_completions_accessed ON completions(accessed)")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def make_key(model, temperature, prompt):
+        return hashlib.sha256(json.dumps([model, temperature, prompt], ensure_ascii=False).encode('utf-8')).hexdigest()
+
+    def get(self, model, temperature, prompt):
+        """Return the cached completion, or None on a miss."""
+        key = self.make_key(model, temperature, prompt)
+        now = time.time()
+        conn = self._connection()
+        row = conn.execute("SELECT value, created FROM completions WHERE key = ?", (key,)).fetchone()
+        if row is not None and self.max_age_seconds and now - row[1] > self.max_age_seconds:
+            conn.execute("DELETE FROM completions WHERE key = ?", (key,))
+            row = None
+
+        with self._counter_lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        conn.execute("UPDATE completions SET accessed = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def put(self, model, temperature, prompt, value):
+        """Store a completion."""
+        key = self.make_key(model, temperature, prompt)
+        now = time.time()
+        self._connection().execute(
+            "INSERT OR REPLACE INTO completions (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+            (key, value, len(value.encode('utf-8')), now, now)
+        )
+        with self._counter_lock:
+            self.stores += 1
+            evict = self.stores % self.evict_every == 0
+        if evict:
+            self.evict()
+
+    def evict(self):
+        """Remove expired entries, then the least recently used ones until the size limits are met."""
+        conn = self._connection()
+        if self.max_age_seconds:
+            conn.execute("DELETE FROM completions WHERE created < ?", (time.time() - self.max_age_seconds,))
+
+        count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions").fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+
+        removed = 0
+        freed = 0
+        doomed = []
+        for key, size in conn.execute("SELECT key, size FROM completions ORDER BY accessed"):
+            if count - removed <= self.max_entries and total - freed <= self.max_bytes:
+                break
+            doomed.append((key,))
+            removed += 1
+            freed += size
+        conn.executemany("DELETE FROM completions WHERE key = ?", doomed)
+
+    def stats(self):
+        """Return hit/miss counters."""
+        with self._counter_lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "stores": self.stores,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
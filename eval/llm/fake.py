@@ -0,0 +1,73 @@
+import re
+import json
+import time
+import types
+
+
+# Replies the fake judge treats as "the caption is complete"
+COMPLETE_WORDS = ("none", "nothing", "complete", "that's all", "no more")
+
+
+def _field(prompt, name):
+    match = re.search(rf"^\s*{name}\s*:\s*(.*)$", prompt, re.MULTILINE)
+    return match.group(1).strip() if match else ""
+
+
+def _json_block(data):
+    return "```json\n" + json.dumps(data, ensure_ascii=False) + "\n```"
+
+
+class FakeLLM:
+    """
+    Deterministic local stand-in for the chat model, used by the benchmarks.
+
+    The prompt templates are recognized by their wording and answered in the format the callers
+    parse: normalization returns the input text, a merge appends caption2 to caption1, and a
+    supplement counts as complete if it contains one of COMPLETE_WORDS. Every call takes
+    `latency` seconds; streamed answers deliver their first chunk after half of it.
+    """
+
+    def __init__(self, latency=0.5):
+        self.latency = latency
+
+    def answer(self, prompt):
+        if "speech normalization tool" in prompt:
+            return _json_block({"caption": _field(prompt, "Input text")})
+        if "First judge whether caption2" in prompt:
+            caption1, caption2 = _field(prompt, "caption1"), _field(prompt, "caption2")
+            if self._is_complete(caption2):
+                return _json_block({"complete": "1", "caption": ""})
+            return _json_block({"complete": "0", "caption": f"{caption1} {caption2}".strip()})
+        if "text integration expert" in prompt:
+            return _json_block({"caption": f"{_field(prompt, 'caption1')} {_field(prompt, 'caption2')}".strip()})
+        if "fully annotated" in prompt:
+            return _json_block({"caption": "0" if self._is_complete(_field(prompt, "caption")) else "1"})
+        if "improve the following caption" in prompt:
+            return _json_block({"caption": prompt.split("Input caption:", 1)[-1].split("\n", 1)[0].strip()})
+        # semantic unit parsing: one unit per sentence of the caption
+        caption = prompt.split("Input text:", 1)[-1].split("\n", 1)[0]
+        units = [
+            {"name": sentence.strip().split(" ")[-1], "attributes": {"other": [sentence.strip()]}}
+            for sentence in caption.split(".") if sentence.strip()
+        ]
+        return _json_block(units)
+
+    @staticmethod
+    def _is_complete(caption):
+        caption = caption.lower()
+        return any(word in caption for word in COMPLETE_WORDS)
+
+    def complete(self, prompt):
+        time.sleep(self.latency)
+        return self.answer(prompt)
+
+    def stream(self, prompt, chunks=8):
+        """Yield the answer in chunks shaped like the OpenAI streaming response."""
+        content = self.answer(prompt)
+        time.sleep(self.latency / 2)
+        size = max(1, -(-len(content) // chunks))
+        for start in range(0, len(content), size):
+            if start:
+                time.sleep(self.latency / 2 / chunks)
+            delta = types.SimpleNamespace(content=content[start:start + size])
+            yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=delta)])
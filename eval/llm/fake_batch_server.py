@@ -0,0 +1,171 @@
+import re
+import json
+import time
+import uuid
+import argparse
+import threading
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from llm.fake import FakeLLM
+
+
+class FakeBatchService:
+    """
+    In-memory stand-in for the OpenAI Files and Batches endpoints, answering with FakeLLM.
+
+    A batch stays 'in_progress' for `delay_seconds` and is then completed. Requests whose
+    custom id contains `fail_marker` get an error response, to exercise the error file path.
+    """
+
+    def __init__(self, delay_seconds=2.0, fail_marker="__fail__"):
+        self.delay_seconds = delay_seconds
+        self.fail_marker = fail_marker
+        self.llm = FakeLLM(latency=0)
+        self.files = {}
+        self.batches = {}
+        self._lock = threading.Lock()
+
+    def add_file(self, filename, content, purpose):
+        file_id = "file-" + uuid.uuid4().hex[:24]
+        with self._lock:
+            self.files[file_id] = {"filename": filename, "content": content, "purpose": purpose, "created_at": int(time.time())}
+        return self.file_object(file_id)
+
+    def file_object(self, file_id):
+        item = self.files[file_id]
+        return {"id": file_id, "object": "file", "bytes": len(item["content"]), "created_at": item["created_at"],
+                "filename": item["filename"], "purpose": item["purpose"], "status": "processed"}
+
+    def create_batch(self, input_file_id, endpoint, completion_window):
+        batch_id = "batch_" + uuid.uuid4().hex[:24]
+        lines = [line for line in self.files[input_file_id]["content"].decode("utf-8").splitlines() if line.strip()]
+        with self._lock:
+            self.batches[batch_id] = {
+                "id": batch_id, "object": "batch", "endpoint": endpoint, "input_file_id": input_file_id,
+                "completion_window": completion_window, "status": "in_progress", "created_at": int(time.time()),
+                "output_file_id": None, "error_file_id": None,
+                "request_counts": {"total": len(lines), "completed": 0, "failed": 0},
+            }
+        return self.get_batch(batch_id)
+
+    def get_batch(self, batch_id):
+        with self._lock:
+            batch = self.batches[batch_id]
+            if batch["status"] == "in_progress" and time.time() - batch["created_at"] >= self.delay_seconds:
+                self._complete(batch)
+            return dict(batch)
+
+    def _complete(self, batch):
+        outputs, errors = [], []
+        for line in self.files[batch["input_file_id"]]["content"].decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            custom_id = request["custom_id"]
+            if self.fail_marker in custom_id:
+                errors.append({"id": "req_" + uuid.uuid4().hex[:12], "custom_id": custom_id, "response": None,
+                               "error": {"code": "fake_error", "message": "Request failed on purpose"}})
+                continue
+            content = self.llm.answer(request["body"]["messages"][0]["content"])
+            body = {"id": "chatcmpl-" + uuid.uuid4().hex[:12], "object": "chat.completion", "model": request["body"]["model"],
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}]}
+            outputs.append({"id": "req_" + uuid.uuid4().hex[:12], "custom_id": custom_id,
+                            "response": {"status_code": 200, "body": body}, "error": None})
+
+        for key, items in (("output_file_id", outputs), ("error_file_id", errors)):
+            if items:
+                content = "".join(json.dumps(item) + "\n" for item in items).encode("utf-8")
+                file_id = "file-" + uuid.uuid4().hex[:24]
+                self.files[file_id] = {"filename": f"{batch['id']}_{key}.jsonl", "content": content,
+                                       "purpose": "batch_output", "created_at": int(time.time())}
+                batch[key] = file_id
+        batch["status"] = "completed"
+        batch["completed_at"] = int(time.time())
+        batch["request_counts"] = {"total": len(outputs) + len(errors), "completed": len(outputs), "failed": len(errors)}
+
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        def _send_json(self, data, status=200):
+            body = json.dumps(data).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _body(self):
+            return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        def do_GET(self):
+            path = self.path.split("?")[0]
+            if path == "/v1/models":
+                return self._send_json({"object": "list", "data": [{"id": "fake", "object": "model", "created": 0, "owned_by": "local"}]})
+            match = re.fullmatch(r"/v1/batches/([\w-]+)", path)
+            if match and match.group(1) in service.batches:
+                return self._send_json(service.get_batch(match.group(1)))
+            match = re.fullmatch(r"/v1/files/([\w-]+)/content", path)
+            if match and match.group(1) in service.files:
+                content = service.files[match.group(1)]["content"]
+                self.send_response(200)
+                self.send_header("Content-Type", "application/octet-stream")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+                return
+            self._send_json({"error": {"message": f"Not found: {path}"}}, status=404)
+
+        def do_POST(self):
+            path = self.path.split("?")[0]
+            if path == "/v1/files":
+                # multipart/form-data with the fields 'purpose' and 'file'
+                message = BytesParser(policy=HTTP).parsebytes(
+                    b"Content-Type: " + self.headers["Content-Type"].encode() + b"\r\n\r\n" + self._body()
+                )
+                fields = {}
+                for part in message.iter_parts():
+                    fields[part.get_param("name", header="content-disposition")] = (part.get_filename(), part.get_payload(decode=True))
+                filename, content = fields["file"]
+                return self._send_json(service.add_file(filename or "upload.jsonl", content, fields["purpose"][1].decode()))
+            if path == "/v1/batches":
+                request = json.loads(self._body())
+                if request.get("input_file_id") not in service.files:
+                    return self._send_json({"error": {"message": "Unknown input file"}}, status=400)
+                return self._send_json(service.create_batch(request["input_file_id"], request["endpoint"], request["completion_window"]))
+            self._send_json({"error": {"message": f"Not found: {path}"}}, status=404)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def start_server(port=0, host="127.0.0.1", delay_seconds=2.0):
+    """
+    Start the fake batch server in a daemon thread.
+
+    Returns:
+        tuple: (server, base URL to use as the OpenAI base_url)
+    """
+    service = FakeBatchService(delay_seconds=delay_seconds)
+    server = ThreadingHTTPServer((host, port), make_handler(service))
+    threading.Thread(target=server.serve_forever, name="fake-batch-server", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local stand-in for the OpenAI batch API, answering with the fake LLM.")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on")
+    parser.add_argument("--delay_seconds", type=float, default=2.0, help="Time a batch stays in progress")
+    args = parser.parse_args()
+
+    server, base_url = start_server(args.port, args.host, args.delay_seconds)
+    print(f"Fake batch API listening on {base_url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -1,26 +1,247 @@
+import os
+import openai
 from openai import OpenAI
+import httpx
 import json
+import time
+
+from llm.cache import LLMCache
+from llm.rate_limit import TokenBucket, call_with_retry
+from llm.fake import FakeLLM
+from metrics import LLM_SECONDS, LLM_REQUESTS
 
 config = json.load(open("config//llm//openai.json"))
 
+# One connection pool shared by every caller in the process (Gradio handlers, batch tools)
+http_client = httpx.Client(
+    limits=httpx.Limits(
+        max_connections=config.get('max_connections', 32),
+        max_keepalive_connections=config.get('max_connections', 32),
+    )
+)
+
+# Retries are handled by call_with_retry below, with jitter and the shared rate limits
 client = OpenAI(
   base_url=config['api_base'],
   api_key=config['api_key'],
+  http_client=http_client,
+  timeout=config.get('timeout', 60),
+  max_retries=0,
 )
 
-def llm(prompt):
+# Deterministic local stand-in for benchmarks, selected with "backend": "fake" in the config or COTALK_LLM_BACKEND=fake
+backend = os.environ.get("COTALK_LLM_BACKEND", config.get('backend', 'openai'))
+fake_llm = FakeLLM(latency=float(os.environ.get("COTALK_FAKE_LLM_LATENCY", config.get('fake_latency_seconds', 0.5)))) if backend == "fake" else None
+
+# Provider quotas, 0 disables the limit
+request_bucket = TokenBucket(config['requests_per_minute']) if config.get('requests_per_minute') else None
+token_bucket = TokenBucket(config['tokens_per_minute']) if config.get('tokens_per_minute') else None
+
+# Optional on-disk cache of completions, enabled with "cache": {"enabled": true} in the config
+cache = None
+
+
+def configure_cache(enabled=True, **kwargs):
+    """
+    Enable or disable the completion cache. Keyword arguments are passed to LLMCache
+    (path, max_entries, max_size_mb, max_age_days) and override the "cache" config section.
+    """
+    global cache
+    if not enabled:
+        cache = None
+        return None
+    options = {k: v for k, v in config.get('cache', {}).items() if k != 'enabled'}
+    options.update(kwargs)
+    cache = LLMCache(**options)
+    return cache
+
+
+if config.get('cache', {}).get('enabled', False):
+    configure_cache()
+
+
+def warm_up():
+    """
+    Open a connection to the API ahead of the first request.
+
+    Returns:
+        bool: True if the API answered
+    """
+    if fake_llm is not None:
+        return True
+    try:
+        client.models.list()
+        return True
+    except Exception as e:
+        print(f"LLM warm-up failed: {e}")
+        return False
+
+
+def estimate_tokens(prompt):
+    """Rough token estimate used to reserve the token budget before a call (about 4 characters per token)."""
+    return len(prompt) // 4 + config.get('expected_completion_tokens', 256)
+
+
+def is_retryable(error):
+    """Rate limits, timeouts, connection errors and 5xx responses are worth retrying."""
+    return isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError))
+
+
+def retry_after(error):
+    """Delay requested by the server in a Retry-After header, if any."""
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+def _chat(prompt, model_name, temperature, timeout):
+    if request_bucket is not None:
+        request_bucket.acquire(1)
+    estimate = estimate_tokens(prompt)
+    if token_bucket is not None:
+        token_bucket.acquire(estimate)
+
+    if fake_llm is not None:
+        return fake_llm.complete(prompt)
+
     completion = client.chat.completions.create(
-        model=config['model_name'],
+        model=model_name,
         messages=[
             {
             "role": "user",
             "content": f"{prompt}"
             }
         ],
-        temperature=config.get('temperature', 0.6),
+        temperature=temperature,
+        timeout=timeout,
     )
+
+    # correct the reservation with the real usage
+    usage = getattr(completion, 'usage', None)
+    if token_bucket is not None and usage is not None and usage.total_tokens:
+        token_bucket.consume(usage.total_tokens - estimate)
     return completion.choices[0].message.content
 
 
+def llm(prompt, use_cache=True, timeout=None, tag="other"):
+    """
+    Send one prompt to the chat model and return the completion text.
+
+    Calls wait for the configured request and token rate limits, and retryable errors are
+    retried with exponential backoff and jitter.
+
+    Parameters:
+        prompt (str): Prompt text
+        use_cache (bool): Set to False to bypass the completion cache and get a fresh sample
+        timeout (float): Per-call timeout in seconds, defaults to the "timeout" config value
+        tag (str): Prompt type the request is counted under in the metrics
+    """
+    model_name = config['model_name']
+    temperature = config.get('temperature', 0.6)
+
+    if cache is not None and use_cache:
+        cached = cache.get(model_name, temperature, prompt)
+        if cached is not None:
+            LLM_REQUESTS.inc(prompt=tag, outcome="cached")
+            return cached
+
+    start = time.perf_counter()
+    try:
+        content = call_with_retry(
+            lambda: _chat(prompt, model_name, temperature, timeout or config.get('timeout', 60)),
+            is_retryable,
+            max_retries=config.get('max_retries', 5),
+            base_delay=config.get('backoff_base_seconds', 1.0),
+            max_delay=config.get('backoff_max_seconds', 30.0),
+            retry_after=retry_after,
+        )
+    except Exception:
+        LLM_REQUESTS.inc(prompt=tag, outcome="error")
+        raise
+    LLM_SECONDS.observe(time.perf_counter() - start, prompt=tag)
+    LLM_REQUESTS.inc(prompt=tag, outcome="ok")
+
+    if cache is not None and use_cache and content is not None:
+        cache.put(model_name, temperature, prompt, content)
+    return content
+
+
+def llm_stream(prompt, use_cache=True, timeout=None, tag="other"):
+    """
+    Stream the completion of one prompt, yielding text deltas as they arrive.
+
+    Rate limits and the cache apply as in `llm`. Retryable errors are only retried until the
+    first token has been received, after that they are raised to the caller.
+
+    Parameters:
+        prompt (str): Prompt text
+        use_cache (bool): Set to False to bypass the completion cache and get a fresh sample
+        timeout (float): Per-call timeout in seconds, defaults to the "timeout" config value
+        tag (str): Prompt type the request is counted under in the metrics
+    """
+    model_name = config['model_name']
+    temperature = config.get('temperature', 0.6)
+
+    if cache is not None and use_cache:
+        cached = cache.get(model_name, temperature, prompt)
+        if cached is not None:
+            LLM_REQUESTS.inc(prompt=tag, outcome="cached")
+            yield cached
+            return
+
+    def open_stream():
+        if request_bucket is not None:
+            request_bucket.acquire(1)
+        if token_bucket is not None:
+            token_bucket.acquire(estimate_tokens(prompt))
+        if fake_llm is not None:
+            return fake_llm.stream(prompt)
+        return client.chat.completions.create(
+            model=model_name,
+            messages=[
+                {
+                "role": "user",
+                "content": f"{prompt}"
+                }
+            ],
+            temperature=temperature,
+            timeout=timeout or config.get('timeout', 60),
+            stream=True,
+        )
+
+    start = time.perf_counter()
+    parts = []
+    try:
+        stream = call_with_retry(
+            open_stream,
+            is_retryable,
+            max_retries=config.get('max_retries', 5),
+            base_delay=config.get('backoff_base_seconds', 1.0),
+            max_delay=config.get('backoff_max_seconds', 30.0),
+            retry_after=retry_after,
+        )
 
+        try:
+            for chunk in stream:
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta.content
+                if delta:
+                    parts.append(delta)
+                    yield delta
+        finally:
+            # a caller that stops reading early (generator closed) also ends the HTTP response
+            if hasattr(stream, "close"):
+                stream.close()
+    except Exception:
+        LLM_REQUESTS.inc(prompt=tag, outcome="error")
+        raise
+    LLM_SECONDS.observe(time.perf_counter() - start, prompt=tag)
+    LLM_REQUESTS.inc(prompt=tag, outcome="ok")
 
+    if cache is not None and use_cache and parts:
+        cache.put(model_name, temperature, prompt, "".join(parts))
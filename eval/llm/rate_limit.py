@@ -0,0 +1,77 @@
+import time
+import random
+import threading
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled continuously at `rate_per_minute`.
+
+    `acquire` blocks until the requested amount is available. `consume` debits an amount after
+    the fact (e.g. the real token usage reported by the API) and may leave the bucket negative,
+    which delays the following requests instead of failing them.
+    """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(capacity if capacity is not None else rate_per_minute)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1.0):
+        # a single request larger than the bucket would wait forever, let it drain the bucket instead
+        amount = min(float(amount), self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(min(wait, 1.0))
+
+    def consume(self, amount):
+        with self._lock:
+            self._refill()
+            self.tokens -= amount
+
+
+def backoff_delay(attempt, base_delay=1.0, max_delay=30.0):
+    """Exponential backoff with full jitter: a random delay in [0, min(max_delay, base_delay * 2^attempt)]."""
+    return random.uniform(0, min(max_delay, base_delay * (2 ** attempt)))
+
+
+def call_with_retry(fn, is_retryable, max_retries=5, base_delay=1.0, max_delay=30.0, retry_after=None):
+    """
+    Call `fn()` and retry it with exponential backoff and jitter when it raises a retryable error.
+
+    Parameters:
+        fn (callable): Function to call
+        is_retryable (callable): Returns True if an exception should be retried
+        max_retries (int): Number of retries after the first attempt
+        base_delay (float): Backoff base in seconds
+        max_delay (float): Upper bound of a single backoff in seconds
+        retry_after (callable): Optional, returns a server-provided delay in seconds for an exception, or None
+
+    Returns:
+        The return value of fn
+    """
+    attempt = 0
+    while True:
+        try:
+            return fn()
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable(e):
+                raise
+            delay = retry_after(e) if retry_after is not None else None
+            if delay is None:
+                delay = backoff_delay(attempt, base_delay, max_delay)
+            print(f"LLM call failed ({type(e).__name__}: {e}), retrying in {delay:.1f}s ({attempt + 1}/{max_retries})")
+            time.sleep(delay)
+            attempt += 1
@@ -0,0 +1,75 @@
+import queue
+import threading
+
+
+class MergeQueue:
+    """
+    Background queue of submitted images waiting for their LLM judge/merge.
+
+    `process(key)` is called from `workers` daemon threads, at most once at a time per key. A key
+    queued again while it is pending is only processed once. When `process` raises, the key is
+    queued again after `retry_seconds`, doubling with every failure up to `max_retry_seconds`, so an
+    unreachable LLM delays the merge instead of losing it. After `max_attempts` failures the key is
+    dropped and `on_give_up(key, error)` is called, e.g. to make the image available again.
+    """
+
+    def __init__(self, process, workers=2, retry_seconds=30, max_attempts=5, max_retry_seconds=600, on_give_up=None):
+        self.process = process
+        self.workers = workers
+        self.retry_seconds = retry_seconds
+        self.max_attempts = max_attempts
+        self.max_retry_seconds = max_retry_seconds
+        self.on_give_up = on_give_up
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._attempts = {}     # key -> failed attempts so far
+        self._lock = threading.Lock()
+
+    def start(self):
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f"merge-worker-{i}", daemon=True).start()
+        return self
+
+    def put(self, key):
+        """Queue an image, unless it is already waiting."""
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+        self._queue.put(key)
+
+    def _worker(self):
+        while True:
+            key = self._queue.get()
+            try:
+                self.process(key)
+            except Exception as e:
+                self._failed(key, e)
+                continue
+            with self._lock:
+                self._pending.discard(key)
+                self._attempts.pop(key, None)
+
+    def _failed(self, key, error):
+        with self._lock:
+            attempts = self._attempts[key] = self._attempts.get(key, 0) + 1
+            if attempts >= self.max_attempts:
+                self._pending.discard(key)
+                del self._attempts[key]
+        if attempts >= self.max_attempts:
+            print(f"Background merge of {key} failed {attempts} times, giving up: {error}")
+            if self.on_give_up is not None:
+                try:
+                    self.on_give_up(key, error)
+                except Exception as e:
+                    print(f"Failed to give up the merge of {key}: {e}")
+            return
+        delay = min(self.retry_seconds * 2 ** (attempts - 1), self.max_retry_seconds)
+        print(f"Background merge of {key} failed (attempt {attempts}/{self.max_attempts}), retrying in {delay}s: {error}")
+        retry = threading.Timer(delay, self._queue.put, args=(key,))
+        retry.daemon = True
+        retry.start()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._pending)
@@ -0,0 +1,193 @@
+import time
+import bisect
+import functools
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    """Monotonic counter with labels, in the Prometheus text format."""
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1.0, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            return self._values.get(key, 0.0)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_labels(self.labelnames, key)} {value:g}"
+
+
+class Histogram:
+    """Histogram with cumulative buckets and labels, in the Prometheus text format."""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}       # label values -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            counts = self._values.setdefault(key, [0] * (len(self.buckets) + 1) + [0.0])
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """Observe the duration of a `with` block, also when it raises."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = {key: list(counts) for key, counts in self._values.items()}
+        for key, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else f"{bound:g}"
+                yield f"{self.name}_bucket{_labels(self.labelnames, key, [('le', le)])} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labelnames, key)} {counts[-1]:g}"
+            yield f"{self.name}_count{_labels(self.labelnames, key)} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+# -----------------------------
+# Metrics of the annotation server
+# -----------------------------
+
+registry = Registry()
+
+STAGE_SECONDS = registry.histogram(
+    "cotalk_stage_seconds", "Duration of a processing stage (asr, normalize, judge_merge, find_image, submit, storage_*)", ["stage"])
+LLM_SECONDS = registry.histogram(
+    "cotalk_llm_request_seconds", "Duration of an LLM request by prompt type, retries included", ["prompt"])
+LLM_REQUESTS = registry.counter(
+    "cotalk_llm_requests_total", "LLM requests by prompt type and outcome (ok, error, cached)", ["prompt", "outcome"])
+EVENTS = registry.counter(
+    "cotalk_events_total", "Server events (image_assigned, lock_conflict, submission, image_completed, ...)", ["event"])
+ANNOTATOR_SUBMISSIONS = registry.counter(
+    "cotalk_annotator_submissions_total", "Annotations submitted per annotator", ["annotator"])
+ANNOTATOR_UNITS = registry.counter(
+    "cotalk_annotator_units_total", "Words (the proxy of semantic units) contributed per annotator and chain position", ["annotator", "position"])
+ANNOTATOR_SECONDS = registry.counter(
+    "cotalk_annotator_seconds_total", "Time spent annotating per annotator and chain position", ["annotator", "position"])
+
+
+def time_stage(stage):
+    """Context manager timing a processing stage."""
+    return STAGE_SECONDS.time(stage=stage)
+
+
+def timed(stage):
+    """Decorator timing every call of a function as a processing stage."""
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with time_stage(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class TimedStore:
+    """Storage backend proxy recording the duration of each storage operation as a 'storage_<method>' stage."""
+
+    TIMED_METHODS = {"load", "image_name", "save", "update", "try_lock", "release", "expire", "create", "exists"}
+
+    def __init__(self, store):
+        self._store = store
+
+    def __getattr__(self, name):
+        attribute = getattr(self._store, name)
+        if name not in self.TIMED_METHODS:
+            return attribute
+
+        def timed_call(*args, **kwargs):
+            with time_stage(f"storage_{name}"):
+                return attribute(*args, **kwargs)
+        return timed_call
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # scrapes would flood the server log
+        pass
+
+
+def start_metrics_server(port, host=""):
+    """Serve the metrics on http://host:port/metrics from a daemon thread."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"Serving metrics on port {port}")
+    return server
@@ -38,6 +38,25 @@ Output:
 
 """
 
+Prompt_Judge_And_Integrate = """ You are a text integration expert. caption1 is the original annotation result, caption2 is the annotator's supplement.
+
+First judge whether caption2 only says the annotation is finished, e.g. 'I think that's all', 'I think it's complete', 'nothing to add'.
+If so, output "complete": "1" and leave the caption empty.
+Otherwise output "complete": "0" and merge caption2 into caption1:
+1. caption2 may correct or add missing details to caption1.
+2. Merge identical semantic parts, avoid duplication.
+3. Insert new content in the appropriate place.
+4. In case of conflict, caption2 prevails.
+
+Input:
+caption1: {caption1}
+caption2: {caption2}
+Strictly follow this output format, with "complete" before "caption":
+```json
+{{"complete": "0", "caption": "There are 5 airplanes parked in the airport..."}}
+```
+"""
+
 Prompt_Caption_Refinement = """Please help me improve the following caption according to the steps below.
         Special attention:
         1. Correct obvious typos.
@@ -0,0 +1,185 @@
+import heapq
+import random
+import argparse
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from storage import open_store, add_storage_args
+from image_index import ImageIndex
+from assignment import POLICIES, make_policy, annotation_seconds
+
+
+SIMULATION_START = datetime(2000, 1, 1)
+
+
+def load_history(store, max_seconds=3600):
+    """
+    Collect the recorded annotations to replay.
+
+    Returns:
+        tuple: (records, samples) where records maps record keys to their data and samples maps
+        (annotator id, chain position) to a list of (seconds, annotation text)
+    """
+    records = {}
+    samples = defaultdict(list)
+    for key, data in store.iter_records():
+        records[key] = data
+        for position, item in enumerate(data.get('annotation_history', [])):
+            info = item.get('annotation_info', {})
+            seconds = annotation_seconds(info)
+            if 'annotator_id' in info and seconds is not None and seconds <= max_seconds:
+                samples[(str(info['annotator_id']), position)].append((seconds, info.get('annotation') or ""))
+    return records, samples
+
+
+class Sampler:
+    """Draws the duration and text of a simulated annotation from the recorded ones."""
+
+    def __init__(self, samples, rng):
+        self.rng = rng
+        self.by_key = samples
+        self.by_annotator = defaultdict(list)
+        self.by_position = defaultdict(list)
+        for (annotator_id, position), items in samples.items():
+            self.by_annotator[annotator_id].extend(items)
+            self.by_position[position].extend(items)
+        self.everything = [item for items in samples.values() for item in items]
+
+    def draw(self, annotator_id, position):
+        # fall back from this annotator at this position to everyone at this position, then to this annotator
+        for items in (self.by_key.get((annotator_id, position)), self.by_position.get(position),
+                      self.by_annotator.get(annotator_id), self.everything):
+            if items:
+                return self.rng.choice(items)
+        raise ValueError("No recorded annotation to replay")
+
+
+def chain_length(data, person_num):
+    """Number of annotations after which a simulated image is complete."""
+    if person_num > 0:
+        return person_num
+    # without a fixed chain length, completed images end where they ended in reality
+    return len(data.get('annotation_history', [])) if data.get('annotation_completed') == 'Yes' else None
+
+
+def simulate(policy_name, records, samples, annotators, person_num=2, hours=8.0, seed=0):
+    """
+    Replay an annotation session from scratch with an assignment policy.
+
+    Every annotator works without breaks. When one is free, the policy picks their next image
+    through the same ImageIndex as the app, and the annotation takes a duration drawn from what
+    this annotator recorded at that chain position.
+
+    Returns:
+        dict: Results of the session
+    """
+    random.seed(seed)
+    sampler = Sampler(samples, random.Random(seed))
+    policy = make_policy(policy_name)
+    # the app learns the throughput of the existing annotations at startup as well
+    for data in records.values():
+        policy.learn(data)
+
+    lengths = {key: chain_length(data, person_num) for key, data in records.items()}
+    images = {
+        key: {"image_status": "unlocked", "annotation_completed": "No", "annotation_history": []}
+        for key, length in lengths.items() if length
+    }
+    index = ImageIndex(policy=policy)
+    index.build(images.items())
+
+    horizon = hours * 3600
+    events = []
+    idle = []
+    busy_seconds = defaultdict(float)
+
+    def assign(annotator_id, now):
+        key = index.reserve_next(annotator_id)
+        if key is None:
+            idle.append(annotator_id)
+            return
+        position = len(images[key]["annotation_history"])
+        seconds, text = sampler.draw(annotator_id, position)
+        heapq.heappush(events, (now + seconds, annotator_id, key, now, text))
+
+    for annotator_id in annotators:
+        assign(annotator_id, 0.0)
+
+    completed = []
+    while events:
+        now, annotator_id, key, started, text = heapq.heappop(events)
+        if now > horizon:
+            busy_seconds[annotator_id] += horizon - started
+            continue
+        busy_seconds[annotator_id] += now - started
+
+        data = images[key]
+        data["annotation_history"].append({
+            "id": len(data["annotation_history"]) + 1,
+            "annotation_info": {
+                "annotator_id": annotator_id,
+                "annotation": text,
+                "start_time": (SIMULATION_START + timedelta(seconds=started)).strftime("%Y-%m-%d %H:%M:%S"),
+                "end_time": (SIMULATION_START + timedelta(seconds=now)).strftime("%Y-%m-%d %H:%M:%S"),
+            }
+        })
+        if len(data["annotation_history"]) >= lengths[key]:
+            data["annotation_completed"] = "Yes"
+            data["image_status"] = "locked"
+            completed.append(now)
+        else:
+            data["image_status"] = "unlocked"
+        index.update(key, data)
+        policy.learn(data, latest_only=True)
+
+        # the image may be eligible for someone who was waiting
+        waiting = idle[:]
+        idle.clear()
+        for waiting_id in waiting:
+            assign(waiting_id, now)
+        assign(annotator_id, now)
+
+    in_progress = sum(1 for data in images.values() if data["annotation_history"] and data["annotation_completed"] == "No")
+    return {
+        "policy": policy_name,
+        "completed": len(completed),
+        "completed_per_hour": len(completed) / hours,
+        "half_finished": in_progress,
+        "utilization": sum(busy_seconds.values()) / (horizon * len(annotators)) if annotators else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay the recorded annotation history to compare image assignment policies.")
+    parser.add_argument("--json_folder_path", type=str, default="output/annotation_json", help="Annotation JSON folder path")
+    add_storage_args(parser)
+    parser.add_argument("--policies", type=str, nargs="+", default=sorted(POLICIES), choices=sorted(POLICIES), help="Policies to compare")
+    parser.add_argument("--person_num", type=int, default=2, help="Annotations per image, <= 0 replays the recorded chain lengths of completed images")
+    parser.add_argument("--hours", type=float, default=8.0, help="Length of the simulated session in hours")
+    parser.add_argument("--annotators", type=str, nargs="*", default=None, help="Annotator ids to simulate (default: everyone in the history)")
+    parser.add_argument("--max_seconds", type=int, default=3600, help="Ignore recorded annotations that took longer than this (abandoned sessions)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed, shared by all policies")
+    args = parser.parse_args()
+
+    store = open_store(args.storage, json_folder_path=args.json_folder_path, sqlite_path=args.sqlite_path)
+    records, samples = load_history(store, args.max_seconds)
+    annotators = args.annotators or sorted({annotator_id for annotator_id, _ in samples})
+    if not samples or not annotators:
+        print("No recorded annotations with valid timestamps to replay.")
+        return
+    print(f"Replaying {sum(len(items) for items in samples.values())} recorded annotations of {len(annotators)} annotators "
+          f"on {len(records)} images for {args.hours:g} hours")
+
+    results = [
+        simulate(policy, records, samples, annotators, args.person_num, args.hours, args.seed)
+        for policy in args.policies
+    ]
+
+    print(f"{'policy':<15}{'completed':>10}{'per hour':>10}{'half-finished':>15}{'utilization':>13}")
+    for result in results:
+        print(f"{result['policy']:<15}{result['completed']:>10}{result['completed_per_hour']:>10.1f}"
+              f"{result['half_finished']:>15}{result['utilization']:>13.0%}")
+
+
+if __name__ == "__main__":
+    main()
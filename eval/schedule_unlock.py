@@ -1,47 +1,36 @@
-import json
-import os
 import time
+import heapq
+import threading
 from datetime import datetime, timedelta
 import schedule
 
 
-def load_json(file_path):
+def is_stale(data, timeout_duration):
     """
-    Safely read a JSON file.
+    Check if an image has been locked for longer than the timeout.
     
     Parameters:
-        file_path (str): Path to the JSON file
+        data (dict): Dictionary containing the lock information
+        timeout_duration (timedelta): Lock timeout
         
     Returns:
-        dict: Parsed JSON data or None if an error occurs
+        bool: True if the lock is stale and the annotation is not completed
     """
-    try:
-        with open(file_path, 'r', encoding='utf-8') as file:
-            return json.load(file)
-    except Exception as e:
-        print(f"Error reading {file_path}: {e}")
-        return None
-
+    lock_time_str = data.get('lock_time', '')
+    annotation_completed = data.get('annotation_completed', '')
 
-def save_json(file_path, data):
-    """
-    Safely write data to a JSON file.
-    
-    Parameters:
-        file_path (str): Path to save the JSON file
-        data (dict): Data to be saved
-        
-    Returns:
-        bool: True if successful, False otherwise
-    """
-    try:
-        with open(file_path, 'w', encoding='utf-8') as file:
-            json.dump(data, file, ensure_ascii=False, indent=4)
-        return True
-    except Exception as e:
-        print(f"Error writing {file_path}: {e}")
+    # images whose submission is still being merged are not held by an annotator
+    if data.get('image_status', 'locked') != 'locked':
         return False
 
+    if lock_time_str and annotation_completed == "No":
+        try:
+            lock_time = datetime.strptime(lock_time_str, '%Y-%m-%d %H:%M:%S')
+            return datetime.now() > lock_time + timeout_duration
+        except ValueError as e:
+            print(f"Invalid date format in {data.get('image_name', 'unknown')}: {lock_time_str}, {e}")
+    return False
+
 
 def unlock_if_needed(data, timeout_duration):
     """
@@ -53,73 +42,149 @@ def unlock_if_needed(data, timeout_duration):
     Returns:
         tuple: A tuple containing updated data and a boolean indicating whether it was unlocked
     """
-    now = datetime.now()
     flag = False
-    
-    lock_time_str = data.get('lock_time', '')
-    annotation_completed = data.get('annotation_completed', '')
 
-    if lock_time_str and annotation_completed == "No":
-        try:
-            lock_time = datetime.strptime(lock_time_str, '%Y-%m-%d %H:%M:%S')
-            if now > lock_time + timeout_duration:
-                print(f"Unlocking {data['image_name']}")
-                data['lock_time'] = ""
-                data['image_status'] = "unlocked"
-                flag = True
-        except ValueError as e:
-            print(f"Invalid date format in {data.get('image_name', 'unknown')}: {lock_time_str}, {e}")
+    if is_stale(data, timeout_duration):
+        print(f"Unlocking {data['image_name']}")
+        data['lock_time'] = ""
+        data['lock_owner'] = ""
+        data['image_status'] = "unlocked"
+        flag = True
 
     return data, flag
 
 
-def unlock_stale_locks(json_folder_path, timeout_duration):
+def unlock_stale_locks(store, timeout_duration, on_unlock=None):
     """
-    Scan through all JSON files in the specified folder and automatically unlock files that have been locked for over 15 minutes.
+    Scan through all annotation records and automatically unlock images that have been locked for longer than the timeout.
     
     Parameters:
-        json_folder_path (str): The path to the folder containing JSON files
+        store: Annotation storage backend (see storage.open_store)
+        timeout_duration (timedelta): Lock timeout
+        on_unlock (callable): Optional callback called as on_unlock(key, data) after an image is unlocked
     """
-    if not os.path.exists(json_folder_path):
-        print(f"Folder does not exist: {json_folder_path}")
+    try:
+        unlocked = store.expire_stale(timeout_duration)
+    except Exception as e:
+        print(f"Failed to unlock stale locks: {e}")
         return
 
-    file_names = [f for f in os.listdir(json_folder_path) if f.endswith('.json')]
-    if not file_names:
-        # print(f"No JSON files found in {json_folder_path}")
-        return
+    for key, data in unlocked:
+        if on_unlock is not None:
+            on_unlock(key, data)
+        print(f"Updated and saved: {key}")
+
+
+class LockDeadlines:
+    """
+    Min-heap of lock deadlines, filled when locks are taken.
+
+    Each tick only pops the deadlines that have passed, so expiry costs O(expired locks) instead
+    of reading every record. Entries are never removed when a lock is released or renewed: the
+    store re-checks the record when the deadline is reached and leaves it alone if it is no
+    longer stale.
+    """
 
-    for json_name in file_names:
-        json_file_path = os.path.join(json_folder_path, json_name)
+    def __init__(self, timeout_duration):
+        self.timeout_duration = timeout_duration
+        self._heap = []
+        self._lock = threading.Lock()
+
+    def push(self, key, lock_time_str):
+        """
+        Register a lock taken at `lock_time_str` ('%Y-%m-%d %H:%M:%S').
+
+        Parameters:
+            key (str): Record key of the locked image
+            lock_time_str (str): Lock time as stored in the record
+        """
+        try:
+            lock_time = datetime.strptime(lock_time_str, '%Y-%m-%d %H:%M:%S')
+        except (TypeError, ValueError):
+            return
+        self.push_deadline(key, lock_time + self.timeout_duration)
+
+    def push_deadline(self, key, deadline):
+        """Register a deadline directly, e.g. to re-check a lock that could not be expired."""
+        with self._lock:
+            heapq.heappush(self._heap, (deadline, key))
+
+    def track(self, records):
+        """
+        Pass (key, data) records through while registering the locks they hold, so the heap can be
+        seeded during the single startup pass over the storage.
+        """
+        for key, data in records:
+            if data.get('image_status') == 'locked' and data.get('annotation_completed') == 'No':
+                self.push(key, data.get('lock_time', ''))
+            yield key, data
+
+    def pop_due(self, now=None):
+        """
+        Remove and return the keys whose deadline has passed.
+
+        Returns:
+            list: Record keys to re-check
+        """
+        now = now or datetime.now()
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] < now:
+                due.append(heapq.heappop(self._heap)[1])
+        return due
+
+    def __len__(self):
+        with self._lock:
+            return len(self._heap)
+
+
+def expire_due_locks(store, deadlines, on_unlock=None, retry_seconds=10):
+    """
+    Unlock the images whose lock deadline has passed.
+    
+    Parameters:
+        store: Annotation storage backend (see storage.open_store)
+        deadlines (LockDeadlines): Heap of lock deadlines
+        on_unlock (callable): Optional callback called as on_unlock(key, data) after an image is unlocked
+        retry_seconds (int): Delay before a lock that failed to expire is checked again
+    """
+    for key in set(deadlines.pop_due()):
         try:
-            data = load_json(json_file_path)
-            if data is None:
-                continue
-            
-            updated_data, was_unlocked = unlock_if_needed(data, timeout_duration)
-            if was_unlocked:
-                save_json(json_file_path, updated_data)
-                print(f"Updated and saved: {json_name}")
+            data, was_unlocked = store.expire(key, deadlines.timeout_duration)
         except Exception as e:
-            print(f"Failed to process {json_name}: {e}")
+            # the key has left the heap, put it back or the lock is never expired
+            print(f"Failed to process {key}, retrying in {retry_seconds}s: {e}")
+            deadlines.push_deadline(key, datetime.now() + timedelta(seconds=retry_seconds))
+            continue
+        if was_unlocked:
+            if on_unlock is not None:
+                on_unlock(key, data)
+            print(f"Updated and saved: {key}")
 
 
 # -----------------------------
 # Run as scheduled job
 # -----------------------------
 
-def start_unlocker_job(folder_path, timeout_minutes=15, interval_seconds=10):
+def start_unlocker_job(store, timeout_minutes=15, interval_seconds=10, on_unlock=None, deadlines=None):
     """
-    Start a scheduled job to periodically check and unlock stale JSON files.
+    Start a scheduled job to periodically check and unlock stale annotation records.
     
     Parameters:
         interval_seconds (int): Interval between checks in seconds
-        folder_path (str): Folder path containing JSON files
+        store: Annotation storage backend (see storage.open_store)
         timeout_minutes (int): Timeout duration in minutes after which the lock is considered stale
+        on_unlock (callable): Optional callback called as on_unlock(key, data) after an image is unlocked
+        deadlines (LockDeadlines): If given, only the locks registered in this heap are checked
+            instead of scanning every record
     """
     timeout_duration = timedelta(minutes=timeout_minutes)
-    print(f"Starting unlocker job every {interval_seconds} seconds for folder: {folder_path} with timeout: {timeout_minutes} minutes")
-    schedule.every(interval_seconds).seconds.do(unlock_stale_locks, json_folder_path=folder_path, timeout_duration=timeout_duration)
+    print(f"Starting unlocker job every {interval_seconds} seconds for {store.kind} storage with timeout: {timeout_minutes} minutes")
+    if deadlines is not None:
+        schedule.every(interval_seconds).seconds.do(expire_due_locks, store=store, deadlines=deadlines, on_unlock=on_unlock,
+                                                     retry_seconds=interval_seconds)
+    else:
+        schedule.every(interval_seconds).seconds.do(unlock_stale_locks, store=store, timeout_duration=timeout_duration, on_unlock=on_unlock)
 
     while True:
         schedule.run_pending()
@@ -0,0 +1,704 @@
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+from json_lock import (read_json, atomic_write_json, update_json, try_lock, release_lock, file_lock,
+                       acquire_lock, release_owned_lock)
+from schedule_unlock import is_stale, unlock_if_needed
+from image_index import annotator_ids
+
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tiff', '.bmp', '.gif')
+
+
+def new_record(image_name):
+    """Return the initial annotation record of an image."""
+    return {
+        "image_name": image_name,  # Placeholder for the name of the image file.
+        "image_status": "unlocked",  # Status indicating if the image is locked for annotation.
+        "annotation_completed": "No",  # Indicates if annotation for this image is completed.
+        "lock_time": "",  # Time when the image was locked for annotation.
+        "lock_owner": "",  # Id of the annotator holding the lock.
+        "overall_annotation": "",  # Overall annotation for the image.
+        "overall_annotation_history": [],  # History of overall annotations.
+        "annotation_history": []  # Annotation history for the image.
+    }
+
+
+def record_key(image_name):
+    """Records are keyed by the image file name without extension, like the JSON file names."""
+    return os.path.splitext(image_name)[0]
+
+
+# -----------------------------
+# Folder layout of the file backends
+# -----------------------------
+
+# Marker file of a record folder, folders without it use the flat layout
+LAYOUT_FILE = ".layout.json"
+
+
+def read_layout(folder):
+    """Layout of a record folder, {"layout": "flat"} or {"layout": "sharded", "shard_chars": n}."""
+    path = os.path.join(folder, LAYOUT_FILE)
+    if not os.path.exists(path):
+        return {"layout": "flat"}
+    return read_json(path)
+
+
+def has_records(folder):
+    """True if the folder contains anything besides hidden files (lock folder, layout file)."""
+    if not os.path.isdir(folder):
+        return False
+    with os.scandir(folder) as entries:
+        return any(not entry.name.startswith('.') for entry in entries)
+
+
+def init_layout(folder, layout=None, shard_chars=2):
+    """
+    Open the layout of a record folder, choosing it if the folder has no records yet.
+
+    Parameters:
+        folder (str): Record folder
+        layout (str): 'flat' (one folder), 'sharded' (subfolders named by a hash prefix of the key),
+            or None to keep the current layout
+        shard_chars (int): Hex characters of the hash prefix, 2 gives 256 subfolders
+
+    Returns:
+        dict: The layout of the folder
+    """
+    os.makedirs(folder, exist_ok=True)
+    current = read_layout(folder)
+    wanted = {"layout": layout, "shard_chars": shard_chars} if layout == "sharded" else {"layout": layout}
+    if layout is None or current == wanted:
+        return current
+    if has_records(folder):
+        raise ValueError(f"{folder} already holds records in the {current['layout']} layout, "
+                         f"copy them with 'convert_storage relayout' (add '--backend split' for a split folder) to change it")
+    if layout == "sharded":
+        for i in range(16 ** shard_chars):
+            os.makedirs(os.path.join(folder, f"{i:0{shard_chars}x}"), exist_ok=True)
+    atomic_write_json(os.path.join(folder, LAYOUT_FILE), wanted)
+    return wanted
+
+
+def output_layout(folder, like=None):
+    """Layout for an output folder: its own if it has records, otherwise the layout `like` of the input."""
+    if has_records(folder) or like is None:
+        return init_layout(folder)
+    return init_layout(folder, like["layout"], like.get("shard_chars", 2))
+
+
+def record_folder(folder, key, layout):
+    """Folder holding the files of a record."""
+    if layout["layout"] == "sharded":
+        return os.path.join(folder, hashlib.md5(key.encode('utf-8')).hexdigest()[:layout["shard_chars"]])
+    return folder
+
+
+def scan_keys(folder, suffix, layout):
+    """Stream the keys of the record files ending in `suffix` with os.scandir, without listing the folder at once."""
+    folders = [folder]
+    if layout["layout"] == "sharded":
+        with os.scandir(folder) as entries:
+            folders = sorted(entry.path for entry in entries if entry.is_dir() and not entry.name.startswith('.'))
+    for path in folders:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name.endswith(suffix) and not entry.name.startswith('.'):
+                    yield entry.name[:-len(suffix)]
+
+
+# -----------------------------
+# One JSON file per image
+# -----------------------------
+
+class JsonStore:
+    """
+    Annotation records stored as one JSON file per image (the layout created by init_annotation_json).
+
+    The files are either all in `json_folder_path` or, in the sharded layout, spread over
+    subfolders named by a hash prefix of the key (see init_layout).
+    """
+    kind = "json"
+
+    def __init__(self, json_folder_path, layout=None, shard_chars=2):
+        self.json_folder_path = json_folder_path
+        self.layout = init_layout(json_folder_path, layout, shard_chars)
+
+    def path(self, key):
+        return os.path.join(record_folder(self.json_folder_path, key, self.layout), key + ".json")
+
+    def iter_keys(self):
+        return scan_keys(self.json_folder_path, ".json", self.layout)
+
+    def keys(self):
+        return list(self.iter_keys())
+
+    def exists(self, key):
+        return os.path.exists(self.path(key))
+
+    def load(self, key):
+        return read_json(self.path(key))
+
+    def image_name(self, key):
+        return self.load(key)["image_name"]
+
+    def iter_records(self):
+        for key in self.iter_keys():
+            try:
+                yield key, self.load(key)
+            except Exception as e:
+                print(f"Failed to read {key}: {e}")
+
+    def create(self, image_name):
+        key = record_key(image_name)
+        if self.exists(key):
+            return False
+        atomic_write_json(self.path(key), new_record(image_name))
+        return True
+
+    def save(self, key, data):
+        atomic_write_json(self.path(key), data)
+
+    def update(self, key, update_fn):
+        return update_json(self.path(key), update_fn)
+
+    def try_lock(self, key, owner):
+        return try_lock(self.path(key), owner)
+
+    def release(self, key, owner=None):
+        return release_lock(self.path(key), owner)
+
+    def expire(self, key, timeout_duration):
+        return update_json(self.path(key), lambda data: unlock_if_needed(data, timeout_duration)[1])
+
+    def expire_stale(self, timeout_duration):
+        unlocked = []
+        for key, data in self.iter_records():
+            # cheap check without the file lock first, most files are not stale
+            if not is_stale(data, timeout_duration):
+                continue
+            try:
+                data, was_unlocked = self.expire(key, timeout_duration)
+            except Exception as e:
+                print(f"Failed to process {key}: {e}")
+                continue
+            if was_unlocked:
+                unlocked.append((key, data))
+        return unlocked
+
+
+# -----------------------------
+# Split state file + history log per image
+# -----------------------------
+
+# Fields kept out of the state file and appended to the history log instead
+HISTORY_FIELDS = ("overall_annotation_history", "annotation_history")
+
+
+def history_summary(data, log_size=0):
+    """What the lock operations need to know about the history of a record, without reading it."""
+    return {
+        "annotator_ids": sorted(annotator_ids(data)),
+        "annotation_count": len(data.get("annotation_history", [])),
+        "overall_count": len(data.get("overall_annotation_history", [])),
+        "log_size": log_size,
+    }
+
+
+class SplitStore:
+    """
+    Annotation records split into a small state file and an append-only history log per image.
+
+    `<key>.state.json` holds every field except the two history lists, plus a 'history_summary'
+    (annotator ids, entry counts and the committed size of the log), written without indentation.
+    New history entries are appended to `<key>.history.jsonl`. Taking, releasing and expiring locks
+    only rewrite the state file, so their cost does not grow with the annotation chain; they return
+    the state with its 'history_summary' instead of the full record. `load` joins both files into
+    the canonical record, and `convert_storage export --backend split` compacts a folder back into
+    one JSON file per image. Like JsonStore, the files can be kept in the sharded layout.
+    """
+    kind = "split"
+
+    STATE_SUFFIX = ".state.json"
+    HISTORY_SUFFIX = ".history.jsonl"
+
+    def __init__(self, folder_path, layout=None, shard_chars=2):
+        self.folder_path = folder_path
+        self.layout = init_layout(folder_path, layout, shard_chars)
+
+    def state_path(self, key):
+        return os.path.join(record_folder(self.folder_path, key, self.layout), key + self.STATE_SUFFIX)
+
+    def history_path(self, key):
+        return os.path.join(record_folder(self.folder_path, key, self.layout), key + self.HISTORY_SUFFIX)
+
+    def iter_keys(self):
+        return scan_keys(self.folder_path, self.STATE_SUFFIX, self.layout)
+
+    def keys(self):
+        return list(self.iter_keys())
+
+    def exists(self, key):
+        return os.path.exists(self.state_path(key))
+
+    def load_state(self, key):
+        return read_json(self.state_path(key))
+
+    def _join(self, key, state):
+        """Canonical record of a state and the committed part of its history log."""
+        data = {k: v for k, v in state.items() if k != "history_summary"}
+        for field in HISTORY_FIELDS:
+            data[field] = []
+        # the log is appended before the state is written, a tail past log_size is an unfinished write
+        size = state["history_summary"]["log_size"]
+        if size:
+            with open(self.history_path(key), 'rb') as f:
+                content = f.read(size)
+            for line in content.decode('utf-8').splitlines():
+                item = json.loads(line)
+                data[item["field"]].append(item["entry"])
+        return data
+
+    def load(self, key):
+        return self._join(key, self.load_state(key))
+
+    def image_name(self, key):
+        # from the state file alone, the history log is not read
+        return self.load_state(key)["image_name"]
+
+    def iter_records(self):
+        for key in self.iter_keys():
+            try:
+                yield key, self.load(key)
+            except Exception as e:
+                print(f"Failed to read {key}: {e}")
+
+    def _write(self, key, data, old=None, log_size=0):
+        """
+        Write a record, called with the file lock of its state held. If the history lists of `old`
+        are a prefix of the new ones, only the new entries are appended to the log.
+        """
+        append = old is not None and all(
+            data.get(field, [])[:len(old.get(field, []))] == old.get(field, []) for field in HISTORY_FIELDS
+        )
+        lines = []
+        for field in HISTORY_FIELDS:
+            items = data.get(field, [])
+            for entry in items[len(old.get(field, [])):] if append else items:
+                lines.append(json.dumps({"field": field, "entry": entry}, ensure_ascii=False) + "\n")
+        payload = "".join(lines).encode('utf-8')
+
+        log_path = self.history_path(key)
+        if append:
+            if payload:
+                fd = os.open(log_path, os.O_WRONLY | os.O_CREAT, 0o644)
+                try:
+                    # drop the tail of a write that never reached the state file
+                    os.ftruncate(fd, log_size)
+                    os.lseek(fd, log_size, os.SEEK_SET)
+                    os.write(fd, payload)
+                    os.fsync(fd)
+                finally:
+                    os.close(fd)
+                log_size += len(payload)
+        else:
+            tmp_path = log_path + ".tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, log_path)
+            log_size = len(payload)
+
+        state = {k: v for k, v in data.items() if k not in HISTORY_FIELDS}
+        state["history_summary"] = history_summary(data, log_size)
+        atomic_write_json(self.state_path(key), state, indent=None)
+        return state
+
+    def _update_state(self, key, update_fn):
+        """Read, modify and write back the state file alone, the history log is not read."""
+        path = self.state_path(key)
+        with file_lock(path):
+            state = read_json(path)
+            changed = bool(update_fn(state))
+            if changed:
+                atomic_write_json(path, state, indent=None)
+            return state, changed
+
+    def create(self, image_name):
+        key = record_key(image_name)
+        if self.exists(key):
+            return False
+        with file_lock(self.state_path(key)):
+            if self.exists(key):
+                return False
+            self._write(key, new_record(image_name))
+        return True
+
+    def save(self, key, data):
+        with file_lock(self.state_path(key)):
+            self._write(key, data)
+
+    def update(self, key, update_fn):
+        with file_lock(self.state_path(key)):
+            state = self.load_state(key)
+            old = self._join(key, state)
+            data = json.loads(json.dumps(old))
+            changed = bool(update_fn(data))
+            if changed:
+                self._write(key, data, old, state["history_summary"]["log_size"])
+            return data, changed
+
+    def try_lock(self, key, owner):
+        return self._update_state(key, lambda state: acquire_lock(state, owner))
+
+    def release(self, key, owner=None):
+        return self._update_state(key, lambda state: release_owned_lock(state, owner))
+
+    def expire(self, key, timeout_duration):
+        return self._update_state(key, lambda state: unlock_if_needed(state, timeout_duration)[1])
+
+    def expire_stale(self, timeout_duration):
+        unlocked = []
+        for key in self.iter_keys():
+            try:
+                # cheap check without the file lock first, most images are not stale
+                if not is_stale(self.load_state(key), timeout_duration):
+                    continue
+                state, was_unlocked = self.expire(key, timeout_duration)
+            except Exception as e:
+                print(f"Failed to process {key}: {e}")
+                continue
+            if was_unlocked:
+                unlocked.append((key, state))
+        return unlocked
+
+
+# -----------------------------
+# SQLite (WAL mode)
+# -----------------------------
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    key TEXT PRIMARY KEY,
+    image_name TEXT NOT NULL,
+    annotation_completed TEXT NOT NULL DEFAULT 'No',
+    overall_annotation TEXT NOT NULL DEFAULT '',
+    extra TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS locks (
+    key TEXT PRIMARY KEY REFERENCES images(key),
+    lock_owner TEXT NOT NULL DEFAULT '',
+    lock_time TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'locked'
+);
+CREATE TABLE IF NOT EXISTS annotation_history (
+    key TEXT NOT NULL REFERENCES images(key),
+    id INTEGER NOT NULL,
+    annotator_id TEXT,
+    annotation TEXT,
+    start_time TEXT,
+    end_time TEXT,
+    extra TEXT NOT NULL DEFAULT '{}',
+    PRIMARY KEY (key, id)
+);
+CREATE TABLE IF NOT EXISTS overall_annotation_history (
+    key TEXT NOT NULL REFERENCES images(key),
+    id INTEGER NOT NULL,
+    description TEXT,
+    start_time TEXT,
+    end_time TEXT,
+    PRIMARY KEY (key, id)
+);
+CREATE INDEX IF NOT EXISTS idx_images_completed ON images(annotation_completed);
+CREATE INDEX IF NOT EXISTS idx_locks_time ON locks(lock_time);
+CREATE INDEX IF NOT EXISTS idx_history_annotator ON annotation_history(annotator_id, key);
+"""
+
+# Top-level fields stored in dedicated columns/tables, everything else goes to images.extra
+_RECORD_FIELDS = {"image_name", "image_status", "annotation_completed", "lock_time", "lock_owner",
+                  "overall_annotation", "overall_annotation_history", "annotation_history"}
+# annotation_info fields stored in annotation_history columns, everything else goes to annotation_history.extra
+_ANNOTATION_FIELDS = {"annotator_id", "annotation", "start_time", "end_time"}
+
+
+class SqliteStore:
+    """
+    Annotation records stored in a SQLite database in WAL mode, with image, lock and history tables.
+
+    Lock operations are single-row transactions and history entries are appended as rows,
+    instead of rewriting a whole JSON document.
+    """
+    kind = "sqlite"
+
+    def __init__(self, sqlite_path):
+        self.sqlite_path = sqlite_path
+        folder = os.path.dirname(sqlite_path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self._local = threading.local()
+        conn = self._connection()
+        conn.executescript(SQLITE_SCHEMA)
+        # databases created before the 'merging' status have no status column
+        if "status" not in [row["name"] for row in conn.execute("PRAGMA table_info(locks)")]:
+            conn.execute("ALTER TABLE locks ADD COLUMN status TEXT NOT NULL DEFAULT 'locked'")
+        # nor do they have extra annotation_info fields (e.g. merge_failed)
+        if "extra" not in [row["name"] for row in conn.execute("PRAGMA table_info(annotation_history)")]:
+            conn.execute("ALTER TABLE annotation_history ADD COLUMN extra TEXT NOT NULL DEFAULT '{}'")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.sqlite_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        conn = self._connection()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def keys(self):
+        return [row["key"] for row in self._connection().execute("SELECT key FROM images")]
+
+    def iter_keys(self):
+        return iter(self.keys())
+
+    def image_name(self, key):
+        row = self._connection().execute("SELECT image_name FROM images WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            raise KeyError(f"Unknown record: {key}")
+        return row["image_name"]
+
+    def exists(self, key):
+        return self._connection().execute("SELECT 1 FROM images WHERE key = ?", (key,)).fetchone() is not None
+
+    def _load(self, conn, key):
+        image = conn.execute("SELECT * FROM images WHERE key = ?", (key,)).fetchone()
+        if image is None:
+            raise KeyError(f"Unknown record: {key}")
+        lock = conn.execute("SELECT lock_owner, lock_time, status FROM locks WHERE key = ?", (key,)).fetchone()
+        overall_history = conn.execute(
+            "SELECT id, description, start_time, end_time FROM overall_annotation_history WHERE key = ? ORDER BY id",
+            (key,)
+        ).fetchall()
+        history = conn.execute(
+            "SELECT id, annotator_id, annotation, start_time, end_time, extra FROM annotation_history WHERE key = ? ORDER BY id",
+            (key,)
+        ).fetchall()
+
+        data = {
+            "image_name": image["image_name"],
+            "image_status": lock["status"] if lock else "unlocked",
+            "annotation_completed": image["annotation_completed"],
+            "lock_time": lock["lock_time"] if lock else "",
+            "lock_owner": lock["lock_owner"] if lock else "",
+            "overall_annotation": image["overall_annotation"],
+            "overall_annotation_history": [dict(row) for row in overall_history],
+            "annotation_history": [
+                {
+                    "id": row["id"],
+                    "annotation_info": {
+                        "annotator_id": row["annotator_id"],
+                        "annotation": row["annotation"],
+                        "start_time": row["start_time"],
+                        "end_time": row["end_time"],
+                        **json.loads(row["extra"])
+                    }
+                }
+                for row in history
+            ],
+        }
+        data.update(json.loads(image["extra"]))
+        return data
+
+    def load(self, key):
+        conn = self._connection()
+        conn.execute("BEGIN")
+        try:
+            return self._load(conn, key)
+        finally:
+            conn.execute("COMMIT")
+
+    def iter_records(self):
+        for key in self.keys():
+            try:
+                yield key, self.load(key)
+            except Exception as e:
+                print(f"Failed to read {key}: {e}")
+
+    def _write(self, conn, key, data, old=None):
+        """Write a record, storing only the history entries that are new or changed since `old`."""
+        extra = {k: v for k, v in data.items() if k not in _RECORD_FIELDS}
+        conn.execute(
+            "INSERT INTO images (key, image_name, annotation_completed, overall_annotation, extra) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET image_name = excluded.image_name, "
+            "annotation_completed = excluded.annotation_completed, "
+            "overall_annotation = excluded.overall_annotation, extra = excluded.extra",
+            (key, data.get("image_name", ""), data.get("annotation_completed", "No"),
+             data.get("overall_annotation", ""), json.dumps(extra, ensure_ascii=False))
+        )
+
+        if data.get("image_status") in ("locked", "merging"):
+            conn.execute(
+                "INSERT INTO locks (key, lock_owner, lock_time, status) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET lock_owner = excluded.lock_owner, lock_time = excluded.lock_time, "
+                "status = excluded.status",
+                (key, data.get("lock_owner", "") or "", data.get("lock_time", "") or "", data["image_status"])
+            )
+        else:
+            conn.execute("DELETE FROM locks WHERE key = ?", (key,))
+
+        old_history = old["annotation_history"] if old else []
+        for index, item in enumerate(data.get("annotation_history", [])):
+            # existing entries can change too, e.g. a merge that is given up flags its supplement
+            if index < len(old_history) and item == old_history[index]:
+                continue
+            info = item.get("annotation_info", {})
+            info_extra = {k: v for k, v in info.items() if k not in _ANNOTATION_FIELDS}
+            conn.execute(
+                "INSERT OR REPLACE INTO annotation_history (key, id, annotator_id, annotation, start_time, end_time, extra) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, item["id"], None if info.get("annotator_id") is None else str(info["annotator_id"]),
+                 info.get("annotation"), info.get("start_time"), info.get("end_time"),
+                 json.dumps(info_extra, ensure_ascii=False))
+            )
+
+        old_overall = len(old["overall_annotation_history"]) if old else 0
+        for item in data.get("overall_annotation_history", [])[old_overall:]:
+            conn.execute(
+                "INSERT OR REPLACE INTO overall_annotation_history (key, id, description, start_time, end_time) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, item["id"], item.get("description"), item.get("start_time"), item.get("end_time"))
+            )
+
+    def create(self, image_name):
+        key = record_key(image_name)
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO images (key, image_name) VALUES (?, ?)", (key, image_name)
+            )
+            return cursor.rowcount == 1
+
+    def save(self, key, data):
+        with self._transaction() as conn:
+            for table in ("locks", "annotation_history", "overall_annotation_history"):
+                conn.execute(f"DELETE FROM {table} WHERE key = ?", (key,))
+            self._write(conn, key, data)
+
+    def update(self, key, update_fn):
+        with self._transaction() as conn:
+            old = self._load(conn, key)
+            data = json.loads(json.dumps(old))
+            changed = bool(update_fn(data))
+            if changed:
+                self._write(conn, key, data, old)
+            return data, changed
+
+    def try_lock(self, key, owner):
+        owner = str(owner)
+        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "INSERT INTO locks (key, lock_owner, lock_time) "
+                "SELECT key, ?, ? FROM images WHERE key = ? AND annotation_completed = 'No' "
+                "AND NOT EXISTS (SELECT 1 FROM locks WHERE key = ?) "
+                "AND NOT EXISTS (SELECT 1 FROM annotation_history WHERE key = ? AND annotator_id = ?)",
+                (owner, current_time, key, key, key, owner)
+            )
+            return self._load(conn, key), cursor.rowcount == 1
+
+    def release(self, key, owner=None):
+        with self._transaction() as conn:
+            if owner is None:
+                cursor = conn.execute(
+                    "DELETE FROM locks WHERE key = ? AND status = 'locked' "
+                    "AND key IN (SELECT key FROM images WHERE annotation_completed = 'No')",
+                    (key,)
+                )
+            else:
+                cursor = conn.execute(
+                    "DELETE FROM locks WHERE key = ? AND status = 'locked' AND (lock_owner = '' OR lock_owner = ?) "
+                    "AND key IN (SELECT key FROM images WHERE annotation_completed = 'No')",
+                    (key, str(owner))
+                )
+            return self._load(conn, key), cursor.rowcount == 1
+
+    def expire(self, key, timeout_duration):
+        cutoff = (datetime.now() - timeout_duration).strftime("%Y-%m-%d %H:%M:%S")
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "DELETE FROM locks WHERE key = ? AND status = 'locked' AND lock_time != '' AND lock_time < ? "
+                "AND key IN (SELECT key FROM images WHERE annotation_completed = 'No')",
+                (key, cutoff)
+            )
+            return self._load(conn, key), cursor.rowcount == 1
+
+    def expire_stale(self, timeout_duration):
+        cutoff = (datetime.now() - timeout_duration).strftime("%Y-%m-%d %H:%M:%S")
+        stale = [
+            row["key"] for row in self._connection().execute(
+                "SELECT locks.key FROM locks JOIN images ON images.key = locks.key "
+                "WHERE status = 'locked' AND lock_time != '' AND lock_time < ? AND annotation_completed = 'No'",
+                (cutoff,)
+            )
+        ]
+        unlocked = []
+        for key in stale:
+            data, was_unlocked = self.expire(key, timeout_duration)
+            if was_unlocked:
+                print(f"Unlocking {data['image_name']}")
+                unlocked.append((key, data))
+        return unlocked
+
+
+def open_store(storage="json", json_folder_path="output/annotation_json", sqlite_path="output/annotation.db",
+               layout=None, shard_chars=2):
+    """
+    Open the annotation storage backend.
+
+    Parameters:
+        storage (str): Backend name, 'json', 'split' or 'sqlite'
+        json_folder_path (str): Folder of the JSON and split backends
+        sqlite_path (str): Database file of the SQLite backend
+        layout (str): Folder layout for a new JSON or split folder, 'flat' or 'sharded'
+            (None: the layout recorded in the folder, flat for a new one)
+        shard_chars (int): Hex characters of the shard folder names in the sharded layout
+
+    Returns:
+        JsonStore, SplitStore or SqliteStore
+    """
+    if storage == "json":
+        return JsonStore(json_folder_path, layout, shard_chars)
+    if storage == "split":
+        return SplitStore(json_folder_path, layout, shard_chars)
+    if storage == "sqlite":
+        return SqliteStore(sqlite_path)
+    raise ValueError(f"Unknown storage backend: {storage}")
+
+
+def add_storage_args(parser):
+    """Add the storage backend options to an argparse parser."""
+    parser.add_argument("--storage", type=str, default="json", choices=["json", "split", "sqlite"], help="Annotation storage backend ('split': small state file plus append-only history log per image, in --json_folder_path)")
+    parser.add_argument("--sqlite_path", type=str, default="output/annotation.db", help="SQLite database path (used with --storage sqlite)")
+
+
+def add_layout_args(parser):
+    """Add the folder layout options of the JSON and split backends to an argparse parser."""
+    parser.add_argument("--layout", type=str, default=None, choices=["flat", "sharded"], help="Folder layout of a new JSON or split folder ('sharded': subfolders named by a hash prefix of the key, for large corpora). Existing folders keep their layout.")
+    parser.add_argument("--shard_chars", type=int, default=2, help="Hex characters of the shard folder names, 2 gives 256 subfolders")
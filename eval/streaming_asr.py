@@ -0,0 +1,145 @@
+import os
+import wave
+import tempfile
+import threading
+
+import numpy as np
+
+from vad import frame_levels
+
+
+WHISPER_SAMPLE_RATE = 16000
+
+
+def to_mono_float(samples):
+    """Convert a Gradio audio chunk (int16 or float, mono or multi-channel) to mono float32 in [-1, 1]."""
+    samples = np.asarray(samples)
+    if samples.ndim > 1:
+        samples = samples.mean(axis=1)
+    if np.issubdtype(samples.dtype, np.integer):
+        samples = samples.astype(np.float32) / 32768.0
+    return samples.astype(np.float32)
+
+
+def resample(samples, sample_rate, target_rate=WHISPER_SAMPLE_RATE):
+    """Linear-interpolation resampling, good enough for speech recognition."""
+    if sample_rate == target_rate or len(samples) == 0:
+        return samples
+    duration = len(samples) / sample_rate
+    target_length = int(round(duration * target_rate))
+    source_times = np.arange(len(samples)) / sample_rate
+    target_times = np.arange(target_length) / target_rate
+    return np.interp(target_times, source_times, samples).astype(np.float32)
+
+
+def write_wav(path, samples, sample_rate):
+    """Write mono float samples in [-1, 1] as a 16-bit PCM WAV file."""
+    pcm = (np.clip(samples, -1.0, 1.0) * 32767).astype(np.int16)
+    with wave.open(path, 'wb') as wav_file:
+        wav_file.setnchannels(1)
+        wav_file.setsampwidth(2)
+        wav_file.setframerate(sample_rate)
+        wav_file.writeframes(pcm.tobytes())
+
+
+def quietest_cut(samples, sample_rate, center_seconds, window_seconds, frame_ms=30):
+    """
+    Sample index at the quietest frame within `window_seconds` of `center_seconds`, where cutting
+    the recording is least likely to split a word.
+    """
+    start = max(0, int((center_seconds - window_seconds) * sample_rate))
+    end = min(len(samples), int((center_seconds + window_seconds) * sample_rate))
+    levels = frame_levels(samples[start:end], sample_rate, frame_ms)
+    if len(levels) == 0:
+        return min(len(samples), int(center_seconds * sample_rate))
+    frame = int(sample_rate * frame_ms / 1000)
+    return start + int(np.argmin(levels)) * frame + frame // 2
+
+
+class StreamingTranscript:
+    """
+    Incremental transcription of one microphone recording.
+
+    Audio chunks are buffered as they arrive. About every `chunk_seconds` of audio is written to a
+    temporary WAV file and handed to `submit` (which returns a Future of the text), so Whisper
+    works on the recording while the annotator is still speaking. When recording stops only the
+    remaining tail needs to be transcribed.
+
+    Segments are cut at the quietest frame within `boundary_seconds` of `chunk_seconds`, usually
+    a pause between words, and the audio after the cut starts the next segment. A hard cut would
+    split the word spoken at the boundary, and neither segment would transcribe it correctly.
+    """
+
+    def __init__(self, submit, chunk_seconds=5.0, boundary_seconds=0.5):
+        self.submit = submit
+        self.chunk_seconds = chunk_seconds
+        self.boundary_seconds = boundary_seconds
+        self.sample_rate = None
+        self.recorded = []     # all chunks at the microphone sample rate, for the archive
+        self.pending = []      # chunks not yet sent to Whisper
+        self.pending_samples = 0
+        self.futures = []      # one future per transcribed segment, in order
+        self._lock = threading.Lock()
+
+    def add_chunk(self, sample_rate, samples):
+        """Buffer a new audio chunk and start transcribing once a full segment is available."""
+        samples = to_mono_float(samples)
+        with self._lock:
+            self.sample_rate = sample_rate
+            self.recorded.append(samples)
+            self.pending.append(samples)
+            self.pending_samples += len(samples)
+            # wait for the audio after the boundary too, the cut may fall there
+            if self.pending_samples >= (self.chunk_seconds + self.boundary_seconds) * sample_rate:
+                self._flush(cut=True)
+
+    def _flush(self, cut=False):
+        if not self.pending_samples:
+            return
+        audio = np.concatenate(self.pending)
+        if cut:
+            end = quietest_cut(audio, self.sample_rate, self.chunk_seconds, self.boundary_seconds)
+            audio, rest = audio[:end], audio[end:]
+            self.pending = [rest]
+            self.pending_samples = len(rest)
+        else:
+            self.pending = []
+            self.pending_samples = 0
+        segment = resample(audio, self.sample_rate)
+
+        fd, path = tempfile.mkstemp(prefix="cotalk_chunk_", suffix=".wav")
+        os.close(fd)
+        write_wav(path, segment, WHISPER_SAMPLE_RATE)
+        future = self.submit(path)
+        future.add_done_callback(lambda _: os.path.exists(path) and os.remove(path))
+        self.futures.append(future)
+
+    def partial_text(self):
+        """Text of the segments transcribed so far, stopping at the first unfinished one."""
+        texts = []
+        with self._lock:
+            futures = list(self.futures)
+        for future in futures:
+            if not future.done() or future.exception() is not None:
+                break
+            texts.append(future.result().strip())
+        return " ".join(t for t in texts if t)
+
+    def finish(self):
+        """
+        Send the remaining audio to Whisper.
+
+        Returns:
+            list: Futures of every segment, in order
+        """
+        with self._lock:
+            self._flush()
+            return list(self.futures)
+
+    def save(self, path):
+        """Archive the whole recording at its original sample rate."""
+        with self._lock:
+            if not self.recorded:
+                return False
+            write_wav(path, np.concatenate(self.recorded), self.sample_rate)
+            return True
@@ -0,0 +1,176 @@
+import os
+import math
+import shutil
+import tempfile
+import threading
+from html import escape
+from urllib.parse import quote
+
+from PIL import Image
+
+# raises Pillow's pixel limit for the source images, once for the process
+from display_cache import MAX_SOURCE_PIXELS  # noqa: F401
+
+DZI_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" TileSize="{tile_size}" Overlap="{overlap}" Format="{format}">
+    <Size Width="{width}" Height="{height}"/>
+</Image>
+"""
+
+VIEWER_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<script src="{openseadragon_url}/openseadragon.min.js"></script>
+<style>html, body, #viewer {{ margin: 0; width: 100%; height: 100%; background: #111; }}</style>
+</head>
+<body>
+<div id="viewer"></div>
+<script>
+OpenSeadragon({{
+    id: "viewer",
+    prefixUrl: "{openseadragon_url}/images/",
+    tileSources: "{dzi_url}",
+    showNavigator: true,
+    maxZoomPixelRatio: 2
+}});
+</script>
+</body>
+</html>
+"""
+
+OPENSEADRAGON_URL = "https://cdn.jsdelivr.net/npm/openseadragon@4.1.1/build/openseadragon"
+
+# Largest pyramid base level, larger sources are tiled from a reduced copy (about 200 MB decoded)
+MAX_PYRAMID_PIXELS = 8192 * 8192
+
+# A build holds a decoded source in memory, builds of different images (e.g. the prefetches of
+# several annotators) run one at a time so they cannot stack up
+_build_lock = threading.Lock()
+
+
+class TilePyramid:
+    """
+    Deep Zoom (DZI) tile pyramids of the source images.
+
+    For an image `<stem>.png` the pyramid is `cache_folder/<stem>.dzi` plus the tiles
+    `cache_folder/<stem>_files/<level>/<column>_<row>.jpg`, level 0 being a single pixel and the
+    last level the full resolution, or the source reduced to at most `max_pixels`. A zoomable
+    viewer only downloads the tiles in view, so the browser never loads the whole source image.
+    Pyramids are built once and rebuilt when the source is newer than its .dzi file.
+    """
+
+    def __init__(self, source_folder, cache_folder, tile_size=254, overlap=1, quality=85, max_pixels=MAX_PYRAMID_PIXELS):
+        self.source_folder = source_folder
+        self.cache_folder = cache_folder
+        self.tile_size = tile_size
+        self.overlap = overlap
+        self.quality = quality
+        self.max_pixels = max_pixels
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+        os.makedirs(cache_folder, exist_ok=True)
+
+    def source_path(self, image_name):
+        return os.path.join(self.source_folder, image_name)
+
+    def dzi_path(self, image_name):
+        return os.path.join(self.cache_folder, os.path.splitext(image_name)[0] + ".dzi")
+
+    def is_current(self, image_name):
+        try:
+            return os.path.getmtime(self.dzi_path(image_name)) >= os.path.getmtime(self.source_path(image_name))
+        except OSError:
+            return False
+
+    def _lock_for(self, image_name):
+        with self._locks_lock:
+            return self._locks.setdefault(image_name, threading.Lock())
+
+    def get(self, image_name):
+        """
+        Return the path of the .dzi file of an image, building the pyramid if needed.
+
+        Returns:
+            str: Path of the .dzi file, or None if the pyramid could not be built
+        """
+        if self.is_current(image_name):
+            return self.dzi_path(image_name)
+        with self._lock_for(image_name):
+            if self.is_current(image_name):
+                return self.dzi_path(image_name)
+            try:
+                return self.build(image_name)
+            except Exception as e:
+                print(f"Failed to build the tile pyramid of {image_name}: {e}")
+                return None
+
+    def build(self, image_name):
+        """Cut an image into a tile pyramid. The .dzi file is written last and marks the pyramid as complete."""
+        dzi_path = self.dzi_path(image_name)
+        tiles_folder = dzi_path[:-len(".dzi")] + "_files"
+        tmp_folder = tempfile.mkdtemp(dir=self.cache_folder, prefix=".tiles-")
+        try:
+            with _build_lock, Image.open(self.source_path(image_name)) as source:
+                image = self._base_level(source)
+                width, height = image.size
+                max_level = math.ceil(math.log2(max(width, height, 1)))
+
+                # only the level being cut and the next one are held in memory
+                for level in range(max_level, -1, -1):
+                    if level < max_level:
+                        image = image.resize((max(1, math.ceil(image.width / 2)), max(1, math.ceil(image.height / 2))), Image.LANCZOS)
+                    self._write_level(image, os.path.join(tmp_folder, str(level)))
+
+            if os.path.exists(tiles_folder):
+                shutil.rmtree(tiles_folder)
+            os.replace(tmp_folder, tiles_folder)
+        except BaseException:
+            shutil.rmtree(tmp_folder, ignore_errors=True)
+            raise
+
+        tmp_dzi = dzi_path + ".tmp"
+        with open(tmp_dzi, 'w', encoding='utf-8') as f:
+            f.write(DZI_TEMPLATE.format(tile_size=self.tile_size, overlap=self.overlap, format="jpg", width=width, height=height))
+        os.replace(tmp_dzi, dzi_path)
+        return dzi_path
+
+    def _base_level(self, source):
+        """Decode a source image as RGB, reduced by an integer factor to fit in `max_pixels`."""
+        factor = max(1, math.ceil(math.sqrt(source.width * source.height / self.max_pixels)))
+        # JPEG sources are decoded at a reduced scale directly, other formats are decoded whole
+        source.draft("RGB", (math.ceil(source.width / factor), math.ceil(source.height / factor)))
+        image = source
+        factor = max(1, math.ceil(math.sqrt(image.width * image.height / self.max_pixels)))
+        if factor > 1:
+            # reduce before converting, so the full resolution is never held twice
+            image = image.reduce(factor) if image.mode in ("L", "RGB", "RGBA") else image.convert("RGB").reduce(factor)
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        if image is not source:
+            # release the full decode of the source
+            source.close()
+        return image
+
+    def _write_level(self, image, folder):
+        os.makedirs(folder)
+        columns = math.ceil(image.width / self.tile_size)
+        rows = math.ceil(image.height / self.tile_size)
+        for column in range(columns):
+            for row in range(rows):
+                # tiles overlap their neighbours by `overlap` pixels on the inner edges
+                left = max(0, column * self.tile_size - self.overlap)
+                top = max(0, row * self.tile_size - self.overlap)
+                right = min(image.width, (column + 1) * self.tile_size + self.overlap)
+                bottom = min(image.height, (row + 1) * self.tile_size + self.overlap)
+                tile = image.crop((left, top, right, bottom))
+                tile.save(os.path.join(folder, f"{column}_{row}.jpg"), "JPEG", quality=self.quality)
+
+
+def viewer_html(dzi_path, height=800, openseadragon_url=OPENSEADRAGON_URL):
+    """
+    HTML of an OpenSeadragon viewer for a pyramid, served through Gradio's /file= route.
+    The viewer runs in an iframe because gr.HTML does not execute scripts.
+    """
+    dzi_url = "/file=" + quote(os.path.abspath(dzi_path))
+    page = VIEWER_TEMPLATE.format(openseadragon_url=openseadragon_url, dzi_url=dzi_url)
+    return f'<iframe srcdoc="{escape(page, quote=True)}" style="width: 100%; height: {height}px; border: 0;"></iframe>'
@@ -0,0 +1,116 @@
+import numpy as np
+
+
+SAMPLE_RATE = 16000
+# Level in dB below which a recording is treated as silence
+FLOOR_DB = -50.0
+
+
+def frame_levels(samples, sample_rate=SAMPLE_RATE, frame_ms=30):
+    """Level in dB of each consecutive `frame_ms` frame of a recording, a partial last frame is ignored."""
+    frame = int(sample_rate * frame_ms / 1000)
+    n_frames = len(samples) // frame
+    frames = samples[:n_frames * frame].reshape(n_frames, frame)
+    return 10 * np.log10(np.mean(frames ** 2, axis=1) + 1e-12)
+
+
+def speech_segments(samples, sample_rate=SAMPLE_RATE, frame_ms=30, margin_db=10.0, floor_db=FLOOR_DB,
+                    padding_ms=300, min_silence_ms=500, min_speech_ms=200):
+    """
+    Energy-based voice activity detection.
+
+    A frame is speech when its level is `margin_db` above the noise floor (estimated as the 10th
+    percentile of frame levels) and above `floor_db`. Speech regions are padded by `padding_ms`,
+    regions separated by less than `min_silence_ms` are merged and regions shorter than
+    `min_speech_ms` are dropped. A recording without pauses (levels spread less than `margin_db`,
+    e.g. a streamed chunk of continuous speech) has no noise floor to compare with; it is one
+    segment if it is above `floor_db`, and silence otherwise.
+
+    Parameters:
+        samples (np.ndarray): Mono float audio in [-1, 1]
+        sample_rate (int): Sample rate of `samples`
+
+    Returns:
+        list: (start, end) sample indices of the speech segments
+    """
+    frame = int(sample_rate * frame_ms / 1000)
+    n_frames = len(samples) // frame
+    if n_frames == 0:
+        return []
+
+    level_db = frame_levels(samples, sample_rate, frame_ms)
+    noise_floor, loud = np.percentile(level_db, 10), np.percentile(level_db, 90)
+    if loud - noise_floor < margin_db:
+        return [(0, len(samples))] if loud > floor_db else []
+    threshold = max(noise_floor + margin_db, floor_db)
+    voiced = np.flatnonzero(level_db > threshold)
+    if len(voiced) == 0:
+        return []
+
+    padding = int(padding_ms / frame_ms)
+    min_silence = int(min_silence_ms / frame_ms)
+    min_speech = int(min_speech_ms / frame_ms)
+
+    # group voiced frames into regions, merging short pauses
+    regions = []
+    start = end = voiced[0]
+    for index in voiced[1:]:
+        if index - end > min_silence:
+            regions.append((start, end))
+            start = index
+        end = index
+    regions.append((start, end))
+
+    segments = []
+    for start, end in regions:
+        if end - start + 1 < min_speech:
+            continue
+        start = max(0, start - padding)
+        end = min(n_frames, end + 1 + padding)
+        if segments and start * frame <= segments[-1][1]:
+            segments[-1] = (segments[-1][0], int(end * frame))
+        else:
+            segments.append((int(start * frame), int(end * frame)))
+    return segments
+
+
+def trim_silence(samples, sample_rate=SAMPLE_RATE, gap_ms=200, **kwargs):
+    """
+    Cut the silences out of a recording, keeping a short gap between speech segments.
+
+    Returns:
+        tuple: (trimmed samples, speech segments)
+    """
+    segments = speech_segments(samples, sample_rate, **kwargs)
+    if not segments:
+        return samples[:0], segments
+    gap = np.zeros(int(sample_rate * gap_ms / 1000), dtype=samples.dtype)
+    pieces = []
+    for start, end in segments:
+        if pieces:
+            pieces.append(gap)
+        pieces.append(samples[start:end])
+    return np.concatenate(pieces), segments
+
+
+def transcribe_with_vad(model, audio_path):
+    """
+    Transcribe only the speech segments of an audio file with a Whisper model.
+    The file itself is left unchanged.
+
+    Returns:
+        str: Transcribed text, empty if the recording is silent
+    """
+    import whisper
+
+    samples = whisper.load_audio(audio_path)
+    speech, segments = trim_silence(samples, SAMPLE_RATE)
+    if not segments:
+        # only skip Whisper for a recording that is silent as a whole, VAD misses must not drop speech
+        if len(samples) and 10 * np.log10(np.mean(samples ** 2) + 1e-12) > FLOOR_DB:
+            print(f"VAD found no speech segments, transcribing the whole recording: {audio_path}")
+            return model.transcribe(samples)["text"]
+        return ""
+    kept = len(speech) / max(len(samples), 1)
+    print(f"VAD kept {kept:.0%} of {len(samples) / SAMPLE_RATE:.1f}s in {len(segments)} segments: {audio_path}")
+    return model.transcribe(speech)["text"]